@@ -1,17 +1,25 @@
 # --- IMPORTACIONES ---
-from flask import Flask, render_template, request, send_from_directory, abort, redirect, url_for, session
+from flask import Flask, render_template, request, send_from_directory, send_file, abort, redirect, url_for, session
 import os
 import json
 import tempfile
 import sys
 import webbrowser
+import threading
+import time
+import hashlib
+import shutil
+import contextvars
+import queue
+import atexit
 from threading import Timer
+from collections import OrderedDict
 from waitress import serve
 import uuid 
 from datetime import datetime
+APP_TZ_NAME = os.getenv('APP_TZ', 'America/Argentina/Buenos_Aires')
 try:
     from zoneinfo import ZoneInfo
-    APP_TZ_NAME = os.getenv('APP_TZ', 'America/Argentina/Buenos_Aires')
     _APP_TZ = ZoneInfo(APP_TZ_NAME)
 except Exception:
     _APP_TZ = None
@@ -26,16 +34,10 @@ def ts_to_local(ts: float):
         return datetime.fromtimestamp(ts, _APP_TZ) if _APP_TZ else datetime.fromtimestamp(ts)
     except Exception:
         return datetime.fromtimestamp(ts)
-import pandas as pd
 import re
 import unicodedata
 from functools import wraps
 from werkzeug.security import generate_password_hash, check_password_hash
-try:
-    import psycopg
-    from psycopg.rows import dict_row
-except ImportError:  # Permite correr sin PostgreSQL hasta instalar deps
-    psycopg = None
 try:
     from dotenv import load_dotenv
 except ImportError:
@@ -47,6 +49,19 @@ try:
 except Exception:
     pass
 
+psycopg = None
+if os.getenv('DATABASE_URL'):  # sin base configurada no se paga el import del driver
+    try:
+        import psycopg
+        from psycopg.rows import dict_row
+    except ImportError:  # Permite correr sin PostgreSQL hasta instalar deps
+        psycopg = None
+
+try:
+    import brotli  # opcional: sin él las respuestas se comprimen solo con gzip
+except ImportError:
+    brotli = None
+
 app = Flask(__name__)
 app.secret_key = os.getenv('SECRET_KEY', 'dev-secret-change-me')
 app.config['MAX_CONTENT_LENGTH'] = 25 * 1024 * 1024  # 25MB por archivo
@@ -78,28 +93,163 @@ def log_debug(*parts):
         except Exception:
             pass
 
+# --- TIEMPOS POR ETAPA ---
+# Con TIEMPOS_ETAPAS=1 cada request acumula cuánto tardó cada etapa (leer el Excel, normalizar,
+# filtrar, armar resultados, historial, render...). Se devuelve en el header Server-Timing y se
+# escribe una línea JSON por request en TIEMPOS_LOG (o por stdout si no está definida).
+# Desactivado, etapa() devuelve siempre el mismo context manager vacío.
+TIEMPOS_ETAPAS = os.getenv('TIEMPOS_ETAPAS', '0') == '1'
+TIEMPOS_LOG = os.getenv('TIEMPOS_LOG', '')
+_tiempos_actuales = contextvars.ContextVar('tiempos_etapas', default=None)  # nombre -> [segundos, veces]
+_tiempos_log_lock = threading.Lock()
+
+class _EtapaNula:
+    __slots__ = ()
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+
+_ETAPA_NULA = _EtapaNula()
+
+class _Etapa:
+    __slots__ = ('tiempos', 'nombre', 'inicio')
+    def __init__(self, tiempos, nombre):
+        self.tiempos = tiempos
+        self.nombre = nombre
+    def __enter__(self):
+        self.inicio = time.perf_counter()
+        return self
+    def __exit__(self, *exc):
+        duracion = time.perf_counter() - self.inicio
+        acumulado = self.tiempos.get(self.nombre)
+        if acumulado is None:
+            self.tiempos[self.nombre] = [duracion, 1]
+        else:
+            acumulado[0] += duracion
+            acumulado[1] += 1
+        return False
+
+def etapa(nombre):
+    """`with etapa('leer_excel'):` suma la duración del bloque a esa etapa del request actual.
+    Fuera de un request (hilos de fondo) o con TIEMPOS_ETAPAS=0 no mide nada.
+    """
+    if not TIEMPOS_ETAPAS:
+        return _ETAPA_NULA
+    tiempos = _tiempos_actuales.get()
+    if tiempos is None:
+        return _ETAPA_NULA
+    return _Etapa(tiempos, nombre)
+
+def cronometrar(nombre):
+    """Decorador: cada llamada a la función cuenta como la etapa `nombre`."""
+    def decorador(fn):
+        @wraps(fn)
+        def envoltura(*args, **kwargs):
+            with etapa(nombre):
+                return fn(*args, **kwargs)
+        return envoltura
+    return decorador
+
+def sumar_tiempos(tiempos):
+    """Agrega al request actual las etapas medidas en otro proceso (búsquedas en el pool)."""
+    actuales = _tiempos_actuales.get()
+    if actuales is None or not tiempos:
+        return
+    for nombre, (segundos, veces) in tiempos.items():
+        acumulado = actuales.setdefault(nombre, [0.0, 0])
+        acumulado[0] += segundos
+        acumulado[1] += veces
+
+# La sesión usa la zona de la app: los timestamps sin zona se interpretan como hora local
+# y los timestamptz vuelven convertidos a esa zona.
+PG_OPTIONS = f'-c TimeZone={APP_TZ_NAME}'
+PG_POOL_MIN = int(os.getenv('PG_POOL_MIN', '1'))
+PG_POOL_MAX = int(os.getenv('PG_POOL_MAX', '5'))
+PG_POOL_TIMEOUT = float(os.getenv('PG_POOL_TIMEOUT', '10'))
+_pg_pool = None
+_pg_pool_lock = threading.Lock()
+
+def get_pg_pool():
+    """Devuelve el pool de conexiones (lo crea la primera vez). None si no hay pool disponible."""
+    global _pg_pool
+    if not DATABASE_URL or not psycopg:
+        return None
+    if _pg_pool is not None:
+        return _pg_pool
+    with _pg_pool_lock:
+        if _pg_pool is None:
+            try:
+                from psycopg_pool import ConnectionPool
+            except ImportError:  # Sin pool se abre una conexión por operación
+                return None
+            try:
+                _pg_pool = ConnectionPool(
+                    DATABASE_URL,
+                    min_size=PG_POOL_MIN,
+                    max_size=max(PG_POOL_MIN, PG_POOL_MAX),
+                    timeout=PG_POOL_TIMEOUT,
+                    kwargs={'row_factory': dict_row, 'options': PG_OPTIONS},
+                    name='consulta_precios',
+                    open=True,
+                )
+                log_debug('Pool PostgreSQL creado.')
+            except Exception as e:
+                log_debug('Error creando pool PostgreSQL:', e)
+                return None
+    return _pg_pool
+
 def get_pg_conn():
+    """Conexión lista para usar con `with get_pg_conn() as conn:`.
+    Con pool devuelve una conexión prestada (se devuelve al salir del with);
+    sin pool abre una conexión nueva que se cierra al salir.
+    """
     if not DATABASE_URL or not psycopg:
         log_debug('get_pg_conn: sin DATABASE_URL o psycopg no disponible.')
         return None
+    pool = get_pg_pool()
+    if pool is not None:
+        return pool.connection()
     try:
-        conn = psycopg.connect(DATABASE_URL, row_factory=dict_row)
+        conn = psycopg.connect(DATABASE_URL, row_factory=dict_row, options=PG_OPTIONS)
         log_debug('Conexión PostgreSQL establecida.')
         return conn
     except Exception as e:
         log_debug('Error conectando a PostgreSQL:', e)
         return None
 
+def migrar_timestamp_historial(cur):
+    """Convierte historial.timestamp de TEXT ("%Y-%m-%d %H:%M:%S", hora local) a TIMESTAMPTZ.
+    Las entradas heredadas sin fecha quedan en NULL (no cuentan en los reportes por fecha).
+    Si ya es TIMESTAMPTZ pero NOT NULL (conversión anterior, que les ponía 1970-01-01),
+    le quita el NOT NULL y vuelve esas entradas a NULL.
+    """
+    cur.execute("""
+        SELECT data_type, is_nullable FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = 'historial' AND column_name = 'timestamp'
+    """)
+    row = cur.fetchone()
+    if not row:
+        return
+    if row['data_type'] == 'text':
+        from psycopg import sql
+        # DDL no admite parámetros: la zona va como literal escapado
+        cur.execute(sql.SQL("""
+            ALTER TABLE historial ALTER COLUMN timestamp DROP NOT NULL,
+                ALTER COLUMN timestamp TYPE TIMESTAMPTZ USING NULLIF(timestamp, '')::timestamp AT TIME ZONE {}
+        """).format(sql.Literal(APP_TZ_NAME)))
+        log_debug('migrar_timestamp_historial: columna timestamp convertida a TIMESTAMPTZ.')
+    elif row['is_nullable'] == 'NO':
+        cur.execute("ALTER TABLE historial ALTER COLUMN timestamp DROP NOT NULL")
+        cur.execute("UPDATE historial SET timestamp = NULL WHERE timestamp = to_timestamp(0)")
+        log_debug('migrar_timestamp_historial: entradas sin fecha pasadas a NULL', cur.rowcount)
+
 def ensure_tables():
     if not DATABASE_URL or not psycopg:
         log_debug('ensure_tables: se omite (sin DB).')
         return
-    conn = get_pg_conn()
-    if not conn:
-        log_debug('ensure_tables: no se pudo obtener conexión.')
-        return
     try:
-        with conn, conn.cursor() as cur:
+        with get_pg_conn() as conn, conn.cursor() as cur:
             cur.execute("""
             CREATE TABLE IF NOT EXISTS proveedores (
                 id TEXT PRIMARY KEY,
@@ -107,7 +257,7 @@ def ensure_tables():
             );
             CREATE TABLE IF NOT EXISTS historial (
                 id_historial TEXT PRIMARY KEY,
-                timestamp TEXT NOT NULL,
+                timestamp TIMESTAMPTZ,
                 tipo_calculo TEXT,
                 proveedor_nombre TEXT,
                 producto TEXT,
@@ -123,14 +273,41 @@ def ensure_tables():
                 created_at TIMESTAMP DEFAULT NOW()
             );
             """)
+            migrar_timestamp_historial(cur)
+            cur.execute("""
+            CREATE INDEX IF NOT EXISTS historial_timestamp_idx ON historial (timestamp);
+            CREATE INDEX IF NOT EXISTS historial_proveedor_idx ON historial (proveedor_nombre);
+            CREATE INDEX IF NOT EXISTS historial_tipo_idx ON historial (tipo_calculo);
+            CREATE TABLE IF NOT EXISTS busquedas (
+                id BIGSERIAL PRIMARY KEY,
+                timestamp TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                termino TEXT NOT NULL,
+                proveedor TEXT,
+                resultados INTEGER,
+                duracion_ms DOUBLE PRECISION
+            );
+            CREATE INDEX IF NOT EXISTS busquedas_timestamp_idx ON busquedas (timestamp);
+            CREATE TABLE IF NOT EXISTS precios_versiones (
+                proveedor TEXT NOT NULL,
+                sha256 TEXT NOT NULL,
+                filename TEXT,
+                fecha TIMESTAMPTZ NOT NULL,
+                productos INTEGER,
+                PRIMARY KEY (proveedor, sha256)
+            );
+            CREATE TABLE IF NOT EXISTS precios_historial (
+                proveedor TEXT NOT NULL,
+                codigo TEXT NOT NULL,
+                fecha TIMESTAMPTZ NOT NULL,
+                sha256 TEXT NOT NULL,
+                precio DOUBLE PRECISION,
+                PRIMARY KEY (proveedor, codigo, fecha, sha256)
+            );
+            """)
+            conn.commit()
         log_debug('ensure_tables: tablas verificadas.')
     except Exception as e:
         log_debug('ensure_tables: error creando tablas:', e)
-    finally:
-        try: conn.close()
-        except Exception: pass
-
-ensure_tables()
 
 # --- MIGRACIÓN OPCIONAL HISTORIAL JSON -> PG (solo si tabla vacía) ---
 def maybe_migrate_historial_json_to_pg():
@@ -145,49 +322,15 @@ def maybe_migrate_historial_json_to_pg():
             count = (row or {}).get('c', 0)
             if count != 0:
                 return  # ya hay datos
-            # leer json
-            try:
-                with open(HISTORIAL_FILE, 'r', encoding='utf-8') as f:
-                    datos_json = json.load(f)
-            except Exception:
-                return
-            if not isinstance(datos_json, list) or not datos_json:
-                return
-            inserted = 0
-            for item in datos_json:
-                try:
-                    porcentajes_json = json.dumps(item.get('porcentajes', {}), ensure_ascii=False)
-                    cur.execute(
-                        """
-                        INSERT INTO historial (id_historial, timestamp, tipo_calculo, proveedor_nombre, producto,
-                                               precio_base, porcentajes, precio_final, observaciones)
-                        VALUES (%(id_historial)s, %(timestamp)s, %(tipo_calculo)s, %(proveedor_nombre)s, %(producto)s,
-                                %(precio_base)s, %(porcentajes)s::jsonb, %(precio_final)s, %(observaciones)s)
-                        ON CONFLICT (id_historial) DO NOTHING
-                        """,
-                        {
-                            'id_historial': item.get('id_historial', str(uuid.uuid4())),
-                            'timestamp': item.get('timestamp', ''),
-                            'tipo_calculo': item.get('tipo_calculo'),
-                            'proveedor_nombre': item.get('proveedor_nombre'),
-                            'producto': item.get('producto'),
-                            'precio_base': item.get('precio_base'),
-                            'porcentajes': porcentajes_json,
-                            'precio_final': item.get('precio_final'),
-                            'observaciones': item.get('observaciones')
-                        }
-                    )
-                    inserted += 1
-                except Exception as e:
-                    log_debug('maybe_migrate_historial_json_to_pg: falla item', e)
-            conn.commit()
-            if inserted:
-                log_debug(f'maybe_migrate_historial_json_to_pg: migradas {inserted} filas a PG.')
+        # Carga por lotes con COPY (mismo camino que migrar_json_a_pg.py)
+        from migrar_json_a_pg import migrar_historial, iterar_items_json
+        leidas, inserted = migrar_historial(iterar_items_json(HISTORIAL_FILE))
+        invalidar_conteo_historial()
+        if inserted:
+            log_debug(f'maybe_migrate_historial_json_to_pg: migradas {inserted}/{leidas} filas a PG.')
     except Exception as e:
         log_debug('maybe_migrate_historial_json_to_pg: error general', e)
 
-maybe_migrate_historial_json_to_pg()
-
 # --- AUTENTICACIÓN BÁSICA ---
 def load_credentials():
     """Carga las credenciales desde PostgreSQL si está disponible; si no, desde archivo.
@@ -241,7 +384,7 @@ def save_credentials(data):
     except Exception as e:
         log_debug('save_credentials: error escribiendo auth.json', e)
 
-credentials_cache = load_credentials()
+credentials_cache = None  # se carga en el primer login (no al importar)
 
 def login_required(fn):
     @wraps(fn)
@@ -310,6 +453,8 @@ def cambiar_credenciales():
                 exito = True
             except Exception as e:
                 mensaje = f'Error guardando nuevas credenciales: {e}'
+    if credentials_cache is None:
+        credentials_cache = load_credentials()
     return render_template('cambiar_credenciales.html', mensaje=mensaje, exito=exito, usuario_actual=credentials_cache['username'])
 
 # --- ESTRUCTURA DE DATOS POR DEFECTO ---
@@ -341,6 +486,15 @@ def format_pct(valor):
     else:
         return f"{num_pct:.1f}"
 
+def formatear_iva(valor):
+    """IVA de una fila de la lista como se muestra ("21%", "10.5%"); acepta 0.21, 21, "21%" o "10,5"."""
+    try:
+        iva_float = float(str(valor).replace('%', '').replace(',', '.'))
+        if iva_float < 1.0 and iva_float != 0: iva_float *= 100
+        return f"{iva_float:.1f}%".replace(".0%", "%")
+    except (ValueError, TypeError):
+        return str(valor)
+
 def generar_nombre_visible(prov_data):
     if not prov_data.get("es_dinamico", False):
         return prov_data.get("nombre_base", "Sin Nombre")
@@ -373,43 +527,122 @@ def formatear_precio(valor):
     except (ValueError, TypeError):
         return "N/A"
 
-def formatear_pulgadas(nombre_producto):
-    if not isinstance(nombre_producto, str):
-        return nombre_producto
+# --- MEDIDAS CANÓNICAS ---
+# La búsqueda compara nombres y términos normalizados. Antes, formatear_pulgadas convertía cualquier
+# número suelto de 2 a 4 dígitos en fracción ("10 mm" -> "1/0 mm") y normalize_text después sacaba
+# la barra, así que "5/16", "516" y "5 16" daban resultados distintos. Ahora las medidas se llevan
+# a un token canónico que conserva la barra: fracciones de pulgada reducidas ("5/16", "1-1/2"),
+# milímetros ("10mm", "10.5mm") y pulgadas enteras o decimales ('2"'). El nombre de cada producto
+# se normaliza una vez por versión de lista (caché de columnas e índice SQLite) y el término con la
+# misma función, así que un token de medida se busca como palabra exacta.
+DENOMINADORES_PULGADA = (2, 4, 8, 16, 32, 64)
+_MARCA_PULGADA = r'(?:"|\'\'|\'|”|pulgadas?|pulg|plg)\.?'
+_RE_MEDIDA = re.compile(r"""
+    (?<![a-wyz0-9_/])(?<!\d[.,])  # "hex.5/16" sí, "3.5" no
+    (?:
+        (?P<entero>\d{1,2})[-.](?P<num1>\d{1,2})/(?P<den1>\d{1,2})  # "1 1/2" ya llega como 1-1/2
+      | (?P<num2>\d{1,2})\s*/\s*(?P<den2>\d{1,2})
+      | (?P<cantidad>\d+(?:[.,]\d+)?)\s*(?P<unidad>mm|""" + _MARCA_PULGADA + r""")
+      | (?<!x)(?P<compacto>\d{2,4})(?!x|[.,]\d)  # "x12" / "12x" son cantidades y "14.44" un decimal, no 1/2 ni 1/4
+    )
+    (?P<marca>\s*""" + _MARCA_PULGADA + r""")?
+    # Después de la marca de pulgadas puede seguir cualquier cosa (1/2"SAE); después de una fracción
+    # con barra, letras (5/16PROFESIONAL); después del resto, solo un separador
+    (?(marca)|(?(den1)(?![\d/])|(?(den2)(?![\d/])|(?![a-wyz0-9_/]))))
+""", re.X)
+_FRACCIONES_UNICODE = {'¼': '1/4', '½': '1/2', '¾': '3/4', '⅛': '1/8', '⅜': '3/8', '⅝': '5/8', '⅞': '7/8'}
+_RE_FRACCION_UNICODE = re.compile(r'(\d?)\s*([¼½¾⅛⅜⅝⅞])')
+_RE_FRACCION_ESPACIADA = re.compile(r'(?<![\d/.,])(\d{1,2}) (\d{1,2})(?![\d/.,])')
+_RE_MIXTO_ESPACIADO = re.compile(r'(?<![\d/.,])(\d{1,2})\s+(\d{1,2})/(\d{1,2})(?![\d/.,])')
+_RE_TOKEN_MEDIDA = re.compile(r'^\d+(?:-\d+/\d+|/\d+|(?:\.\d+)?(?:mm|"))$')
+
+def fraccion_pulgada(numerador, denominador, entero=0):
+    """Token de la fracción reducida ("5/16", "1-1/2"), o None si no es una medida en pulgadas."""
+    import math
+    numerador, denominador, entero = int(numerador), int(denominador), int(entero)
+    if denominador not in DENOMINADORES_PULGADA or not 0 < numerador < denominador:
+        return None
+    divisor = math.gcd(numerador, denominador)
+    fraccion = f"{numerador // divisor}/{denominador // divisor}"
+    return f"{entero}-{fraccion}" if entero else fraccion
 
-    # Función interna para reemplazar cada número encontrado
-    def reemplazar(match):
-        numero = match.group(0) # El número completo, ej: "516"
-        
-        # Si tiene 3 dígitos, es probable que sea X/16 o X/32. Asumimos /16.
-        if len(numero) == 3:
-            # Evita convertir números redondos como "100", "200", etc.
-            if numero.endswith("00"):
-                return numero
-            return f"{numero[0]}/{numero[1:]}" # 516 -> 5/16
-            
-        # Si tiene 4 dígitos, es probable que sea XX/16 o XX/32. Asumimos /16.
-        if len(numero) == 4:
-            # Evita convertir años o números redondos
-            if numero.endswith("00"):
-                return numero
-            return f"{numero[:2]}/{numero[2:]}" # 1116 -> 11/16
+def fraccion_compacta(numero):
+    """'516' -> '5/16', '12' -> '1/2', '1116' -> '11/16'. Solo fracciones ya reducidas (numerador impar)."""
+    corte = 2 if len(numero) == 4 else 1
+    numerador, denominador = numero[:corte], numero[corte:]
+    if denominador.startswith('0') or int(numerador) % 2 == 0:
+        return None
+    return fraccion_pulgada(numerador, denominador)
+
+def token_medida(m):
+    if m.group('den1'):
+        return fraccion_pulgada(m.group('num1'), m.group('den1'), m.group('entero'))
+    if m.group('den2'):
+        return fraccion_pulgada(m.group('num2'), m.group('den2'))
+    if m.group('cantidad'):
+        cantidad = m.group('cantidad').replace(',', '.')
+        if m.group('unidad') != 'mm' and cantidad.isdigit() and len(cantidad) >= 3:
+            return fraccion_compacta(cantidad) or f'{cantidad}"'  # 516" -> 5/16
+        if '.' in cantidad:
+            cantidad = cantidad.rstrip('0').rstrip('.')
+        return f"{cantidad}mm" if m.group('unidad') == 'mm' else f'{cantidad}"'
+    numero = m.group('compacto')
+    if m.group('marca') and len(numero) == 2:
+        return f'{numero}"'  # 12" son doce pulgadas, no 1/2
+    return fraccion_compacta(numero)
+
+def normalizar_medidas(texto, consulta=False):
+    """normalize_text con las medidas como tokens canónicos. "1 1/2" se lee como 1-1/2 en nombres
+    y términos por igual; con `consulta` además "5 16" se lee como 5/16 (solo en el término de
+    búsqueda: en los nombres sería ambiguo)."""
+    texto = _RE_FRACCION_UNICODE.sub(  # "½" -> "1/2", "1½" -> "1-1/2"
+        lambda m: (f"{m.group(1)}-" if m.group(1) else ' ') + _FRACCIONES_UNICODE[m.group(2)], str(texto))
+    texto = ''.join(c for c in unicodedata.normalize('NFD', texto) if unicodedata.category(c) != 'Mn').lower()
+    texto = _RE_MIXTO_ESPACIADO.sub(
+        lambda m: f"{m.group(1)}-{m.group(2)}/{m.group(3)}" if fraccion_pulgada(m.group(2), m.group(3)) else m.group(0), texto)
+    if consulta:
+        texto = _RE_FRACCION_ESPACIADA.sub(
+            lambda m: f"{m.group(1)}/{m.group(2)}" if fraccion_pulgada(m.group(1), m.group(2)) else m.group(0), texto)
+    partes = []
+    inicio = 0
+    for m in _RE_MEDIDA.finditer(texto):
+        token = token_medida(m)
+        if token is None:
+            continue  # número común: queda como texto
+        partes.append(re.sub(r'[^a-z0-9\s]+', '', texto[inicio:m.start()]))
+        partes.append(f' {token} ')
+        inicio = m.end()
+    partes.append(re.sub(r'[^a-z0-9\s]+', '', texto[inicio:]))
+    return ' '.join(''.join(partes).split())
+
+def es_token_medida(palabra):
+    return bool(_RE_TOKEN_MEDIDA.match(palabra))
 
-        # Si tiene 2 dígitos, podría ser 1/2, 1/4, 3/4, etc.
-        if len(numero) == 2:
-            return f"{numero[0]}/{numero[1]}" # 14 -> 1/4
+def modos_de_busqueda(termino):
+    """(por código, por nombre) del término. Solo dígitos (3 o más) es un código, pero si además
+    se lee como medida ("516" = 5/16) se busca también por nombre y se juntan los resultados."""
+    por_codigo = termino.isdigit() and len(termino) > 2
+    por_nombre = not por_codigo or es_token_medida(normalizar_medidas(termino, consulta=True))
+    return por_codigo, por_nombre
 
-        return numero # Devuelve el número original si no coincide
+def patrones_nombre(texto):
+    """Lo que debe contener el nombre normalizado (ver codificar_columna_busqueda) para coincidir
+    con `texto`: las medidas (5/16, 10mm, 2") como palabra exacta y el resto como subcadena."""
+    palabras = normalizar_medidas(texto, consulta=True).split()
+    return [(f' {p} ' if es_token_medida(p) else p).encode('utf-8') for p in palabras]
 
-    # El regex ahora busca cualquier número de 2 a 4 dígitos que esté solo
-    # (rodeado de espacios o al final de la cadena) para evitar modificar
-    # códigos de producto como "AB1234".
-    # \b es un "word boundary" o límite de palabra.
-    return re.sub(r'\b(\d{2,4})\b', reemplazar, nombre_producto)
+def coinciden_nombres(nombres, patrones):
+    """Máscara de los `nombres` (ndarray 'S') que contienen todos los `patrones`."""
+    import numpy as np
+    mascara = np.ones(len(nombres), dtype=bool)
+    for patron in patrones:
+        mascara &= np.char.find(nombres, patron) >= 0
+    return mascara
 
 app.jinja_env.globals.update(generar_nombre_visible=generar_nombre_visible, formatear_precio=formatear_precio)
 
 # --- FUNCIONES DB ---
+@cronometrar('proveedores_leer')
 def load_proveedores():
     # PostgreSQL preferente si está disponible
     if DATABASE_URL:
@@ -435,6 +668,7 @@ def load_proveedores():
             print(f"Warning: no se pudo leer {DATA_FILE} -> usando valores por defecto. Error: {e}")
     return json.loads(json.dumps(default_proveedores))
 
+@cronometrar('proveedores_guardar')
 def save_proveedores(data):
     # Guardar en PostgreSQL si existe
     if DATABASE_URL:
@@ -467,14 +701,37 @@ def save_proveedores(data):
         except Exception: pass
         raise
 
+TIMESTAMP_FORMATO = "%Y-%m-%d %H:%M:%S"
+
+@cronometrar('historial_leer')
 def load_historial():
+    """Historial guardado más las entradas aceptadas que el escritor todavía no volcó."""
+    # Primero lo pendiente: si el escritor vuelca entre las dos lecturas, la entrada aparece
+    # en ambas (y se descarta el duplicado) en lugar de en ninguna.
+    sin_volcar = historial_sin_volcar()
+    historial = leer_historial_guardado()
+    if sin_volcar:
+        ids = {item.get('id_historial') for item in historial}
+        for entrada in sin_volcar:
+            if entrada.get('id_historial') not in ids:
+                ids.add(entrada.get('id_historial'))
+                historial.append(entrada)
+    return historial
+
+def leer_historial_guardado():
     if DATABASE_URL:
         try:
             with get_pg_conn() as conn, conn.cursor() as cur:
-                cur.execute("SELECT * FROM historial ORDER BY timestamp ASC")
+                # Las entradas sin fecha van primero: la pantalla muestra el historial al revés
+                cur.execute("SELECT * FROM historial ORDER BY timestamp ASC NULLS FIRST")
                 rows = cur.fetchall()
                 # Aseguramos que porcentajes sea dict si viene como texto
+                # y que timestamp tenga el mismo formato de texto que en JSON
                 for r in rows:
+                    if isinstance(r.get('timestamp'), datetime):
+                        r['timestamp'] = r['timestamp'].strftime(TIMESTAMP_FORMATO)
+                    elif r.get('timestamp') is None:
+                        r['timestamp'] = ''
                     val = r.get('porcentajes')
                     if isinstance(val, str):
                         try:
@@ -493,6 +750,7 @@ def load_historial():
     except Exception:
         return []
 
+@cronometrar('historial_guardar')
 def atomic_save_historial_list(historial_list):
     if DATABASE_URL:
         try:
@@ -501,6 +759,7 @@ def atomic_save_historial_list(historial_list):
                 cur.execute("DELETE FROM historial")
                 for item in historial_list:
                     data_insert = dict(item)
+                    data_insert['timestamp'] = item.get('timestamp') or None  # sin fecha (heredadas): NULL
                     data_insert['porcentajes'] = json.dumps(item.get('porcentajes', {}), ensure_ascii=False)
                     cur.execute("""
                         INSERT INTO historial (id_historial, timestamp, tipo_calculo, proveedor_nombre, producto,
@@ -509,6 +768,7 @@ def atomic_save_historial_list(historial_list):
                                 %(precio_base)s, %(porcentajes)s::jsonb, %(precio_final)s, %(observaciones)s)
                     """, data_insert)
                 conn.commit()
+                invalidar_conteo_historial()
                 return
         except Exception as e:
             log_debug('atomic_save_historial_list: fallo PG', e)
@@ -519,32 +779,303 @@ def atomic_save_historial_list(historial_list):
         with os.fdopen(fd, "w", encoding="utf-8") as tmpf:
             json.dump(historial_list, tmpf, ensure_ascii=False, indent=4)
         os.replace(tmp_path, HISTORIAL_FILE)
+        invalidar_conteo_historial()
     except Exception:
         try: os.remove(tmp_path)
         except Exception: pass
         raise
 
 def add_entry_to_historial(nueva_entrada):
+    add_entries_to_historial([nueva_entrada])
+
+@cronometrar('historial_agregar')
+def add_entries_to_historial(nuevas_entradas):
+    """Agrega entradas al historial. Con escritura diferida solo las encola (vuelven enseguida)
+    y las escribe el hilo escritor en lotes; si no, se guardan acá en una sola transacción."""
+    if not nuevas_entradas:
+        return
+    if HISTORIAL_DIFERIDO:
+        encolar_historial(nuevas_entradas)
+        return
+    guardar_entradas_historial(nuevas_entradas)
+
+def guardar_entradas_historial(nuevas_entradas, respaldo_json=True):
+    """Un único INSERT multi-fila (executemany) en PG; si PG falla y `respaldo_json`, al JSON local.
+    Devuelve True si quedaron guardadas."""
     if DATABASE_URL:
         try:
             with get_pg_conn() as conn, conn.cursor() as cur:
-                data_insert = dict(nueva_entrada)
-                data_insert['porcentajes'] = json.dumps(nueva_entrada.get('porcentajes', {}), ensure_ascii=False)
-                cur.execute("""
+                datos = []
+                for entrada in nuevas_entradas:
+                    data_insert = dict(entrada)
+                    data_insert['porcentajes'] = json.dumps(entrada.get('porcentajes', {}), ensure_ascii=False)
+                    datos.append(data_insert)
+                cur.executemany("""
                     INSERT INTO historial (id_historial, timestamp, tipo_calculo, proveedor_nombre, producto,
                                            precio_base, porcentajes, precio_final, observaciones)
                     VALUES (%(id_historial)s, %(timestamp)s, %(tipo_calculo)s, %(proveedor_nombre)s, %(producto)s,
                             %(precio_base)s, %(porcentajes)s::jsonb, %(precio_final)s, %(observaciones)s)
-                """, data_insert)
+                    ON CONFLICT (id_historial) DO NOTHING
+                """, datos)
                 conn.commit()
-                log_debug('add_entry_to_historial: insert OK', data_insert.get('id_historial'))
-                return
+                invalidar_conteo_historial()
+                log_debug('guardar_entradas_historial: insert OK', len(datos))
+                return True
         except Exception as e:
-            log_debug('add_entry_to_historial: fallo PG', e)
-            print(f"[WARN] add_entry_to_historial PG fallo: {e}. Se usa JSON.")
-    historial_actual = load_historial() or []
-    historial_actual.append(nueva_entrada)
+            log_debug('guardar_entradas_historial: fallo PG', e)
+            if not respaldo_json:
+                return False
+            print(f"[WARN] guardar_entradas_historial PG fallo: {e}. Se usa JSON.")
+    historial_actual = leer_historial_guardado() or []
+    ids = {item.get('id_historial') for item in historial_actual}
+    historial_actual.extend(e for e in nuevas_entradas if e.get('id_historial') not in ids)
     atomic_save_historial_list(historial_actual)
+    return True
+
+# --- ESCRITURA DIFERIDA DEL HISTORIAL ---
+# Cada cálculo abría una conexión y hacía commit de un INSERT de una fila antes de responder, así
+# que la calculadora tardaba lo que tarda la base. Las entradas se aceptan en memoria y un hilo
+# escritor las vuelca en lotes (cada HISTORIAL_LOTE entradas o HISTORIAL_LOTE_MS ms) con un solo
+# INSERT multi-fila. Mientras no se escriben se muestran igual (load_historial las suma). Si la
+# base no responde, el lote se agrega a historial_pendiente.jsonl (con fsync) y se reintenta;
+# al cerrar el proceso se vuelca lo que quede. HISTORIAL_DIFERIDO=0 vuelve a escribir en el request.
+HISTORIAL_DIFERIDO = os.getenv('HISTORIAL_DIFERIDO', '1') == '1'
+HISTORIAL_LOTE = int(os.getenv('HISTORIAL_LOTE', '50'))
+HISTORIAL_LOTE_MS = int(os.getenv('HISTORIAL_LOTE_MS', '200'))
+HISTORIAL_REINTENTO = 30  # segundos entre reintentos mientras haya entradas en el archivo pendiente
+HISTORIAL_PENDIENTE_FILE = os.path.join(base_path, 'historial_pendiente.jsonl')
+_historial_cond = threading.Condition()
+_historial_pendientes = []  # aceptadas y sin escribir (incluye el lote que se está escribiendo)
+_historial_volcado_lock = threading.Lock()  # un volcado a la vez (escritor, vaciado explícito o cierre)
+_historial_escritor = None
+
+def encolar_historial(entradas):
+    with _historial_cond:
+        _historial_pendientes.extend(entradas)
+        iniciar_escritor_historial()
+        _historial_cond.notify()  # el escritor despierta y espera a juntar el lote
+
+def iniciar_escritor_historial():
+    global _historial_escritor
+    with _historial_cond:
+        if _historial_escritor is None:
+            _historial_escritor = threading.Thread(target=escritor_historial, name='escritor_historial', daemon=True)
+            _historial_escritor.start()
+            atexit.register(vaciar_historial)
+
+def escritor_historial():
+    while True:
+        try:
+            vaciar_historial()
+        except Exception as e:
+            log_debug('escritor_historial: error', e)
+        with _historial_cond:
+            reintento = HISTORIAL_REINTENTO if os.path.exists(HISTORIAL_PENDIENTE_FILE) else None
+            _historial_cond.wait_for(lambda: _historial_pendientes, timeout=reintento)
+            if _historial_pendientes:
+                # Juntar hasta completar el lote o hasta HISTORIAL_LOTE_MS
+                _historial_cond.wait_for(lambda: len(_historial_pendientes) >= HISTORIAL_LOTE, timeout=HISTORIAL_LOTE_MS / 1000)
+
+def leer_historial_pendiente():
+    """Entradas que quedaron en el archivo pendiente porque la base no respondía."""
+    if not os.path.exists(HISTORIAL_PENDIENTE_FILE):
+        return []
+    entradas = []
+    with open(HISTORIAL_PENDIENTE_FILE, 'r', encoding='utf-8') as f:
+        for linea in f:
+            try:
+                entradas.append(json.loads(linea))
+            except ValueError:
+                pass  # línea cortada por un corte de luz a mitad de escritura
+    return entradas
+
+def historial_sin_volcar():
+    # Memoria antes que archivo: un volcado que pasa lo pendiente al archivo entre ambas lecturas
+    # deja la entrada repetida (load_historial descarta duplicados), no perdida.
+    with _historial_cond:
+        pendientes = list(_historial_pendientes)
+    try:
+        return leer_historial_pendiente() + pendientes
+    except OSError as e:
+        log_debug('historial_sin_volcar: error leyendo pendientes', e)
+        return pendientes
+
+def vaciar_historial():
+    """Escribe ya lo que esté pendiente (en memoria y en el archivo pendiente)."""
+    with _historial_volcado_lock:
+        with _historial_cond:
+            lote = list(_historial_pendientes)
+        del_archivo = leer_historial_pendiente()
+        if not lote and not del_archivo:
+            return
+        if guardar_entradas_historial(del_archivo + lote, respaldo_json=False):
+            if del_archivo:
+                os.remove(HISTORIAL_PENDIENTE_FILE)
+        elif lote:
+            with open(HISTORIAL_PENDIENTE_FILE, 'a', encoding='utf-8') as f:
+                for entrada in lote:
+                    f.write(json.dumps(entrada, ensure_ascii=False) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            print(f"[WARN] Historial: {len(lote)} entrada(s) en {HISTORIAL_PENDIENTE_FILE} hasta que responda la base.")
+        with _historial_cond:
+            # Solo este volcado quita entradas: las primeras len(lote) son las que se escribieron
+            del _historial_pendientes[:len(lote)]
+
+# Conteo barato para /health: se cachea unos segundos y se invalida en cada escritura.
+HISTORIAL_COUNT_TTL = float(os.getenv('HISTORIAL_COUNT_TTL', '30'))
+_historial_count_cache = {'valor': None, 'ts': 0.0}
+
+def invalidar_conteo_historial():
+    _historial_count_cache['valor'] = None
+
+@cronometrar('historial_contar')
+def contar_historial():
+    """Cantidad de entradas del historial sin traer las filas (SELECT count(*) en PG)."""
+    ahora = time.monotonic()
+    if _historial_count_cache['valor'] is not None and ahora - _historial_count_cache['ts'] < HISTORIAL_COUNT_TTL:
+        return _historial_count_cache['valor']
+    valor = None
+    if DATABASE_URL:
+        try:
+            with get_pg_conn() as conn, conn.cursor() as cur:
+                cur.execute("SELECT count(*) AS c FROM historial")
+                valor = (cur.fetchone() or {}).get('c', 0)
+        except Exception as e:
+            log_debug('contar_historial: fallo PG', e)
+    if valor is None:
+        valor = len(load_historial())
+    _historial_count_cache['valor'] = valor
+    _historial_count_cache['ts'] = ahora
+    return valor
+
+def iterar_historial(desde=None, hasta=None, tamanio_lote=2000):
+    """Recorre el historial en orden cronológico sin cargarlo entero: cursor del lado del
+    servidor en PG, lectura incremental del archivo en modo JSON. `desde`/`hasta` son fechas inclusivas.
+    """
+    vaciar_historial()  # incluir lo recién calculado que el escritor todavía no volcó
+    if DATABASE_URL:
+        emitidas = 0
+        try:
+            with get_pg_conn() as conn:
+                filtros = []
+                params = {'tz': APP_TZ_NAME, 'desde': desde, 'hasta': hasta}
+                if desde:
+                    filtros.append("timestamp >= (%(desde)s::date)::timestamp AT TIME ZONE %(tz)s")
+                if hasta:
+                    filtros.append("timestamp < (%(hasta)s::date + 1)::timestamp AT TIME ZONE %(tz)s")
+                where = f"WHERE {' AND '.join(filtros)}" if filtros else ""
+                with conn.cursor(name='exportar_historial') as cur:
+                    cur.itersize = tamanio_lote
+                    cur.execute(f"SELECT * FROM historial {where} ORDER BY timestamp ASC NULLS LAST", params)
+                    for r in cur:
+                        if isinstance(r.get('timestamp'), datetime):
+                            r['timestamp'] = r['timestamp'].strftime(TIMESTAMP_FORMATO)
+                        elif r.get('timestamp') is None:
+                            r['timestamp'] = ''
+                        emitidas += 1
+                        yield r
+                return
+        except Exception as e:
+            log_debug('iterar_historial: fallo PG', e)
+            if emitidas:
+                raise  # ya se enviaron filas de PG: no mezclar con el JSON local
+            print(f"[WARN] iterar_historial PG fallo: {e}. Usando JSON local.")
+    if not os.path.exists(HISTORIAL_FILE):
+        return
+    from migrar_json_a_pg import iterar_items_json
+    for item in iterar_items_json(HISTORIAL_FILE):
+        if desde or hasta:
+            try:
+                fecha = datetime.strptime(str(item.get('timestamp', '')), TIMESTAMP_FORMATO).date()
+            except ValueError:
+                continue
+            if (desde and fecha < desde) or (hasta and fecha > hasta):
+                continue
+        yield item
+
+# --- REPORTES DE HISTORIAL ---
+AGRUPACIONES_HISTORIAL = {
+    'dia': "(timestamp AT TIME ZONE %(tz)s)::date",
+    'proveedor': "COALESCE(proveedor_nombre, 'N/A')",
+    'tipo': "COALESCE(tipo_calculo, 'N/A')",
+}
+
+def resumir_historial(agrupar, desde=None, hasta=None):
+    """Cantidad de cálculos, margen promedio (precio_final / precio_base - 1) y ganancia
+    promedio configurada por día, proveedor o tipo. En PG se agrega en SQL usando los índices;
+    en modo JSON se recorre el archivo. `desde`/`hasta` son fechas (date) inclusivas.
+    Las entradas sin fecha no cuentan por día ni cuando se acota por fechas.
+    """
+    if agrupar not in AGRUPACIONES_HISTORIAL:
+        raise ValueError(f"agrupar debe ser uno de: {', '.join(AGRUPACIONES_HISTORIAL)}")
+    vaciar_historial()
+    if DATABASE_URL:
+        try:
+            with get_pg_conn() as conn, conn.cursor() as cur:
+                filtros = ["timestamp IS NOT NULL"] if agrupar == 'dia' else []
+                params = {'tz': APP_TZ_NAME, 'desde': desde, 'hasta': hasta}
+                if desde:
+                    filtros.append("timestamp >= (%(desde)s::date)::timestamp AT TIME ZONE %(tz)s")
+                if hasta:
+                    filtros.append("timestamp < (%(hasta)s::date + 1)::timestamp AT TIME ZONE %(tz)s")
+                where = f"WHERE {' AND '.join(filtros)}" if filtros else ""
+                clave = AGRUPACIONES_HISTORIAL[agrupar]
+                cur.execute(f"""
+                    SELECT {clave} AS clave,
+                           count(*) AS cantidad,
+                           avg(precio_final / NULLIF(precio_base, 0) - 1) AS margen_promedio,
+                           avg((porcentajes->>'ganancia')::double precision) AS ganancia_promedio,
+                           sum(precio_final) AS total_precio_final
+                    FROM historial
+                    {where}
+                    GROUP BY 1
+                    ORDER BY 1
+                """, params)
+                filas = cur.fetchall()
+                for f in filas:
+                    if hasattr(f['clave'], 'isoformat'):
+                        f['clave'] = f['clave'].isoformat()
+                return filas
+        except Exception as e:
+            log_debug('resumir_historial: fallo PG', e)
+            print(f"[WARN] resumir_historial PG fallo: {e}. Usando JSON local.")
+    grupos = {}
+    for item in load_historial():
+        try:
+            fecha = datetime.strptime(str(item.get('timestamp', '')), TIMESTAMP_FORMATO).date()
+        except ValueError:
+            fecha = None
+        if fecha is None and (desde or hasta or agrupar == 'dia'):
+            continue
+        if (desde and fecha < desde) or (hasta and fecha > hasta):
+            continue
+        if agrupar == 'dia':
+            clave = fecha.isoformat()
+        elif agrupar == 'proveedor':
+            clave = item.get('proveedor_nombre') or 'N/A'
+        else:
+            clave = item.get('tipo_calculo') or 'N/A'
+        g = grupos.setdefault(clave, {'cantidad': 0, 'margenes': [], 'ganancias': [], 'total': 0.0})
+        g['cantidad'] += 1
+        base, final = item.get('precio_base'), item.get('precio_final')
+        if isinstance(final, (int, float)):
+            g['total'] += final
+            if isinstance(base, (int, float)) and base:
+                g['margenes'].append(final / base - 1)
+        ganancia = (item.get('porcentajes') or {}).get('ganancia')
+        if isinstance(ganancia, (int, float)):
+            g['ganancias'].append(ganancia)
+    return [
+        {
+            'clave': clave,
+            'cantidad': g['cantidad'],
+            'margen_promedio': sum(g['margenes']) / len(g['margenes']) if g['margenes'] else None,
+            'ganancia_promedio': sum(g['ganancias']) / len(g['ganancias']) if g['ganancias'] else None,
+            'total_precio_final': g['total'],
+        }
+        for clave, g in sorted(grupos.items(), key=lambda kv: (kv[0] is None, kv[0] or ''))
+    ]
 
 # --- ACTUALIZACIÓN DE LISTAS EXCEL ---
 def inferir_nombre_base_archivo(nombre_original, proveedores_dict):
@@ -576,8 +1107,921 @@ def humanizar_tiempo_desde(timestamp_segundos):
     except Exception:
         return "-"
 
+# --- CONFIGURACIÓN DE LISTAS POR PROVEEDOR ---
+# Clave: nombre normalizado del archivo (solo letras). Columnas ya normalizadas con normalize_text.
+# 'precio_base': columna que se toma como precio de lista para aplicar descuento/IVA/ganancia.
+PROVEEDOR_CONFIG = {
+    'brementools': {'fila_encabezado': 5, 'codigo': ['codigo'], 'producto': ['producto'], 'precios_a_mostrar': ['precio', 'precio de venta', 'precio de lista', 'precio neto unitario'], 'iva': ['iva'], 'extra_datos': ['unidades x caja'], 'precio_base': ['precio neto unitario', 'precio de lista', 'precio']},
+    #'bremenbuloneria': {'fila_encabezado': 5, 'codigo': ['codigo'], 'producto': ['producto'], 'precios_a_mostrar': ['precio neto unitario'], 'iva': ['iva'], 'extra_datos': ['rosca', 'terminacion', 'unidades por caja']},
+    'crossmaster': {'fila_encabezado': 11, 'codigo': ['codigo'], 'producto': ['descripcion'], 'precios_a_mostrar': ['precio lista'], 'iva': ['iva'], 'extra_datos': [], 'precio_base': ['precio lista']},
+    'berger': {'fila_encabezado': 0, 'codigo': ['cod'], 'producto': ['detalle'], 'precios_a_mostrar': ['pventa'], 'iva': ['iva'], 'extra_datos': ['marca'], 'precio_base': ['pventa']},
+    'chiesa': {'fila_encabezado': 1, 'codigo': ['codigo'], 'producto': ['descripcion'], 'precios_a_mostrar': ['pr unit', 'prunit'], 'iva': ['iva'], 'extra_datos': ['dcto', 'oferta'], 'precio_base': ['pr unit', 'prunit']},
+    'cachan': {'fila_encabezado': 0, 'codigo': ['codigo'], 'producto': ['nombre'], 'precios_a_mostrar': ['precio'], 'iva': [], 'extra_datos': ['marca'], 'precio_base': ['precio']}
+}
+
+def clave_proveedor_archivo(filename):
+    """'BremenTools-092025.xlsx' -> 'brementools' (clave de PROVEEDOR_CONFIG)."""
+    return normalize_text(''.join(filter(str.isalpha, os.path.splitext(filename)[0])))
+
+def buscar_lista_vigente(nombre_base):
+    """Nombre del archivo vigente (no OLD) del proveedor, o None."""
+    clave = normalize_text(''.join(filter(str.isalpha, nombre_base or '')))
+    candidatos = [e for e in listas_manifiesto() if not e['old'] and e['clave'] == clave]
+    if not candidatos:
+        return None
+    return max(candidatos, key=lambda e: e['mtime'])['filename']
+
+# --- MANIFIESTO DE LISTAS ---
+# Un render de "/" recorría LISTAS_PATH con os.listdir + getmtime tres veces (búsqueda,
+# últimas actualizaciones, vigentes/OLD) y la subida dos más; en un volumen de red eso suma.
+# El manifiesto tiene una entrada por archivo (proveedor, versión, OLD, tamaño, mtime, hash),
+# vive en memoria y se persiste en LISTAS_PATH/.manifiesto.json. Subidas y borrados lo
+# actualizan directamente; el directorio solo se vuelve a recorrer si cambió su mtime
+# (alguien copió o borró archivos a mano) o cada MANIFIESTO_RECONCILIAR segundos.
+MANIFIESTO_FILE = os.path.join(LISTAS_PATH, '.manifiesto.json')
+MANIFIESTO_RECONCILIAR = float(os.getenv('MANIFIESTO_RECONCILIAR', '300'))
+_manifiesto_lock = threading.RLock()
+_manifiesto = {'archivos': None, 'dir_mtime': None, 'revisado': 0.0}
+
+def version_de_archivo(fname):
+    """'Berger-092025.xlsx' -> '2025-09', 'Chiesa-08092025.xlsx' -> '2025-09-08' (None si no tiene fecha)."""
+    partes = os.path.splitext(fname)[0].split('-')
+    fecha = partes[1] if len(partes) > 1 else ''
+    if fecha.isdigit() and len(fecha) == 6:
+        return f"{fecha[2:]}-{fecha[:2]}"
+    if fecha.isdigit() and len(fecha) == 8:
+        return f"{fecha[4:]}-{fecha[2:4]}-{fecha[:2]}"
+    return None
+
+def entrada_manifiesto(fname, st, sha256=None):
+    prov_part = os.path.splitext(fname)[0].split('-')[0]
+    return {
+        'filename': fname,
+        'proveedor': prov_part,
+        'proveedor_norm': normalize_text(prov_part),
+        'clave': clave_proveedor_archivo(fname),
+        'version': version_de_archivo(fname),
+        'old': 'old' in fname.lower(),
+        'size': st.st_size,
+        'mtime': st.st_mtime,
+        'sha256': sha256,
+    }
+
+def mtime_directorio_listas():
+    try:
+        return os.stat(LISTAS_PATH).st_mtime_ns
+    except OSError:
+        return None
+
+def leer_manifiesto_persistido():
+    try:
+        with open(MANIFIESTO_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f).get('archivos') or {}
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        print(f"[WARN] Manifiesto de listas ilegible, se reconstruye: {e}")
+        return {}
+
+def guardar_manifiesto():
+    """Persiste el manifiesto (escritura atómica). Llamar con _manifiesto_lock tomado."""
+    tmp_path = None
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=LISTAS_PATH, prefix='.manifiesto-', suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as tmpf:
+            json.dump({'archivos': _manifiesto['archivos']}, tmpf, ensure_ascii=False)
+        os.replace(tmp_path, MANIFIESTO_FILE)
+    except Exception as e:
+        if tmp_path:
+            try: os.remove(tmp_path)
+            except Exception: pass
+        print(f"[WARN] No se pudo guardar el manifiesto de listas: {e}")
+    # Escribir el manifiesto cambia el mtime del directorio: no es un cambio externo
+    _manifiesto['dir_mtime'] = mtime_directorio_listas()
+
+def reconciliar_manifiesto():
+    """Recorre LISTAS_PATH y actualiza el manifiesto; conserva el hash de los archivos sin cambios."""
+    with _manifiesto_lock:
+        previos = _manifiesto['archivos'] if _manifiesto['archivos'] is not None else leer_manifiesto_persistido()
+        dir_mtime = mtime_directorio_listas()
+        try:
+            nombres = os.listdir(LISTAS_PATH)
+        except OSError as e:
+            log_debug('reconciliar_manifiesto: no se pudo leer LISTAS_PATH', e)
+            nombres = []
+        archivos = {}
+        for fname in nombres:
+            if not fname.lower().endswith(('.xlsx', '.xls')):
+                continue
+            try:
+                st = os.stat(os.path.join(LISTAS_PATH, fname))
+            except OSError:
+                continue
+            previo = previos.get(fname) or {}
+            sin_cambios = previo.get('size') == st.st_size and previo.get('mtime') == st.st_mtime
+            archivos[fname] = entrada_manifiesto(fname, st, previo.get('sha256') if sin_cambios else None)
+        _manifiesto.update(archivos=archivos, dir_mtime=dir_mtime, revisado=time.time())
+        if archivos != previos and os.path.isdir(LISTAS_PATH):
+            guardar_manifiesto()
+
+def listas_manifiesto():
+    """Entradas del manifiesto (copias). Solo recorre el directorio si hay indicios de cambios externos."""
+    with _manifiesto_lock:
+        if (_manifiesto['archivos'] is None or mtime_directorio_listas() != _manifiesto['dir_mtime']
+                or time.time() - _manifiesto['revisado'] > MANIFIESTO_RECONCILIAR):
+            reconciliar_manifiesto()
+        return [dict(e) for e in _manifiesto['archivos'].values()]
+
+def actualizar_manifiesto(quitar=(), agregar=None):
+    """Refleja cambios hechos por la app. `agregar`: {filename: sha256 o None}."""
+    with _manifiesto_lock:
+        if _manifiesto['archivos'] is None:
+            reconciliar_manifiesto()
+        archivos = _manifiesto['archivos']
+        for fname in quitar:
+            archivos.pop(fname, None)
+        for fname, sha256 in (agregar or {}).items():
+            try:
+                st = os.stat(os.path.join(LISTAS_PATH, fname))
+            except OSError:
+                archivos.pop(fname, None)
+                continue
+            archivos[fname] = entrada_manifiesto(fname, st, sha256)
+        guardar_manifiesto()
+
+def hash_en_manifiesto(fname, firma):
+    """Hash persistido del archivo si su (mtime, tamaño) no cambió."""
+    with _manifiesto_lock:
+        entrada = (_manifiesto['archivos'] or {}).get(fname)
+        if entrada and (entrada['mtime'], entrada['size']) == firma:
+            return entrada['sha256']
+    return None
+
+def registrar_hash_en_manifiesto(fname, firma, sha256):
+    with _manifiesto_lock:
+        entrada = (_manifiesto['archivos'] or {}).get(fname)
+        if entrada and (entrada['mtime'], entrada['size']) == firma and entrada['sha256'] != sha256:
+            entrada['sha256'] = sha256
+            guardar_manifiesto()
+
+# --- CACHÉ DE LISTAS EXCEL ---
+# Cada búsqueda leía todos los Excel con pd.read_excel. Se guardan las hojas ya
+# leídas (columnas normalizadas), indexadas por el SHA-256 del contenido: renombrar
+# la vigente a OLD o volver a subir el mismo archivo reutiliza lo ya leído.
+# El hash de cada ruta se recalcula solo si cambia su mtime/tamaño.
+# La caché tiene un presupuesto de memoria (CATALOGO_MEMORIA_MB, 0 = sin límite): cada entrada
+# lleva el tamaño aproximado de sus hojas, columnas normalizadas, precios por variante y facetas, y al
+# pasarse se descartan las listas buscadas hace más tiempo (se vuelven a cargar del snapshot
+# la próxima vez que se busquen).
+CATALOGO_MEMORIA_MB = int(os.getenv('CATALOGO_MEMORIA_MB', '512'))
+_catalogo_lock = threading.Lock()
+_catalogo_cache = OrderedDict()  # (sha256, header) -> {'hojas': {hoja: DataFrame}, 'bytes': int, 'variantes': {}, 'columnas': {}, 'facetas': {}, 'filename': str}; la última es la más reciente
+_rutas_catalogo = {}  # ruta -> ((mtime, size), sha256)
+_catalogo_stats = {'hits': 0, 'misses': 0, 'desalojos': 0}
+
+def sha256_archivo(file_path, tamanio_bloque=1024 * 1024):
+    h = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for bloque in iter(lambda: f.read(tamanio_bloque), b''):
+            h.update(bloque)
+    return h.hexdigest()
+
+def hash_lista(file_path, firma=None):
+    """SHA-256 del contenido de la lista (memorizado por ruta mientras no cambie mtime/tamaño).
+    `firma` = (mtime, size) ya conocida (p. ej. del manifiesto) para no hacer stat.
+    """
+    if firma is None:
+        st = os.stat(file_path)
+        firma = (st.st_mtime, st.st_size)
+    with _catalogo_lock:
+        conocido = _rutas_catalogo.get(file_path)
+        if conocido and conocido[0] == firma:
+            return conocido[1]
+    en_listas = os.path.dirname(file_path) == LISTAS_PATH
+    fname = os.path.basename(file_path)
+    digest = hash_en_manifiesto(fname, firma) if en_listas else None
+    if digest is None:
+        digest = sha256_archivo(file_path)
+        if en_listas:
+            registrar_hash_en_manifiesto(fname, firma, digest)
+    with _catalogo_lock:
+        _rutas_catalogo[file_path] = (firma, digest)
+    return digest
+
+def registrar_hash_lista(file_path, digest):
+    """Asocia un hash ya calculado (p. ej. al guardar la subida) a la ruta, sin releer el archivo."""
+    st = os.stat(file_path)
+    with _catalogo_lock:
+        _rutas_catalogo[file_path] = ((st.st_mtime, st.st_size), digest)
+
+def entrada_catalogo(file_path, header_row_index):
+    """Entrada de la caché de la ruta (o None si no está leída)."""
+    with _catalogo_lock:
+        conocido = _rutas_catalogo.get(file_path)
+        return _catalogo_cache.get((conocido[1], header_row_index)) if conocido else None
+
+def cargar_hojas_lista(file_path, header_row_index, firma=None):
+    """Devuelve {hoja: DataFrame} de la lista. Los DataFrames son compartidos: no modificarlos."""
+    with etapa('hash_lista'):
+        clave = (hash_lista(file_path, firma), header_row_index)
+    with _catalogo_lock:
+        entrada = _catalogo_cache.get(clave)
+        if entrada:
+            _catalogo_stats['hits'] += 1
+            _catalogo_cache.move_to_end(clave)
+            entrada['filename'] = os.path.basename(file_path)
+            return entrada['hojas']
+        _catalogo_stats['misses'] += 1
+    with etapa('leer_snapshot'):
+        hojas = leer_snapshot(clave)
+    if hojas is None:
+        with etapa('leer_excel'):
+            hojas = leer_hojas_excel(file_path, header_row_index)
+        with etapa('escribir_snapshot'):
+            escribir_snapshot(clave, hojas)
+    guardar_hojas_en_cache(clave, os.path.basename(file_path), hojas)
+    return hojas
+
+def leer_hojas_excel(file_path, header_row_index):
+    """Lee todas las hojas del Excel con las columnas normalizadas (sin pasar por la caché)."""
+    import pandas as pd  # import diferido: pandas tarda en cargar y no hace falta para arrancar
+    hojas = pd.read_excel(file_path, sheet_name=None, header=header_row_index)
+    for df in hojas.values():
+        df.attrs['columnas_originales'] = [str(c) for c in df.columns]
+        df.columns = [normalize_text(c) for c in df.columns]
+    return hojas
+
+def guardar_hojas_en_cache(clave, filename, hojas):
+    tam = sum(int(df.memory_usage(deep=True).sum()) for df in hojas.values())
+    with _catalogo_lock:
+        _catalogo_cache[clave] = {'hojas': hojas, 'bytes': tam, 'variantes': {}, 'columnas': {}, 'facetas': {}, 'filename': filename}
+        _catalogo_cache.move_to_end(clave)
+        ajustar_memoria_catalogo()
+
+def ajustar_memoria_catalogo():
+    """Descarta las listas usadas hace más tiempo hasta entrar en CATALOGO_MEMORIA_MB.
+    Siempre queda al menos la más reciente. Llamar con _catalogo_lock tomado."""
+    if CATALOGO_MEMORIA_MB <= 0:
+        return
+    limite = CATALOGO_MEMORIA_MB * 1024 * 1024
+    total = sum(e['bytes'] for e in _catalogo_cache.values())
+    while total > limite and len(_catalogo_cache) > 1:
+        clave, entrada = _catalogo_cache.popitem(last=False)
+        total -= entrada['bytes']
+        _catalogo_stats['desalojos'] += 1
+        log_debug('caché de listas: se descarta', entrada['filename'], f"{entrada['bytes'] / 1e6:.1f} MB")
+
+def normalizar_columna(serie, tipo):
+    import pandas as pd
+    if tipo == 'codigo':
+        return serie.apply(lambda x: str(x).split('.')[0] if pd.notna(x) else '')
+    return serie.apply(normalizar_medidas)
+
+def codificar_columna_busqueda(serie, tipo):
+    """ndarray de bytes UTF-8 de ancho fijo (dtype 'S') de la columna normalizada. Los nombres
+    llevan un espacio a cada lado para buscar las medidas como palabra entera."""
+    import numpy as np
+    valores = [(f' {v} ' if tipo == 'nombre' else v).encode('utf-8') for v in serie]
+    return np.array(valores, dtype='S') if valores else np.empty(0, dtype='S1')
+
+def columna_normalizada(file_path, header_row_index, sheet_name, df, columna, tipo):
+    """Columna de la hoja tal como la compara la búsqueda (ver codificar_columna_busqueda): tipo
+    'codigo' (texto sin decimales) o 'nombre' (normalizar_medidas). Se calcula una vez por versión
+    de lista y queda en la caché y en el snapshot, de donde los otros procesos la mapean.
+    """
+    entrada = entrada_catalogo(file_path, header_row_index)
+    clave = (sheet_name, columna, tipo)
+    if entrada is not None:
+        with _catalogo_lock:
+            valores = entrada['columnas'].get(clave)
+        if valores is not None:
+            return valores
+    with _catalogo_lock:
+        conocido = _rutas_catalogo.get(file_path)
+    ruta = ruta_columna_snapshot((conocido[1], header_row_index), clave) if conocido else None
+    valores = leer_columna_snapshot(ruta)
+    if valores is None:
+        valores = codificar_columna_busqueda(normalizar_columna(df[columna], tipo), tipo)
+        escribir_columna_snapshot(ruta, valores)
+    if entrada is not None:
+        with _catalogo_lock:
+            if clave not in entrada['columnas']:
+                entrada['columnas'][clave] = valores
+                entrada['bytes'] += valores.nbytes
+                ajustar_memoria_catalogo()
+    return valores
+
+def purgar_catalogo(rutas_vigentes):
+    """Descarta de la caché las listas que ya no están vigentes (renombradas a OLD o borradas)."""
+    with _catalogo_lock:
+        for ruta in list(_rutas_catalogo):
+            if ruta not in rutas_vigentes:
+                del _rutas_catalogo[ruta]
+        hashes_vigentes = {digest for _, digest in _rutas_catalogo.values()}
+        for clave in list(_catalogo_cache):
+            if clave[0] not in hashes_vigentes:
+                del _catalogo_cache[clave]
+
+def catalogo_stats():
+    with _catalogo_lock:
+        return {
+            'listas': len(_catalogo_cache),
+            'bytes': sum(e['bytes'] for e in _catalogo_cache.values()),
+            'limite_bytes': max(CATALOGO_MEMORIA_MB, 0) * 1024 * 1024,
+            'hits': _catalogo_stats['hits'],
+            'misses': _catalogo_stats['misses'],
+            'desalojos': _catalogo_stats['desalojos'],
+            # De la usada hace más tiempo a la más reciente
+            'residentes': [{'filename': e['filename'], 'bytes': e['bytes']} for e in _catalogo_cache.values()],
+        }
+
+# --- SNAPSHOT DEL CATÁLOGO (NumPy memmap) ---
+# Cada proceso (búsqueda, web) leía los mismos Excel con read_excel (~2 s por lista) y guardaba
+# su propia copia. Por cada versión de lista (sha256 + fila de encabezado) se escribe una vez
+# un snapshot en LISTAS_PATH/.snapshots: columnas numéricas como .npy, que los procesos mapean
+# en solo lectura (las páginas se comparten vía la caché del sistema operativo), y columnas de
+# texto/mixtas como un blob UTF-8 + offsets + tipo por celda, que se reconstruyen al cargar.
+# Las columnas normalizadas que compara la búsqueda (código y nombre) se agregan al snapshot la
+# primera vez que se calculan, como arrays de ancho fijo que los demás procesos también mapean:
+# un proceso nuevo queda listo para buscar en milisegundos sin volver a normalizar.
+# (No se usa Arrow IPC para no sumar pyarrow como dependencia.)
+CATALOGO_SNAPSHOT = os.getenv('CATALOGO_SNAPSHOT', '1') == '1'
+SNAPSHOT_DIR = os.path.join(LISTAS_PATH, '.snapshots')
+SNAPSHOT_VERSION = 2  # subirla si cambia el formato o la normalización de columnas (normalizar_medidas)
+# Tipos de celda de las columnas object
+CELDA_NULA, CELDA_TEXTO, CELDA_ENTERO, CELDA_FLOAT, CELDA_BOOL, CELDA_FECHA = range(6)
+
+def ruta_snapshot(clave):
+    digest, header = clave
+    return os.path.join(SNAPSHOT_DIR, f"{digest}-{header}")
+
+def codificar_columna_objeto(valores):
+    """(tipos uint8, números float64, offsets int64, blob bytes) de una columna object."""
+    import numpy as np
+    import pandas as pd
+    n = len(valores)
+    tipos = np.zeros(n, dtype=np.uint8)
+    numeros = np.full(n, np.nan)
+    partes = []
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    pos = 0
+    for i, v in enumerate(valores):
+        texto = b''
+        if v is None or (isinstance(v, float) and v != v):
+            tipos[i] = CELDA_NULA
+        elif isinstance(v, (bool, np.bool_)):
+            tipos[i], numeros[i] = CELDA_BOOL, float(v)
+        elif isinstance(v, (int, np.integer)):
+            tipos[i], texto = CELDA_ENTERO, str(int(v)).encode()  # como texto: enteros de más de 53 bits
+        elif isinstance(v, (float, np.floating)):
+            tipos[i], numeros[i] = CELDA_FLOAT, float(v)
+        elif isinstance(v, (pd.Timestamp, datetime)):
+            tipos[i], texto = CELDA_FECHA, pd.Timestamp(v).isoformat().encode()
+        else:
+            tipos[i], texto = CELDA_TEXTO, str(v).encode('utf-8')
+        partes.append(texto)
+        pos += len(texto)
+        offsets[i + 1] = pos
+    return tipos, numeros, offsets, b''.join(partes)
+
+def decodificar_columna_objeto(tipos, numeros, offsets, blob):
+    import numpy as np
+    import pandas as pd
+    datos = bytes(blob)
+    salida = np.empty(len(tipos), dtype=object)
+    for i, (tipo, ini, fin) in enumerate(zip(tipos.tolist(), offsets[:-1].tolist(), offsets[1:].tolist())):
+        if tipo == CELDA_TEXTO:
+            salida[i] = datos[ini:fin].decode('utf-8')
+        elif tipo == CELDA_FLOAT:
+            salida[i] = float(numeros[i])
+        elif tipo == CELDA_ENTERO:
+            salida[i] = int(datos[ini:fin])
+        elif tipo == CELDA_BOOL:
+            salida[i] = bool(numeros[i])
+        elif tipo == CELDA_FECHA:
+            salida[i] = pd.Timestamp(datos[ini:fin].decode())
+        else:
+            salida[i] = np.nan
+    return salida
+
+def escribir_snapshot(clave, hojas):
+    """Escribe el snapshot de la versión si todavía no existe (directorio temporal + rename atómico)."""
+    import numpy as np
+    destino = ruta_snapshot(clave)
+    if not CATALOGO_SNAPSHOT or os.path.isdir(destino):
+        return
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=SNAPSHOT_DIR, prefix='.tmp-')
+    try:
+        meta = {'version': SNAPSHOT_VERSION, 'hojas': []}
+        for i, (sheet_name, df) in enumerate(hojas.items()):
+            columnas = []
+            originales = df.attrs.get('columnas_originales', [str(c) for c in df.columns])
+            for j, (nombre, original) in enumerate(zip(df.columns, originales)):
+                valores = df.iloc[:, j].to_numpy()
+                base = os.path.join(tmp_dir, f"h{i}_c{j}")
+                if valores.dtype.kind in 'biuf':
+                    np.save(base + '.npy', np.ascontiguousarray(valores))
+                    columnas.append({'nombre': nombre, 'original': original, 'tipo': 'num'})
+                elif valores.dtype.kind == 'M':
+                    np.save(base + '.npy', valores.view('int64'))
+                    columnas.append({'nombre': nombre, 'original': original, 'tipo': 'fecha', 'dtype': str(valores.dtype)})
+                else:
+                    tipos, numeros, offsets, blob = codificar_columna_objeto(valores)
+                    np.save(base + '.tipos.npy', tipos)
+                    np.save(base + '.num.npy', numeros)
+                    np.save(base + '.off.npy', offsets)
+                    with open(base + '.txt', 'wb') as f:
+                        f.write(blob)
+                    columnas.append({'nombre': nombre, 'original': original, 'tipo': 'obj'})
+            meta['hojas'].append({'nombre': sheet_name, 'filas': len(df), 'columnas': columnas})
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.rename(tmp_dir, destino)
+    except Exception as e:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if not os.path.isdir(destino):  # si otro proceso lo escribió primero, no es un error
+            print(f"[WARN] No se pudo escribir el snapshot del catálogo: {e}")
+        return
+    purgar_snapshots(conservar=clave[0])
+
+def leer_snapshot(clave):
+    """{hoja: DataFrame} desde el snapshot (columnas numéricas mapeadas en solo lectura), o None."""
+    destino = ruta_snapshot(clave)
+    if not CATALOGO_SNAPSHOT or not os.path.isdir(destino):
+        return None
+    import numpy as np
+    import pandas as pd
+    try:
+        with open(os.path.join(destino, 'meta.json'), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('version') != SNAPSHOT_VERSION:
+            return None
+        hojas = {}
+        for i, hoja in enumerate(meta['hojas']):
+            datos = {}
+            for j, col in enumerate(hoja['columnas']):
+                base = os.path.join(destino, f"h{i}_c{j}")
+                if col['tipo'] == 'num':
+                    datos[j] = np.load(base + '.npy', mmap_mode='r').view(np.ndarray)  # mismo mapeo, sin la subclase memmap
+                elif col['tipo'] == 'fecha':
+                    datos[j] = np.load(base + '.npy').view(col['dtype'])
+                else:
+                    blob = np.memmap(base + '.txt', dtype=np.uint8, mode='r') if os.path.getsize(base + '.txt') else b''
+                    datos[j] = decodificar_columna_objeto(
+                        np.load(base + '.tipos.npy'), np.load(base + '.num.npy', mmap_mode='r'),
+                        np.load(base + '.off.npy'), blob)
+            df = pd.DataFrame(datos, index=pd.RangeIndex(hoja['filas']), copy=False)
+            df.columns = [col['nombre'] for col in hoja['columnas']]
+            df.attrs['columnas_originales'] = [col['original'] for col in hoja['columnas']]
+            hojas[hoja['nombre']] = df
+        return hojas
+    except Exception as e:
+        log_debug('leer_snapshot: snapshot ilegible, se vuelve a leer el Excel', destino, e)
+        return None
+
+def ruta_columna_snapshot(clave, clave_columna):
+    """Archivo .npy de una columna normalizada (hoja, columna, tipo) dentro del snapshot de la versión."""
+    nombre = hashlib.sha1(json.dumps(clave_columna, ensure_ascii=False).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(ruta_snapshot(clave), f"norm-{nombre}.npy")
+
+def leer_columna_snapshot(ruta):
+    """Columna normalizada mapeada en solo lectura, o None si no está guardada."""
+    if not CATALOGO_SNAPSHOT or not ruta or not os.path.exists(ruta):
+        return None
+    import numpy as np
+    try:
+        return np.load(ruta, mmap_mode='r').view(np.ndarray)
+    except Exception as e:
+        log_debug('leer_columna_snapshot: ilegible, se vuelve a normalizar', ruta, e)
+        return None
+
+def escribir_columna_snapshot(ruta, valores):
+    """Agrega la columna al snapshot (si existe) con archivo temporal + rename atómico."""
+    if not CATALOGO_SNAPSHOT or not ruta or not len(valores) or not os.path.isdir(os.path.dirname(ruta)):
+        return
+    import numpy as np
+    tmp = f"{ruta}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, 'wb') as f:
+            np.save(f, valores)
+        os.replace(tmp, ruta)
+    except OSError as e:
+        log_debug('escribir_columna_snapshot: no se pudo guardar', ruta, e)
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+def purgar_snapshots(conservar=None):
+    """Borra los snapshots de contenidos que ya no están en LISTAS_PATH (ni vigentes ni OLD)."""
+    hashes = {conservar}
+    for e in listas_manifiesto():
+        digest = e['sha256']
+        if digest is None:
+            # Lista todavía sin hash en el manifiesto: se calcula para no borrar su snapshot
+            try:
+                digest = hash_lista(os.path.join(LISTAS_PATH, e['filename']), (e['mtime'], e['size']))
+            except OSError as ex:
+                log_debug('purgar_snapshots: no se pudo calcular el hash, no se purga', e['filename'], ex)
+                return
+        hashes.add(digest)
+    with _catalogo_lock:
+        hashes |= {digest for _, digest in _rutas_catalogo.values()}
+    try:
+        nombres = os.listdir(SNAPSHOT_DIR)
+    except OSError:
+        return
+    for nombre in nombres:
+        if nombre.startswith('.tmp-'):
+            continue
+        if nombre.rsplit('-', 1)[0] not in hashes:
+            shutil.rmtree(os.path.join(SNAPSHOT_DIR, nombre), ignore_errors=True)
+
+# --- CATÁLOGO SQLITE (FTS5) ---
+# Sin PostgreSQL (ejecutable de escritorio, instalaciones locales) la búsqueda usa un índice
+# persistente en LISTAS_PATH/.catalogo.sqlite3: una fila por producto con código y nombre
+# normalizados, índice por código y FTS5 por nombre (tokenizador trigram: coincide por subcadena,
+# igual que la búsqueda en memoria). Cada lista se indexa al subirla, o la primera vez que se busca
+# en ella, y el índice sobrevive reinicios. Las filas encontradas se arman desde la caché de hojas.
+# CATALOGO_SQLITE=0/1 lo apaga/prende (por defecto prendido si no hay DATABASE_URL).
+CATALOGO_SQLITE = os.getenv('CATALOGO_SQLITE', '0' if DATABASE_URL else '1') == '1'
+CATALOGO_SQLITE_FILE = os.path.join(LISTAS_PATH, '.catalogo.sqlite3')
+CATALOGO_SQLITE_VERSION = 2  # subir si cambia cómo se normalizan código o nombre (2: medidas canónicas)
+_sqlite_local = threading.local()  # una conexión por hilo
+_sqlite_indexadas = set()  # (sha256, header) que ya están en el índice (visto desde este proceso)
+
+def conexion_catalogo_sqlite():
+    """Conexión del hilo actual al índice; None si está apagado o SQLite no tiene FTS5/trigram."""
+    global CATALOGO_SQLITE
+    if not CATALOGO_SQLITE:
+        return None
+    conn = getattr(_sqlite_local, 'conn', None)
+    if conn is not None:
+        return conn
+    import sqlite3
+    try:
+        conn = sqlite3.connect(CATALOGO_SQLITE_FILE, timeout=30, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        if conn.execute('PRAGMA user_version').fetchone()[0] != CATALOGO_SQLITE_VERSION:
+            # Índice armado con otra normalización: se descarta y cada lista se reindexa al buscarla
+            conn.executescript(f"""
+                BEGIN IMMEDIATE;
+                DROP TABLE IF EXISTS productos_fts;
+                DROP TABLE IF EXISTS productos;
+                DROP TABLE IF EXISTS listas;
+                PRAGMA user_version = {CATALOGO_SQLITE_VERSION};
+                COMMIT;
+            """)
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS listas (
+                sha256 TEXT NOT NULL,
+                fila_encabezado INTEGER NOT NULL,
+                filename TEXT,
+                productos INTEGER,
+                indexada TEXT,
+                PRIMARY KEY (sha256, fila_encabezado)
+            );
+            CREATE TABLE IF NOT EXISTS productos (
+                id INTEGER PRIMARY KEY,
+                sha256 TEXT NOT NULL,
+                fila_encabezado INTEGER NOT NULL,
+                hoja TEXT NOT NULL,
+                fila INTEGER NOT NULL,
+                codigo TEXT,
+                nombre TEXT
+            );
+            CREATE INDEX IF NOT EXISTS productos_lista_idx ON productos (sha256, fila_encabezado, hoja, fila);
+            CREATE INDEX IF NOT EXISTS productos_codigo_idx ON productos (codigo);
+            CREATE VIRTUAL TABLE IF NOT EXISTS productos_fts USING fts5(nombre, tokenize='trigram');
+        """)
+    except sqlite3.Error as e:
+        log_debug('conexion_catalogo_sqlite: error', e)
+        print(f"[WARN] Catálogo SQLite no disponible ({e}). Se busca en memoria.")
+        CATALOGO_SQLITE = False
+        return None
+    _sqlite_local.conn = conn
+    return conn
+
+def indexar_lista_sqlite(clave, filename, hojas, config):
+    """Agrega la versión de lista `clave` (sha256, header) al índice si no está. Devuelve True si
+    se puede buscar en ella por SQLite."""
+    if clave in _sqlite_indexadas:
+        return True
+    conn = conexion_catalogo_sqlite()
+    if conn is None:
+        return False
+    if conn.execute('SELECT 1 FROM listas WHERE sha256=? AND fila_encabezado=?', clave).fetchone():
+        _sqlite_indexadas.add(clave)
+        return True
+    filas = []
+    for hoja, df in hojas.items():
+        if df.empty:
+            continue
+        col_codigo = next((alias for alias in config['codigo'] if alias in df.columns), None)
+        col_producto = next((alias for alias in config['producto'] if alias in df.columns), None)
+        if not col_codigo or not col_producto:
+            continue
+        codigos = normalizar_columna(df[col_codigo], 'codigo')
+        nombres = normalizar_columna(df[col_producto], 'nombre')
+        filas.extend((clave[0], clave[1], str(hoja), i, c, n) for i, (c, n) in enumerate(zip(codigos, nombres)))
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        # Otro proceso pudo haberla indexado mientras se normalizaba
+        if not conn.execute('SELECT 1 FROM listas WHERE sha256=? AND fila_encabezado=?', clave).fetchone():
+            conn.executemany('INSERT INTO productos (sha256, fila_encabezado, hoja, fila, codigo, nombre) VALUES (?, ?, ?, ?, ?, ?)', filas)
+            conn.execute('INSERT INTO productos_fts (rowid, nombre) SELECT id, nombre FROM productos WHERE sha256=? AND fila_encabezado=?', clave)
+            conn.execute('INSERT INTO listas (sha256, fila_encabezado, filename, productos, indexada) VALUES (?, ?, ?, ?, ?)',
+                         (clave[0], clave[1], filename, len(filas), now_local().strftime(TIMESTAMP_FORMATO)))
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    _sqlite_indexadas.add(clave)
+    log_debug('indexar_lista_sqlite:', filename, len(filas), 'productos')
+    return True
+
+def coincidencias_sqlite(clave, hoja, termino_busqueda):
+    """(filas, códigos, nombres) de la hoja que coinciden con el término, en orden, con el código y
+    el nombre normalizados como los deja la búsqueda en memoria (ver modos_de_busqueda)."""
+    conn = conexion_catalogo_sqlite()
+    por_codigo, por_nombre = modos_de_busqueda(termino_busqueda)
+    filas = []
+    if por_codigo:
+        filas += conn.execute('SELECT fila, codigo, nombre FROM productos WHERE codigo=? AND sha256=? AND fila_encabezado=? AND hoja=?',
+                              (termino_busqueda, clave[0], clave[1], str(hoja))).fetchall()
+    if por_nombre:
+        palabras = normalizar_medidas(termino_busqueda, consulta=True).split()
+        # El trigram necesita al menos 3 caracteres; las palabras más cortas se filtran con instr()
+        largas = [p for p in palabras if len(p) >= 3]
+        params = []
+        if largas:
+            # Subconsulta: FTS resuelve el MATCH una vez en lugar de evaluarlo fila por fila
+            sql = 'SELECT p.fila, p.codigo, p.nombre FROM productos p WHERE p.id IN (SELECT rowid FROM productos_fts WHERE productos_fts MATCH ?) AND'
+            params.append(' AND '.join('"' + p.replace('"', '""') + '"' for p in largas))  # frase FTS, con las comillas de 2" escapadas
+        else:
+            sql = 'SELECT p.fila, p.codigo, p.nombre FROM productos p WHERE'
+        sql += ' p.sha256=? AND p.fila_encabezado=? AND p.hoja=?'
+        params += [clave[0], clave[1], str(hoja)]
+        for p in palabras:
+            if es_token_medida(p):
+                # Medida: palabra exacta (5/16 no debe coincidir con 15/16)
+                sql += " AND instr(' ' || p.nombre || ' ', ?) > 0"
+                params.append(f' {p} ')
+            elif len(p) < 3:
+                sql += ' AND instr(p.nombre, ?) > 0'
+                params.append(p)
+        filas += conn.execute(sql, params).fetchall()
+    filas = sorted(set(filas))
+    return [f[0] for f in filas], [f[1] for f in filas], [f[2] for f in filas]
+
+def purgar_catalogo_sqlite():
+    """Quita del índice las versiones de lista que ya no están vigentes."""
+    conn = conexion_catalogo_sqlite()
+    if conn is None:
+        return
+    vigentes = set()
+    for e in listas_manifiesto():
+        config = PROVEEDOR_CONFIG.get(e['clave'])
+        if e['old'] or not config or config.get('fila_encabezado') is None:
+            continue
+        sha = e.get('sha256') or hash_lista(os.path.join(LISTAS_PATH, e['filename']), (e['mtime'], e['size']))
+        vigentes.add((sha, config['fila_encabezado']))
+    for clave in conn.execute('SELECT sha256, fila_encabezado FROM listas').fetchall():
+        if tuple(clave) in vigentes:
+            continue
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM productos_fts WHERE rowid IN (SELECT id FROM productos WHERE sha256=? AND fila_encabezado=?)', clave)
+            conn.execute('DELETE FROM productos WHERE sha256=? AND fila_encabezado=?', clave)
+            conn.execute('DELETE FROM listas WHERE sha256=? AND fila_encabezado=?', clave)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        _sqlite_indexadas.discard(tuple(clave))
+
+# --- PRECIOS DE VENTA PRECALCULADOS POR VARIANTE ---
+# Varias entradas de `proveedores` comparten lista (BremenTools IVA 21/10.5, Chiesa p008/p009).
+# Por cada lista en caché se guarda, por hoja, el precio de venta de cada variante ya calculado
+# (entrada['variantes'][hoja][prov_id] = ndarray alineado con las filas del DataFrame).
+# Al editar un proveedor solo se descarta y recalcula (en segundo plano) su columna.
+_variantes_version = {}  # prov_id -> contador de ediciones (descarta recálculos viejos)
+
+def variantes_de_lista(filename, proveedores_dict):
+    """[(prov_id, datos)] de los proveedores cuyo nombre_base corresponde a la lista."""
+    clave = clave_proveedor_archivo(filename)
+    return sorted(
+        ((pid, pdata) for pid, pdata in proveedores_dict.items()
+         if normalize_text(''.join(filter(str.isalpha, pdata.get('nombre_base', '')))) == clave),
+        key=lambda item: generar_nombre_visible(item[1]))
+
+def calcular_variante_hoja(df, config, prov_data):
+    precio_base = next((alias for alias in config.get('precio_base') or config.get('precios_a_mostrar', []) if alias in df.columns), None)
+    if not precio_base:
+        return None
+    return columnas_precio_proveedor(df, precio_base, prov_data)[2]
+
+def precios_variantes(file_path, filename, sheet_name, df, config, proveedores_dict):
+    """{prov_id: ndarray de precio de venta} de la hoja; calcula y guarda solo las columnas que falten."""
+    variantes = variantes_de_lista(filename, proveedores_dict)
+    entrada = entrada_catalogo(file_path, config['fila_encabezado'])
+    with _catalogo_lock:
+        guardadas = dict(entrada['variantes'].get(sheet_name, {})) if entrada else {}
+    resultado = {}
+    for pid, pdata in variantes:
+        if pid not in guardadas:
+            version = _variantes_version.get(pid, 0)
+            columna = calcular_variante_hoja(df, config, pdata)
+            if columna is None:
+                continue
+            with _catalogo_lock:
+                if entrada is not None and _variantes_version.get(pid, 0) == version:
+                    guardar_variante(entrada, sheet_name, pid, columna)
+            guardadas[pid] = columna
+        resultado[pid] = guardadas[pid]
+    return resultado
+
+def guardar_variante(entrada, sheet_name, prov_id, columna):
+    """Guarda la columna en la entrada y suma su tamaño. Llamar con _catalogo_lock tomado."""
+    columnas = entrada['variantes'].setdefault(sheet_name, {})
+    previa = columnas.get(prov_id)
+    columnas[prov_id] = columna
+    entrada['bytes'] += columna.nbytes - (previa.nbytes if previa is not None else 0)
+    ajustar_memoria_catalogo()
+
+def descartar_variante(prov_id):
+    """Descarta la columna precalculada del proveedor en todas las listas en caché."""
+    with _catalogo_lock:
+        _variantes_version[prov_id] = _variantes_version.get(prov_id, 0) + 1
+        for entrada in _catalogo_cache.values():
+            for columnas in entrada['variantes'].values():
+                columna = columnas.pop(prov_id, None)
+                if columna is not None:
+                    entrada['bytes'] -= columna.nbytes
+
+def invalidar_variante(prov_id):
+    """Descarta la columna precalculada del proveedor en todas las listas y la recalcula en segundo plano."""
+    descartar_variante(prov_id)
+    threading.Thread(target=recalcular_variante, args=(prov_id,), name=f'variante_{prov_id}', daemon=True).start()
+
+def recalcular_variante(prov_id):
+    prov_data = (proveedores or {}).get(prov_id)
+    if not prov_data:
+        return  # proveedor borrado: con descartar la columna alcanza
+    with _catalogo_lock:
+        version = _variantes_version.get(prov_id, 0)
+        listas = list(_catalogo_cache.values())
+    for entrada in listas:
+        filename = entrada['filename']
+        config = PROVEEDOR_CONFIG.get(clave_proveedor_archivo(filename))
+        if not config or prov_id not in dict(variantes_de_lista(filename, {prov_id: prov_data})):
+            continue
+        for sheet_name, df in entrada['hojas'].items():
+            if df.empty:
+                continue
+            try:
+                columna = calcular_variante_hoja(df, config, prov_data)
+            except Exception as e:
+                log_debug('recalcular_variante: error', prov_id, filename, e)
+                continue
+            if columna is None:
+                continue
+            with _catalogo_lock:
+                if _variantes_version.get(prov_id, 0) != version:
+                    return  # hubo otra edición: la recalcula su propio hilo
+                guardar_variante(entrada, sheet_name, prov_id, columna)
+    log_debug('recalcular_variante: listo', prov_id)
+
+# --- FACETAS PRECALCULADAS ---
+# Después de buscar se puede acotar por proveedor, hoja, marca, IVA y rango de precio de lista.
+# Por cada versión de lista en caché se guarda, por hoja, un código por fila para cada faceta
+# (entrada['facetas'][hoja][faceta] = (etiquetas, ndarray int32; -1 = sin valor)). Acotar los
+# resultados y contar cada valor es indexar esos códigos con las filas encontradas (isin +
+# bincount), antes de armar los diccionarios de resultados. Proveedor y hoja son fijos por hoja.
+# Los conteos de cada faceta aplican los filtros elegidos en las demás, no los de ella misma.
+FACETAS = {'proveedor': 'Proveedor', 'hoja': 'Hoja', 'marca': 'Marca', 'iva': 'IVA', 'precio': 'Precio de lista'}
+FACETAS_MAX_VALORES = 15  # valores mostrados por faceta (los más frecuentes, más los elegidos)
+FACETAS_RANGOS_PRECIO = tuple(sorted(float(x) for x in os.getenv('FACETAS_RANGOS_PRECIO', '1000,5000,20000,100000').split(',') if x.strip()))
+
+def etiquetas_rangos_precio(limites):
+    pesos = lambda v: f"${v:,.0f}".replace(",", ".")
+    if not limites:
+        return ["Con precio"]
+    return ([f"Hasta {pesos(limites[0])}"]
+            + [f"{pesos(a)} a {pesos(b)}" for a, b in zip(limites, limites[1:])]
+            + [f"Más de {pesos(limites[-1])}"])
+
+ETIQUETAS_RANGOS_PRECIO = etiquetas_rangos_precio(FACETAS_RANGOS_PRECIO)
+
+def codificar_faceta(serie, etiquetar):
+    """(etiquetas ordenadas, código int32 por fila) de la columna; -1 si la fila no tiene valor.
+    `etiquetar` se llama una vez por valor distinto; valores con la misma etiqueta se unen."""
+    import numpy as np
+    import pandas as pd
+    codigos, unicos = pd.factorize(serie)
+    crudas = [etiquetar(v) for v in unicos]
+    etiquetas = sorted({e for e in crudas if e})
+    indice = {e: i for i, e in enumerate(etiquetas)}
+    # El -1 agregado al final atiende a los códigos -1 (NaN) de factorize
+    remapeo = np.array([indice.get(e, -1) for e in crudas] + [-1], dtype=np.int32)
+    return etiquetas, remapeo[codigos]
+
+def calcular_facetas_hoja(df, config):
+    import numpy as np
+    facetas = {}
+    if 'marca' in config.get('extra_datos', []) and 'marca' in df.columns:
+        facetas['marca'] = codificar_faceta(df['marca'], lambda v: str(v).strip().upper())
+    iva = next((alias for alias in config.get('iva', []) if alias in df.columns), None)
+    if iva:
+        facetas['iva'] = codificar_faceta(df[iva], formatear_iva)
+    precio_base = next((alias for alias in config.get('precio_base') or config.get('precios_a_mostrar', []) if alias in df.columns), None)
+    if precio_base:
+        base = precios_numericos(df[precio_base]).to_numpy()
+        codigos = np.searchsorted(np.array(FACETAS_RANGOS_PRECIO), base, side='left').astype(np.int32)
+        codigos[~(base > 0)] = -1  # sin precio (o NaN)
+        facetas['precio'] = (ETIQUETAS_RANGOS_PRECIO, codigos)
+    return facetas
+
+def facetas_hoja(file_path, sheet_name, df, config):
+    """{faceta: (etiquetas, códigos)} de la hoja. Se calcula una vez por versión de lista y queda en la caché."""
+    entrada = entrada_catalogo(file_path, config['fila_encabezado'])
+    if entrada is not None:
+        with _catalogo_lock:
+            facetas = entrada['facetas'].get(sheet_name)
+        if facetas is not None:
+            return facetas
+    facetas = calcular_facetas_hoja(df, config)
+    if entrada is not None:
+        with _catalogo_lock:
+            if sheet_name not in entrada['facetas']:
+                entrada['facetas'][sheet_name] = facetas
+                entrada['bytes'] += sum(codigos.nbytes for _, codigos in facetas.values())
+                ajustar_memoria_catalogo()
+    return facetas
+
+def filtrar_facetas(posiciones, facetas, fijas, filtros, conteos=None):
+    """Máscara sobre `posiciones` (filas encontradas en la hoja) de las que cumplen los `filtros`
+    {faceta: {etiquetas elegidas}}. `fijas` = {faceta: etiqueta} igual para toda la hoja
+    (proveedor, hoja). Si se pasa `conteos` ({faceta: {etiqueta: cantidad}}) suma ahí los de la hoja."""
+    import numpy as np
+    n = len(posiciones)
+    mascaras = {}
+    for faceta, elegidas in (filtros or {}).items():
+        if faceta in fijas:
+            mascaras[faceta] = np.full(n, fijas[faceta] in elegidas)
+        elif faceta in facetas:
+            etiquetas, codigos = facetas[faceta]
+            indices = [i for i, etiqueta in enumerate(etiquetas) if etiqueta in elegidas]
+            mascaras[faceta] = np.isin(codigos[posiciones], indices)
+        else:
+            mascaras[faceta] = np.zeros(n, dtype=bool)  # la hoja no tiene esa columna
+    combinar = lambda lista: np.logical_and.reduce(lista) if lista else np.ones(n, dtype=bool)
+    if conteos is not None:
+        for faceta in FACETAS:
+            visibles = combinar([m for f, m in mascaras.items() if f != faceta])
+            cuenta = conteos.setdefault(faceta, {})
+            if faceta in fijas:
+                cantidad = int(visibles.sum())
+                if cantidad:
+                    cuenta[fijas[faceta]] = cuenta.get(fijas[faceta], 0) + cantidad
+            elif faceta in facetas:
+                etiquetas, codigos = facetas[faceta]
+                valores = codigos[posiciones[visibles]]
+                por_valor = np.bincount(valores[valores >= 0], minlength=len(etiquetas))
+                for i in np.flatnonzero(por_valor):
+                    cuenta[etiquetas[i]] = cuenta.get(etiquetas[i], 0) + int(por_valor[i])
+    return combinar(list(mascaras.values()))
+
+def facetas_para_mostrar(conteos, filtros):
+    """[{'clave', 'nombre', 'valores': [{'etiqueta', 'cantidad', 'elegida'}]}] para la plantilla.
+    Se omiten las facetas con un solo valor (no acotan nada) salvo que tengan uno elegido."""
+    resultado = []
+    for faceta, nombre in FACETAS.items():
+        cuenta = dict(conteos.get(faceta, {}))
+        elegidas = filtros.get(faceta, set())
+        for etiqueta in elegidas:
+            cuenta.setdefault(etiqueta, 0)
+        if len(cuenta) < 2 and not elegidas:
+            continue
+        if faceta == 'precio':
+            orden = sorted(cuenta, key=lambda e: ETIQUETAS_RANGOS_PRECIO.index(e) if e in ETIQUETAS_RANGOS_PRECIO else len(ETIQUETAS_RANGOS_PRECIO))
+        else:
+            orden = sorted(cuenta, key=lambda e: (-cuenta[e], e))
+        mostradas = orden[:FACETAS_MAX_VALORES] + [e for e in orden[FACETAS_MAX_VALORES:] if e in elegidas]
+        resultado.append({'clave': faceta, 'nombre': nombre, 'valores': [
+            {'etiqueta': e, 'cantidad': cuenta[e], 'elegida': e in elegidas} for e in mostradas]})
+    return resultado
+
 # --- LÓGICA DE CÁLCULO ---
-proveedores = load_proveedores()
+proveedores = None  # se carga bajo demanda con asegurar_proveedores()
+
+def asegurar_proveedores():
+    global proveedores
+    if proveedores is None:
+        proveedores = load_proveedores()
+    return proveedores
 
 def core_math(precio, iva, descuentos, ganancias):
     precio_actual = precio
@@ -588,23 +2032,1149 @@ def core_math(precio, iva, descuentos, ganancias):
         if ganc is not None: precio_actual *= (1 + ganc)
     return round(precio_actual, 4)
 
-# --- RUTA PRINCIPAL ---
-@app.route("/", methods=["GET", "POST"])
-@login_required
-def index():
-    global proveedores 
-    mensaje = None
-    resultado_auto = None
-    resultado_manual = None
-    productos_encontrados = None
-    proveedor_id_seleccionado = None
-    datos_seleccionados = {}
-    active_tab = "busqueda" 
-    proveedor_buscado = ""
-    filtro_resultados = ""
-    # --- MODIFICACIÓN ---
-    datos_calculo_auto = {}
-    datos_calculo_manual = {}
+def core_math_vectorizado(precios, ivas, descuentos, ganancias):
+    """Versión NumPy de core_math para muchos precios a la vez.
+    `precios` e `ivas` son vectores de largo n; `descuentos` y `ganancias` matrices n x k
+    (un porcentaje por columna, NaN = no aplicar). Multiplica en el mismo orden que core_math,
+    así los float resultantes son idénticos, y redondea igual que round(x, 4).
+    """
+    import numpy as np
+    precio_actual = np.array(precios, dtype=float)
+    n = len(precio_actual)
+    if n == 0:
+        return []
+    for col in np.asarray(descuentos, dtype=float).reshape(n, -1).T:
+        precio_actual = np.where(np.isnan(col), precio_actual, precio_actual * (1 - col))
+    ivas = np.asarray(ivas, dtype=float)
+    precio_actual = np.where(np.isnan(ivas), precio_actual, precio_actual * (1 + ivas))
+    for col in np.asarray(ganancias, dtype=float).reshape(n, -1).T:
+        precio_actual = np.where(np.isnan(col), precio_actual, precio_actual * (1 + col))
+    # np.round(x, 4) coincide con round(x, 4) salvo cuando x*1e4 queda casi en .5 (o x es enorme):
+    # esos casos se redondean uno por uno con round() de Python.
+    redondeado = np.round(precio_actual, 4)
+    escalado = precio_actual * 1e4
+    dudosos = (np.abs(escalado - np.floor(escalado) - 0.5) < 1e-6) | (np.abs(precio_actual) > 1e11)
+    for i in np.flatnonzero(dudosos):
+        redondeado[i] = round(float(precio_actual[i]), 4)
+    return redondeado.tolist()
+
+def parse_precio(raw):
+    """Precio como lo acepta la calculadora: números tal cual; texto en formato local (1.234,56)."""
+    if raw is None or isinstance(raw, bool):
+        return None
+    if isinstance(raw, (int, float)):
+        return None if raw != raw else float(raw)  # NaN -> None
+    s = str(raw).strip().replace("$", "").replace(" ", "")
+    if not s:
+        return None
+    try:
+        return float(s.replace(".", "").replace(",", "."))
+    except ValueError:
+        return None
+
+# --- CÁLCULO POR LOTE ---
+COLUMNAS_LOTE_MANUAL = ['descuento', 'descuento_extra_1', 'descuento_extra_2', 'iva', 'ganancia', 'ganancia_extra']
+
+def clave_columna(nombre):
+    """'Proveedor ID', 'proveedor_id' y 'PROVEEDOR-ID' -> 'proveedor_id'."""
+    return normalize_text(str(nombre).replace('_', ' ').replace('-', ' ')).replace(' ', '_')
+
+def leer_filas_lote(archivo=None, datos_json=None):
+    """Devuelve la lista de filas (dicts con claves normalizadas) de un CSV/XLSX subido o de un JSON
+    (lista de objetos o {"items": [...]}).
+    """
+    if archivo is not None:
+        import pandas as pd
+        ext = os.path.splitext(archivo.filename or '')[1].lower()
+        if ext == '.csv':
+            df = pd.read_csv(archivo, sep=None, engine='python', encoding='utf-8-sig')
+        elif ext in app.config['UPLOAD_EXTENSIONS']:
+            df = pd.read_excel(archivo)
+        else:
+            raise ValueError('El archivo debe ser CSV o Excel.')
+        df.columns = [clave_columna(c) for c in df.columns]
+        df = df.astype(object).where(df.notna(), None)
+        return df.to_dict(orient='records')
+    if isinstance(datos_json, dict):
+        datos_json = datos_json.get('items')
+    if not isinstance(datos_json, list):
+        raise ValueError('Se espera una lista de items.')
+    return [{clave_columna(k): v for k, v in item.items()} for item in datos_json if isinstance(item, dict)]
+
+def calcular_lote(filas, proveedores_dict):
+    """Calcula el precio final de todas las filas en una pasada vectorizada.
+    Cada fila lleva `precio` (o `precio_base`), opcional `producto` y `observaciones`, y
+    `proveedor_id` o porcentajes manuales (COLUMNAS_LOTE_MANUAL). Devuelve (resultados, entradas_historial).
+    """
+    nan = float('nan')
+    validas = []   # (indice, fila, precio, proveedor_id)
+    resultados = [None] * len(filas)
+    for i, fila in enumerate(filas):
+        precio = parse_precio(fila.get('precio', fila.get('precio_base')))
+        prov_id = fila.get('proveedor_id')
+        prov_id = str(prov_id).strip() if prov_id not in (None, '') else None
+        if precio is None:
+            resultados[i] = {'fila': i + 1, 'error': 'precio inválido o vacío'}
+        elif prov_id and prov_id not in proveedores_dict:
+            resultados[i] = {'fila': i + 1, 'error': f"proveedor '{prov_id}' no existe"}
+        else:
+            validas.append((i, fila, precio, prov_id))
+
+    precios, ivas, descuentos, ganancias, porcentajes = [], [], [], [], []
+    for _, fila, precio, prov_id in validas:
+        precios.append(precio)
+        if prov_id:
+            datos_prov = proveedores_dict[prov_id]
+            desc, iva, ganc = datos_prov.get("descuento", 0), datos_prov.get("iva", 0), datos_prov.get("ganancia", 0)
+            descuentos.append([nan if desc is None else desc, nan, nan])
+            ivas.append(nan if iva is None else iva)
+            ganancias.append([nan if ganc is None else ganc, nan])
+            porcentajes.append({"descuento": desc, "iva": iva, "ganancia": ganc})
+        else:
+            pct = {col: parse_percentage(fila.get(col)) or 0.0 for col in COLUMNAS_LOTE_MANUAL}
+            descuentos.append([pct['descuento'], pct['descuento_extra_1'], pct['descuento_extra_2']])
+            ivas.append(pct['iva'])
+            ganancias.append([pct['ganancia'], pct['ganancia_extra']])
+            porcentajes.append(pct)
+    finales = core_math_vectorizado(precios, ivas, descuentos, ganancias) if validas else []
+
+    timestamp = now_local().strftime(TIMESTAMP_FORMATO)
+    entradas = []
+    for (i, fila, precio, prov_id), final, pct in zip(validas, finales, porcentajes):
+        producto = str(fila.get('producto') or '').strip() or "N/A"
+        if prov_id:
+            nombre_prov = generar_nombre_visible(proveedores_dict[prov_id])
+            tipo = "Automático"
+        else:
+            nombre_prov = str(fila.get('proveedor') or '').strip() or "N/A"
+            tipo = "Manual"
+            pct = {"descuento": pct['descuento'], "descuento_extra_1": pct['descuento_extra_1'],
+                   "descuento_extra_2": pct['descuento_extra_2'], "iva": pct['iva'],
+                   "ganancia": pct['ganancia'], "ganancia_extra": pct['ganancia_extra']}
+        resultados[i] = {'fila': i + 1, 'producto': producto, 'proveedor': nombre_prov,
+                         'precio_base': precio, 'precio_final': final, 'tipo_calculo': tipo}
+        entradas.append({
+            "id_historial": str(uuid.uuid4()), "timestamp": timestamp,
+            "tipo_calculo": tipo, "proveedor_nombre": nombre_prov,
+            "producto": producto, "precio_base": precio, "porcentajes": pct,
+            "precio_final": final, "observaciones": str(fila.get('observaciones') or '')
+        })
+    return resultados, entradas
+
+# --- LISTA DE PROVEEDOR CON PRECIOS ---
+def precios_numericos(serie):
+    """Columna de precios del Excel como float (NaN si no es un número). Acepta coma decimal."""
+    import pandas as pd
+    if pd.api.types.is_numeric_dtype(serie):
+        return serie.astype(float)
+    return pd.to_numeric(serie.astype(str).str.replace(',', '.', regex=False), errors='coerce')
+
+def columnas_precio_proveedor(df, precio_base, prov_data):
+    """Costo (con descuento), costo con IVA y precio de venta (core_math) de toda la columna."""
+    import numpy as np
+    desc = prov_data.get("descuento", 0) or 0.0
+    iva = prov_data.get("iva", 0) or 0.0
+    ganc = prov_data.get("ganancia", 0) or 0.0
+    base = precios_numericos(df[precio_base]).to_numpy()
+    n = len(base)
+    costo = np.round(base * (1 - desc), 4)
+    costo_iva = np.round(base * (1 - desc) * (1 + iva), 4)
+    venta = np.array(core_math_vectorizado(base, np.full(n, iva), np.full((n, 1), desc), np.full((n, 1), ganc)), dtype=float)
+    return costo, costo_iva, venta
+
+def generar_lista_con_precios(file_path, config, prov_data):
+    """XLSX (write-only) con todas las hojas de la lista y tres columnas extra por fila:
+    Costo, Costo c/IVA y Precio Venta calculados con los porcentajes del proveedor.
+    """
+    import math
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    hojas = cargar_hojas_lista(file_path, config['fila_encabezado'])
+    for sheet_name, df in hojas.items():
+        if df.empty:
+            continue
+        precio_base = next((alias for alias in config.get('precio_base') or config.get('precios_a_mostrar', []) if alias in df.columns), None)
+        if not precio_base:
+            continue
+        costo, costo_iva, venta = columnas_precio_proveedor(df, precio_base, prov_data)
+        ws = wb.create_sheet(str(sheet_name)[:31])
+        ws.append(df.attrs.get('columnas_originales', list(df.columns)) + ['Costo', 'Costo c/IVA', 'Precio Venta'])
+        for fila, extra in zip(df.itertuples(index=False, name=None), zip(costo.tolist(), costo_iva.tolist(), venta.tolist())):
+            ws.append([None if isinstance(v, float) and math.isnan(v) else v for v in fila + extra])
+    if not wb.worksheets:
+        wb.create_sheet('Lista')
+    yield from enviar_workbook_por_bloques(wb)
+
+# --- INGESTA DE LISTAS EN SEGUNDO PLANO ---
+# Subir una lista solo guarda el archivo en LISTAS_PATH/.entrantes y encola un trabajo.
+# Un pool acotado (INGESTA_WORKERS hilos) lo valida, lo lee a la caché, calcula las
+# diferencias contra la versión vigente y recién entonces rota la vigente a OLD y publica
+# el archivo: una lista mal armada ya no reemplaza a la buena. Con un solo worker hay como
+# mucho un read_excel compitiendo con las búsquedas, y la cola tiene tope (INGESTA_MAX_PENDIENTES).
+INGESTA_WORKERS = max(1, int(os.getenv('INGESTA_WORKERS', '1')))
+INGESTA_MAX_PENDIENTES = int(os.getenv('INGESTA_MAX_PENDIENTES', '20'))
+INGESTA_HISTORICO = 100  # trabajos que se conservan para consultar su estado
+INGESTA_DIR = os.path.join(LISTAS_PATH, '.entrantes')
+INGESTA_EJEMPLOS_DIFF = 10
+_ingesta_lock = threading.Lock()
+_ingesta_pool = None
+_ingestas = {}  # id -> trabajo (dict), en orden de creación
+_ingesta_locks_proveedor = {}  # proveedor normalizado -> Lock (dos subidas del mismo proveedor no se pisan)
+_diferencias_cache = {}  # (sha256 previa, sha256 nueva, header) -> resumen de diferencias
+
+def get_ingesta_pool():
+    global _ingesta_pool
+    with _ingesta_lock:
+        if _ingesta_pool is None:
+            from concurrent.futures import ThreadPoolExecutor
+            os.makedirs(INGESTA_DIR, exist_ok=True)
+            # Restos de un corte anterior: ningún trabajo los va a procesar
+            limite = time.time() - 86400
+            for fname in os.listdir(INGESTA_DIR):
+                ruta = os.path.join(INGESTA_DIR, fname)
+                try:
+                    if os.path.getmtime(ruta) < limite:
+                        os.remove(ruta)
+                except OSError:
+                    pass
+            _ingesta_pool = ThreadPoolExecutor(max_workers=INGESTA_WORKERS, thread_name_prefix='ingesta')
+        return _ingesta_pool
+
+def encolar_ingesta(archivo, nombre_final, nombre_base):
+    """Guarda el archivo subido en la carpeta de entrada y encola su procesamiento. Devuelve el id del trabajo."""
+    pool = get_ingesta_pool()
+    with _ingesta_lock:
+        pendientes = sum(1 for t in _ingestas.values() if t['estado'] in ('en_cola', 'procesando'))
+    if pendientes >= INGESTA_MAX_PENDIENTES:
+        raise RuntimeError(f"hay {pendientes} listas en proceso, reintentá en unos minutos")
+    trabajo_id = uuid.uuid4().hex[:12]
+    ruta_temporal = os.path.join(INGESTA_DIR, f"{trabajo_id}{os.path.splitext(nombre_final)[1]}")
+    digest = guardar_subida_con_hash(archivo, ruta_temporal)
+    trabajo = {
+        'id': trabajo_id,
+        'archivo': archivo.filename,
+        'nombre_final': nombre_final,
+        'nombre_base': nombre_base,
+        'ruta_temporal': ruta_temporal,
+        'sha256': digest,
+        'sin_cambios': False,
+        'estado': 'en_cola',  # en_cola | procesando | listo | error
+        'etapa': 'en cola',
+        'progreso': 0,
+        'mensaje': None,
+        'diferencias': None,
+        'avisos': [],
+        'creado': now_local().strftime(TIMESTAMP_FORMATO),
+        'terminado': None,
+    }
+    with _ingesta_lock:
+        _ingestas[trabajo_id] = trabajo
+        while len(_ingestas) > INGESTA_HISTORICO:
+            viejo = next((k for k, t in _ingestas.items() if t['estado'] in ('listo', 'error')), None)
+            if viejo is None:
+                break
+            del _ingestas[viejo]
+    pool.submit(procesar_ingesta, trabajo_id)
+    return trabajo_id
+
+def guardar_subida_con_hash(archivo, ruta, tamanio_bloque=1024 * 1024):
+    """Guarda el archivo subido calculando su SHA-256 en la misma pasada. Devuelve el hash."""
+    h = hashlib.sha256()
+    with open(ruta, 'wb') as destino:
+        for bloque in iter(lambda: archivo.stream.read(tamanio_bloque), b''):
+            h.update(bloque)
+            destino.write(bloque)
+    return h.hexdigest()
+
+def actualizar_ingesta(trabajo_id, **campos):
+    with _ingesta_lock:
+        _ingestas[trabajo_id].update(campos)
+
+def listar_ingestas():
+    """Copia de los trabajos, del más reciente al más viejo (sin rutas internas)."""
+    with _ingesta_lock:
+        trabajos = [dict(t) for t in _ingestas.values()]
+    for t in trabajos:
+        t.pop('ruta_temporal', None)
+    return trabajos[::-1]
+
+def ingesta_stats():
+    with _ingesta_lock:
+        estados = [t['estado'] for t in _ingestas.values()]
+    return {e: estados.count(e) for e in ('en_cola', 'procesando', 'listo', 'error')}
+
+def indice_precios_lista(hojas, config):
+    """Serie código -> precio base de todas las hojas (primera aparición de cada código)."""
+    import pandas as pd
+    partes = []
+    for df in hojas.values():
+        if df.empty:
+            continue
+        col_codigo = next((alias for alias in config['codigo'] if alias in df.columns), None)
+        col_precio = next((alias for alias in config.get('precio_base') or config.get('precios_a_mostrar', []) if alias in df.columns), None)
+        if not col_codigo:
+            continue
+        codigos = df[col_codigo].map(lambda x: str(x).split('.')[0].strip() if pd.notna(x) else '')
+        precios = precios_numericos(df[col_precio]) if col_precio else pd.Series(float('nan'), index=df.index)
+        partes.append(pd.Series(precios.to_numpy(), index=codigos.to_numpy()))
+    if not partes:
+        return pd.Series(dtype=float)
+    serie = pd.concat(partes)
+    serie = serie[serie.index != '']
+    return serie[~serie.index.duplicated(keep='first')]
+
+def diferencias_lista(hojas_previas, hojas_nuevas, config):
+    """Resumen de cambios entre dos versiones de la lista: códigos nuevos/eliminados y cambios de precio."""
+    import numpy as np
+    nueva = indice_precios_lista(hojas_nuevas, config)
+    if hojas_previas is None:
+        return {'primera_version': True, 'productos': int(len(nueva))}
+    previa = indice_precios_lista(hojas_previas, config)
+    comunes = nueva.index.intersection(previa.index)
+    antes = previa.loc[comunes].to_numpy(dtype=float)
+    despues = nueva.loc[comunes].to_numpy(dtype=float)
+    cambio = ~np.isclose(antes, despues, rtol=0, atol=1e-9, equal_nan=True)
+    ejemplos = [
+        {'codigo': str(codigo), 'antes': None if a != a else float(a), 'despues': None if d != d else float(d)}
+        for codigo, a, d in zip(comunes[cambio][:INGESTA_EJEMPLOS_DIFF], antes[cambio], despues[cambio])
+    ]
+    return {
+        'primera_version': False,
+        'productos': int(len(nueva)),
+        'nuevos': int(len(nueva.index.difference(previa.index))),
+        'eliminados': int(len(previa.index.difference(nueva.index))),
+        'con_cambio_de_precio': int(cambio.sum()),
+        'ejemplos': ejemplos,
+    }
+
+def rotar_y_publicar_lista(ruta_temporal, nombre_final, nombre_base, sha256=None):
+    """Política: solo 1 versión OLD por proveedor. Borra las OLD previas, renombra la vigente
+    a OLD y mueve el archivo nuevo a su nombre final (overwrite permitido). Devuelve avisos.
+    """
+    avisos = []
+    renombradas = []
+    borradas = []
+    try:
+        norm_prov_subida = normalize_text(nombre_base)
+        entradas = listas_manifiesto()
+        # 1) Borrar OLD previas del proveedor
+        for e in entradas:
+            if e['old'] and e['proveedor_norm'] == norm_prov_subida:
+                try:
+                    os.remove(os.path.join(LISTAS_PATH, e['filename']))
+                    borradas.append(e['filename'])
+                except Exception:
+                    pass
+        # 2) Renombrar la vigente (si existe) a OLD
+        for e in entradas:
+            if e['old']:
+                continue  # ya hemos limpiado las old
+            if e['proveedor_norm'] == norm_prov_subida:
+                existing = e['filename']
+                src_path = os.path.join(LISTAS_PATH, existing)
+                base_no_ext, ext_exist = os.path.splitext(existing)
+                dst_path = os.path.join(LISTAS_PATH, f"{base_no_ext}-OLD{ext_exist}")
+                # Si por alguna razón quedó un archivo destino, lo eliminamos para sobreescribir limpio
+                if os.path.exists(dst_path):
+                    try: os.remove(dst_path)
+                    except Exception: pass
+                try:
+                    os.rename(src_path, dst_path)
+                    renombradas.append((src_path, dst_path, e['sha256']))
+                except Exception as e_rn:
+                    avisos.append(f"No se pudo renombrar a OLD: {existing} -> {e_rn}")
+                break  # solo una vigente
+    except Exception as e_mark:
+        avisos.append(f"Aviso al gestionar versiones OLD: {e_mark}")
+    ruta_final = os.path.join(LISTAS_PATH, nombre_final)
+    os.replace(ruta_temporal, ruta_final)
+    with _catalogo_lock:
+        # Renombrar no cambia el contenido: el hash (y lo ya leído) sigue valiendo
+        for src_path, dst_path, _ in renombradas:
+            conocido = _rutas_catalogo.pop(src_path, None)
+            if conocido:
+                _rutas_catalogo[dst_path] = conocido
+        _rutas_catalogo.pop(ruta_final, None)
+    agregar = {os.path.basename(dst): digest for _, dst, digest in renombradas}
+    agregar[nombre_final] = sha256
+    actualizar_manifiesto(quitar=borradas + [os.path.basename(src) for src, _, _ in renombradas], agregar=agregar)
+    return avisos
+
+def diferencias_por_hash(hash_previo, hojas_previas, hash_nuevo, hojas_nuevas, config):
+    """diferencias_lista memorizada por el par de hashes (subir de nuevo el mismo par no recalcula)."""
+    clave = (hash_previo, hash_nuevo, config['fila_encabezado'])
+    with _ingesta_lock:
+        if clave in _diferencias_cache:
+            return _diferencias_cache[clave]
+    diferencias = diferencias_lista(hojas_previas, hojas_nuevas, config)
+    with _ingesta_lock:
+        _diferencias_cache[clave] = diferencias
+        while len(_diferencias_cache) > INGESTA_HISTORICO:
+            del _diferencias_cache[next(iter(_diferencias_cache))]
+    return diferencias
+
+# --- HISTORIAL DE PRECIOS POR VERSIÓN DE LISTA ---
+# Solo se conserva una versión OLD por proveedor, así que no se podía ver cómo se movió el precio
+# de un producto en las últimas subidas. Cada versión de lista que se publica agrega una fila por
+# código (proveedor, código, fecha de la versión, sha256, precio base) a `precios_historial`
+# (PostgreSQL) o, sin DATABASE_URL, a LISTAS_PATH/.precios_historial.sqlite3. La clave primaria
+# (proveedor, código, fecha) deja la evolución de un producto a una sola lectura por índice,
+# sin volver a abrir Excel viejos. PRECIOS_HISTORIAL=0 lo desactiva.
+PRECIOS_HISTORIAL = os.getenv('PRECIOS_HISTORIAL', '1') == '1'
+PRECIOS_HISTORIAL_FILE = os.path.join(LISTAS_PATH, '.precios_historial.sqlite3')
+PRECIOS_HISTORIAL_LIMITE = 6  # versiones que muestra la evolución por defecto
+
+def conexion_precios_sqlite():
+    import sqlite3
+    conn = sqlite3.connect(PRECIOS_HISTORIAL_FILE, timeout=30)
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS precios_versiones (
+            proveedor TEXT NOT NULL,
+            sha256 TEXT NOT NULL,
+            filename TEXT,
+            fecha TEXT NOT NULL,
+            productos INTEGER,
+            PRIMARY KEY (proveedor, sha256)
+        );
+        CREATE TABLE IF NOT EXISTS precios_historial (
+            proveedor TEXT NOT NULL,
+            codigo TEXT NOT NULL,
+            fecha TEXT NOT NULL,
+            sha256 TEXT NOT NULL,
+            precio REAL,
+            PRIMARY KEY (proveedor, codigo, fecha, sha256)
+        ) WITHOUT ROWID;
+    """)
+    return conn
+
+def version_precios_registrada(proveedor, sha256):
+    if DATABASE_URL:
+        with get_pg_conn() as conn, conn.cursor() as cur:
+            cur.execute("SELECT 1 FROM precios_versiones WHERE proveedor = %s AND sha256 = %s", (proveedor, sha256))
+            return cur.fetchone() is not None
+    conn = conexion_precios_sqlite()
+    try:
+        return conn.execute("SELECT 1 FROM precios_versiones WHERE proveedor = ? AND sha256 = ?",
+                            (proveedor, sha256)).fetchone() is not None
+    finally:
+        conn.close()
+
+def registrar_precios_version(proveedor, sha256, filename, hojas, config, fecha):
+    """Agrega los precios de la versión (si no estaba). `fecha` en TIMESTAMP_FORMATO, hora local.
+    Devuelve la cantidad de códigos guardados (0 si la versión ya estaba)."""
+    if not PRECIOS_HISTORIAL:
+        return 0
+    serie = indice_precios_lista(hojas, config)
+    filas = [(proveedor, codigo, fecha, sha256, None if precio != precio else float(precio))
+             for codigo, precio in zip(serie.index, serie.to_numpy(dtype=float))]
+    version = (proveedor, sha256, filename, fecha, len(filas))
+    if DATABASE_URL:
+        with get_pg_conn() as conn, conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO precios_versiones (proveedor, sha256, filename, fecha, productos)
+                VALUES (%s, %s, %s, %s, %s) ON CONFLICT DO NOTHING
+            """, version)
+            if cur.rowcount == 0:
+                return 0
+            with cur.copy("COPY precios_historial (proveedor, codigo, fecha, sha256, precio) FROM STDIN") as copy:
+                for fila in filas:
+                    copy.write_row(fila)
+            conn.commit()
+        return len(filas)
+    conn = conexion_precios_sqlite()
+    try:
+        with conn:
+            if conn.execute("INSERT OR IGNORE INTO precios_versiones VALUES (?, ?, ?, ?, ?)", version).rowcount == 0:
+                return 0
+            conn.executemany("INSERT OR IGNORE INTO precios_historial VALUES (?, ?, ?, ?, ?)", filas)
+    finally:
+        conn.close()
+    return len(filas)
+
+def registrar_precios_listas_existentes():
+    """Agrega al historial las listas (vigentes y OLD) que ya estaban antes de registrarlo,
+    con la fecha de modificación del archivo."""
+    if not PRECIOS_HISTORIAL:
+        return
+    for e in sorted(listas_manifiesto(), key=lambda e: e['mtime']):
+        config = PROVEEDOR_CONFIG.get(e['clave'])
+        if not config or config.get('fila_encabezado') is None:
+            continue
+        ruta = os.path.join(LISTAS_PATH, e['filename'])
+        try:
+            digest = e['sha256'] or hash_lista(ruta, (e['mtime'], e['size']))
+            if version_precios_registrada(e['clave'], digest):
+                continue
+            # Sin pasar por la caché: una OLD no se busca y no tiene por qué quedar en memoria
+            hojas = leer_snapshot((digest, config['fila_encabezado'])) or leer_hojas_excel(ruta, config['fila_encabezado'])
+            cantidad = registrar_precios_version(e['clave'], digest, e['filename'], hojas, config,
+                                                 ts_to_local(e['mtime']).strftime(TIMESTAMP_FORMATO))
+            log_debug('historial de precios: registrada', e['filename'], cantidad)
+        except Exception as ex:
+            log_debug('registrar_precios_listas_existentes: error', e['filename'], ex)
+
+def historial_precio(proveedor, codigo, limite=PRECIOS_HISTORIAL_LIMITE):
+    """Últimas `limite` versiones del precio del código, de la más nueva a la más vieja."""
+    if DATABASE_URL:
+        with get_pg_conn() as conn, conn.cursor() as cur:
+            cur.execute("""
+                SELECT h.fecha, h.precio, v.filename FROM precios_historial h
+                LEFT JOIN precios_versiones v ON v.proveedor = h.proveedor AND v.sha256 = h.sha256
+                WHERE h.proveedor = %s AND h.codigo = %s
+                ORDER BY h.fecha DESC LIMIT %s
+            """, (proveedor, codigo, limite))
+            filas = [(r['fecha'].astimezone(_APP_TZ).strftime(TIMESTAMP_FORMATO) if _APP_TZ else r['fecha'].strftime(TIMESTAMP_FORMATO),
+                      r['precio'], r['filename']) for r in cur.fetchall()]
+    else:
+        conn = conexion_precios_sqlite()
+        try:
+            filas = conn.execute("""
+                SELECT h.fecha, h.precio, v.filename FROM precios_historial h
+                LEFT JOIN precios_versiones v ON v.proveedor = h.proveedor AND v.sha256 = h.sha256
+                WHERE h.proveedor = ? AND h.codigo = ?
+                ORDER BY h.fecha DESC LIMIT ?
+            """, (proveedor, codigo, limite)).fetchall()
+        finally:
+            conn.close()
+    return [{'fecha': fecha, 'precio': precio, 'lista': filename} for fecha, precio, filename in filas]
+
+def procesar_ingesta(trabajo_id):
+    """Worker: validar -> leer -> comparar con la vigente -> publicar -> precalcular variantes."""
+    with _ingesta_lock:
+        trabajo = dict(_ingestas[trabajo_id])
+    ruta_temporal = trabajo['ruta_temporal']
+    nombre_final = trabajo['nombre_final']
+    digest = trabajo['sha256']
+    clave = clave_proveedor_archivo(nombre_final)
+    with _ingesta_lock:
+        lock_proveedor = _ingesta_locks_proveedor.setdefault(clave, threading.Lock())
+    inicio = time.perf_counter()
+    try:
+        with lock_proveedor:
+            actualizar_ingesta(trabajo_id, estado='procesando', etapa='validando', progreso=10)
+            vigente = buscar_lista_vigente(trabajo['nombre_base'])
+            ruta_vigente = os.path.join(LISTAS_PATH, vigente) if vigente else None
+            if ruta_vigente and hash_lista(ruta_vigente) == digest:
+                # Mismo contenido que la vigente: no se renombra nada a OLD ni se vuelve a leer
+                os.remove(ruta_temporal)
+                actualizar_ingesta(trabajo_id, estado='listo', etapa='sin cambios', progreso=100, sin_cambios=True,
+                                   mensaje=f"idéntica a la lista vigente ({vigente}), no se modificó nada",
+                                   terminado=now_local().strftime(TIMESTAMP_FORMATO))
+                return
+            config = PROVEEDOR_CONFIG.get(clave)
+            hojas = None
+            diferencias = None
+            if config and config.get('fila_encabezado') is not None:
+                clave_cache = (digest, config['fila_encabezado'])
+                with _catalogo_lock:
+                    entrada = _catalogo_cache.get(clave_cache)
+                if entrada:
+                    hojas = entrada['hojas']  # mismo contenido ya leído (p. ej. se vuelve a subir la versión OLD)
+                else:
+                    actualizar_ingesta(trabajo_id, etapa='leyendo hojas', progreso=20)
+                    hojas = leer_hojas_excel(ruta_temporal, config['fila_encabezado'])
+                hojas_validas = [
+                    nombre for nombre, df in hojas.items()
+                    if not df.empty and any(a in df.columns for a in config['codigo']) and any(a in df.columns for a in config['producto'])
+                ]
+                if not hojas_validas:
+                    raise ValueError(f"ninguna hoja tiene las columnas de código/producto esperadas "
+                                     f"(encabezado en la fila {config['fila_encabezado'] + 1})")
+                actualizar_ingesta(trabajo_id, etapa='comparando con la vigente', progreso=50)
+                if ruta_vigente:
+                    hojas_previas = cargar_hojas_lista(ruta_vigente, config['fila_encabezado'])
+                    diferencias = diferencias_por_hash(hash_lista(ruta_vigente), hojas_previas, digest, hojas, config)
+                else:
+                    diferencias = diferencias_lista(None, hojas, config)
+            else:
+                # Proveedor sin configuración de búsqueda: solo se verifica que el Excel abra
+                import pandas as pd
+                with pd.ExcelFile(ruta_temporal):
+                    pass
+            actualizar_ingesta(trabajo_id, etapa='publicando', progreso=75, diferencias=diferencias)
+            avisos = rotar_y_publicar_lista(ruta_temporal, nombre_final, trabajo['nombre_base'], digest)
+            ruta_final = os.path.join(LISTAS_PATH, nombre_final)
+            registrar_hash_lista(ruta_final, digest)
+            if hojas is not None and PRECIOS_HISTORIAL:
+                actualizar_ingesta(trabajo_id, etapa='historial de precios', progreso=80)
+                try:
+                    registrar_precios_version(clave, digest, nombre_final, hojas, config,
+                                              now_local().strftime(TIMESTAMP_FORMATO))
+                except Exception as e:
+                    # La lista ya está publicada: no se marca la subida como fallida
+                    log_debug('registrar_precios_version: error', nombre_final, e)
+                    avisos.append(f"No se pudo guardar el historial de precios: {e}")
+            if hojas is not None:
+                # Los procesos de búsqueda cargan la versión nueva desde acá, sin leer el Excel
+                actualizar_ingesta(trabajo_id, etapa='escribiendo snapshot', progreso=85)
+                escribir_snapshot(clave_cache, hojas)
+                if CATALOGO_SQLITE:
+                    actualizar_ingesta(trabajo_id, etapa='indexando', progreso=88)
+                    indexar_lista_sqlite(clave_cache, nombre_final, hojas, config)
+                    purgar_catalogo_sqlite()
+            if hojas is not None and not BUSQUEDA_PROCESOS:
+                # Se busca en este proceso: dejar la lista nueva lista para buscar
+                with _catalogo_lock:
+                    ya_en_cache = clave_cache in _catalogo_cache
+                if not ya_en_cache:
+                    guardar_hojas_en_cache(clave_cache, nombre_final, hojas)
+                actualizar_ingesta(trabajo_id, etapa='precalculando precios', progreso=90, avisos=avisos)
+                proveedores_dict = asegurar_proveedores()
+                for sheet_name, df in hojas.items():
+                    if not df.empty:
+                        precios_variantes(ruta_final, nombre_final, sheet_name, df, config, proveedores_dict)
+            elif hojas is not None:
+                # Se busca en otros procesos: que la lean ellos y no retenerla acá
+                purgar_catalogo({os.path.join(LISTAS_PATH, e['filename']) for e in listas_manifiesto() if not e['old']})
+                precalentar_busqueda(asegurar_proveedores())
+            if LISTAS_CSV_PRECONVERTIR:
+                actualizar_ingesta(trabajo_id, etapa='convirtiendo a CSV', progreso=95)
+                lista_csv_gz(ruta_final, digest)
+        actualizar_ingesta(trabajo_id, estado='listo', etapa='listo', progreso=100, avisos=avisos,
+                           terminado=now_local().strftime(TIMESTAMP_FORMATO))
+        log_debug(f'ingesta {trabajo_id}: {nombre_final} lista en {time.perf_counter() - inicio:.2f}s')
+    except Exception as e:
+        actualizar_ingesta(trabajo_id, estado='error', etapa='error', mensaje=str(e),
+                           terminado=now_local().strftime(TIMESTAMP_FORMATO))
+        log_debug(f'ingesta {trabajo_id}: error', e)
+        try:
+            os.remove(ruta_temporal)
+        except OSError:
+            pass
+
+# --- BÚSQUEDA DE PRODUCTOS ---
+def buscar_productos(termino_busqueda, proveedor_buscado, proveedores_dict, filtros=None, facetas=None, filtro_resultados=None):
+    """Busca por código (solo dígitos), por palabras o ambos (ver modos_de_busqueda) en las listas vigentes.
+    `filtro_resultados` (palabra clave) deja lo que la tiene en el nombre, el código o la marca.
+    `filtros` = {faceta: {etiquetas}} acota los resultados; si se pasa `facetas` (dict) se
+    completa con los conteos {faceta: {etiqueta: cantidad}} de lo que pasa el filtro y en
+    'total' la cantidad encontrada antes de acotar (filtro y facetas).
+    Devuelve (productos_encontrados, mensaje de error o None).
+    """
+    mensaje = None
+    import numpy as np
+    import pandas as pd
+    productos_encontrados = []
+    rutas_vigentes = set()
+    por_codigo, por_nombre = modos_de_busqueda(termino_busqueda)
+    patrones = patrones_nombre(termino_busqueda)
+    if filtro_resultados:
+        # El filtro se compara con el nombre como el término y con el código y la marca como texto
+        patrones_filtro = patrones_nombre(filtro_resultados)
+        filtro_norm = normalize_text(filtro_resultados).encode('utf-8')
+    for entrada_lista in sorted(listas_manifiesto(), key=lambda e: e['filename']):
+        if entrada_lista['old']:
+            # Saltar archivos marcados como antiguos
+            continue
+        filename = entrada_lista['filename']
+        rutas_vigentes.add(os.path.join(LISTAS_PATH, filename))
+        try:
+            nombre_proveedor_archivo = entrada_lista['clave']
+
+            # --- LÓGICA DE FILTRADO POR PROVEEDOR ---
+            # Si se seleccionó un proveedor y el nombre del archivo no coincide, saltar al siguiente.
+            if proveedor_buscado and normalize_text(proveedor_buscado) != nombre_proveedor_archivo:
+                continue
+            # --- FIN DE LA LÓGICA DE FILTRADO ---
+
+            config = PROVEEDOR_CONFIG.get(nombre_proveedor_archivo)
+            if not config: continue
+
+            proveedor_display_name = next((p.get("nombre_base") for p in proveedores_dict.values() if normalize_text(p.get("nombre_base","")) == nombre_proveedor_archivo), nombre_proveedor_archivo.title())
+            file_path = os.path.join(LISTAS_PATH, filename)
+
+            header_row_index = config.get('fila_encabezado')
+            if header_row_index is None: continue
+
+            firma = (entrada_lista['mtime'], entrada_lista['size'])
+            all_sheets = cargar_hojas_lista(file_path, header_row_index, firma=firma)
+            clave_lista = (hash_lista(file_path, firma), header_row_index)
+            try:
+                with etapa('indexar_sqlite'):
+                    en_sqlite = indexar_lista_sqlite(clave_lista, filename, all_sheets, config)
+            except Exception as e:
+                log_debug('indexar_lista_sqlite: error, se busca en memoria', filename, e)
+                en_sqlite = False
+
+            for sheet_name, df in all_sheets.items():
+                if df.empty: continue
+
+                actual_cols = {
+                    'codigo': next((alias for alias in config['codigo'] if alias in df.columns), None),
+                    'producto': next((alias for alias in config['producto'] if alias in df.columns), None),
+                    'iva': next((alias for alias in config.get('iva', []) if alias in df.columns), None),
+                    'precios_a_mostrar': [alias for alias in config.get('precios_a_mostrar', []) if alias in df.columns],
+                    'extra_datos': [alias for alias in config.get('extra_datos', []) if alias in df.columns]
+                }
+                if not all([actual_cols['codigo'], actual_cols['producto']]): continue
+
+                # El DataFrame viene de la caché: las columnas transformadas se calculan
+                # aparte y solo se copian a las filas encontradas.
+                if en_sqlite:
+                    with etapa('filtrar_sqlite'):
+                        filas, codigos, nombres = coincidencias_sqlite(clave_lista, sheet_name, termino_busqueda)
+                        producto_rows = df.iloc[filas].copy()
+                        if por_codigo:
+                            producto_rows[actual_cols['codigo']] = codigos
+                        if por_nombre:
+                            producto_rows[actual_cols['producto']] = nombres
+                else:
+                    condition = np.zeros(len(df), dtype=bool)
+                    if por_codigo:
+                        with etapa('normalizar'):
+                            codigos = columna_normalizada(file_path, header_row_index, sheet_name, df, actual_cols['codigo'], 'codigo')
+                        with etapa('filtrar'):
+                            condition |= (codigos == termino_busqueda.encode('utf-8'))
+                    if por_nombre:
+                        with etapa('normalizar'):
+                            nombres = columna_normalizada(file_path, header_row_index, sheet_name, df, actual_cols['producto'], 'nombre')
+                        # Coincidencia: todas las palabras deben estar presentes en el nombre del producto
+                        with etapa('filtrar'):
+                            condition |= coinciden_nombres(nombres, patrones)
+                    producto_rows = df[condition].copy()
+                    if por_codigo:
+                        producto_rows[actual_cols['codigo']] = [c.decode('utf-8') for c in codigos[condition]]
+                    if por_nombre:
+                        producto_rows[actual_cols['producto']] = [n.decode('utf-8').strip() for n in nombres[condition]]
+
+                posiciones = df.index.get_indexer(producto_rows.index)
+                if facetas is not None:
+                    facetas['total'] = facetas.get('total', 0) + len(producto_rows)
+                if filtro_resultados and len(posiciones):
+                    with etapa('filtro_resultados'):
+                        if en_sqlite:
+                            nombres_filas = codificar_columna_busqueda(nombres, 'nombre')
+                            codigos_filas = codificar_columna_busqueda(codigos, 'codigo')
+                        else:
+                            nombres_filas = columna_normalizada(file_path, header_row_index, sheet_name, df, actual_cols['producto'], 'nombre')[posiciones]
+                            codigos_filas = columna_normalizada(file_path, header_row_index, sheet_name, df, actual_cols['codigo'], 'codigo')[posiciones]
+                        elegidas = coinciden_nombres(nombres_filas, patrones_filtro)
+                        elegidas |= np.char.find(np.char.lower(codigos_filas), filtro_norm) >= 0
+                        marca = facetas_hoja(file_path, sheet_name, df, config).get('marca')
+                        if marca is not None:
+                            # Se compara con cada marca distinta de la hoja, no fila por fila
+                            etiquetas, codigos_marca = marca
+                            marcas = [i for i, etiqueta in enumerate(etiquetas) if filtro_norm.decode('utf-8') in normalize_text(etiqueta)]
+                            elegidas |= np.isin(codigos_marca[posiciones], marcas)
+                    producto_rows, posiciones = producto_rows[elegidas], posiciones[elegidas]
+                if filtros or facetas is not None:
+                    with etapa('facetas'):
+                        codigos_facetas = facetas_hoja(file_path, sheet_name, df, config)
+                        fijas = {'proveedor': proveedor_display_name, 'hoja': sheet_name}
+                        elegidas = filtrar_facetas(posiciones, codigos_facetas, fijas, filtros, facetas)
+                    producto_rows, posiciones = producto_rows[elegidas], posiciones[elegidas]
+
+                if not producto_rows.empty:
+                    with etapa('precios_variantes'):
+                        columnas_variantes = precios_variantes(file_path, filename, sheet_name, df, config, proveedores_dict)
+                    with etapa('armar_resultados'):
+                        for posicion, (i, fila) in zip(posiciones, producto_rows.iterrows()):
+
+                            # Crear diccionarios base
+                            precios = {col.replace("_", " ").title(): fila.get(col) for col in actual_cols['precios_a_mostrar']}
+                            extra_datos = {col.replace("_", " ").title(): fila.get(col) for col in actual_cols['extra_datos']}
+                            precios_calculados = {}
+
+                            # --- LÓGICA ESPECIAL PARA PROVEEDORES ---
+
+                            # Lógica para BremenTools
+                            if nombre_proveedor_archivo == 'brementools':
+                                precio_neto_col = next((alias for alias in ['precio neto unitario'] if alias in df.columns), None)
+                                if precio_neto_col and pd.notna(fila.get(precio_neto_col)):
+                                    try:
+                                        precio_neto = float(str(fila[precio_neto_col]).replace(",", "."))
+                                        precio_final_bremen = precio_neto * 1.21 * 1.60
+                                        precios["Precio Final Calculado"] = precio_final_bremen
+                                    except (ValueError, TypeError):
+                                        pass
+
+                            # Lógica para Chiesa
+                            if nombre_proveedor_archivo == 'chiesa':
+                                precio_base_col = next((alias for alias in ['pr unit', 'prunit'] if alias in df.columns), None)
+                                if precio_base_col and pd.notna(fila.get(precio_base_col)):
+                                    try:
+                                        precio_base = float(str(fila[precio_base_col]).replace(",", "."))
+                                        dcto_excel = parse_percentage(fila.get('dcto', 0)) or 0.0
+                                        oferta_excel = parse_percentage(fila.get('oferta', 0)) or 0.0
+
+                                        precio_con_4_extra = precio_base * (1 - dcto_excel) * (1 - oferta_excel) * (1 - 0.04)
+                                        precios_calculados["Costo (con 4% extra)"] = precio_con_4_extra
+
+                                        precio_sin_4_extra = precio_base * (1 - dcto_excel) * (1 - oferta_excel)
+                                        precios_calculados["Costo (sin 4% extra)"] = precio_sin_4_extra
+                                    except (ValueError, TypeError):
+                                        pass
+
+                            # --- FIN DE LÓGICA ESPECIAL ---
+
+                            # Precio de venta de cada variante del proveedor (precalculado)
+                            for pid, columna in columnas_variantes.items():
+                                valor = columna[posicion]
+                                if valor == valor:  # NaN = sin precio en la fila
+                                    precios_calculados[f"Venta {generar_nombre_visible(proveedores_dict[pid])}"] = valor
+
+                            producto_iva = "N/A"
+                            if actual_cols['iva'] and pd.notna(fila[actual_cols['iva']]):
+                                producto_iva = formatear_iva(fila[actual_cols['iva']])
+
+                            productos_encontrados.append({
+                                "codigo": fila[actual_cols['codigo']], "producto": fila[actual_cols['producto']],
+                                "proveedor": f"{proveedor_display_name} (Hoja: {sheet_name})", "iva": producto_iva,
+                                "clave_proveedor": nombre_proveedor_archivo,
+                                "precios": precios, 
+                                "extra_datos": extra_datos,
+                                "precios_calculados": precios_calculados
+                            })
+        except Exception as e:
+            mensaje = f"❌ ERROR PROCESANDO {filename}: {e}"
+    purgar_catalogo(rutas_vigentes)
+    return productos_encontrados, mensaje
+
+# --- EJECUCIÓN DE BÚSQUEDAS (procesos + control de admisión) ---
+# Cada búsqueda recorre las listas con pandas bajo el GIL: unas pocas en paralelo frenaban
+# el login y la calculadora. Las búsquedas corren en un pool de BUSQUEDA_PROCESOS procesos
+# (cada uno con su propia caché de listas) y, si ya hay BUSQUEDA_MAX_PENDIENTES en curso,
+# se responde 503 con Retry-After en lugar de encolar más trabajo.
+# BUSQUEDA_PROCESOS=0 busca en el hilo del request (por defecto en el ejecutable de escritorio).
+BUSQUEDA_PROCESOS = int(os.getenv('BUSQUEDA_PROCESOS', '0' if getattr(sys, 'frozen', False) else '1'))
+BUSQUEDA_MAX_PENDIENTES = int(os.getenv('BUSQUEDA_MAX_PENDIENTES', '8'))
+BUSQUEDA_TIMEOUT = float(os.getenv('BUSQUEDA_TIMEOUT', '60'))
+BUSQUEDA_RETRY_AFTER = 5  # segundos sugeridos al cliente cuando se rechaza por saturación
+_busqueda_lock = threading.Lock()
+_busqueda_pool = None
+_busquedas = {'en_curso': 0, 'rechazadas': 0}
+_catalogo_stats_workers = {}  # pid -> catalogo_stats() informado por cada proceso de búsqueda
+_proveedores_vistos = {}  # en el proceso de búsqueda: prov_id -> datos con que se calcularon sus variantes
+
+class BusquedaSaturada(Exception):
+    """Hay demasiadas búsquedas en curso (responder 503)."""
+
+def get_busqueda_pool():
+    global _busqueda_pool
+    with _busqueda_lock:
+        if _busqueda_pool is None and BUSQUEDA_PROCESOS > 0:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            # spawn: los procesos no heredan hilos ni locks tomados de waitress/psycopg
+            _busqueda_pool = ProcessPoolExecutor(max_workers=BUSQUEDA_PROCESOS, mp_context=multiprocessing.get_context('spawn'))
+        return _busqueda_pool
+
+def reiniciar_pool_busqueda():
+    global _busqueda_pool
+    with _busqueda_lock:
+        pool, _busqueda_pool = _busqueda_pool, None
+        _catalogo_stats_workers.clear()
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def sincronizar_variantes(proveedores_dict):
+    """En el proceso de búsqueda: descarta las columnas precalculadas de los proveedores que cambiaron."""
+    for pid in set(_proveedores_vistos) | set(proveedores_dict):
+        if _proveedores_vistos.get(pid) != proveedores_dict.get(pid):
+            descartar_variante(pid)
+    _proveedores_vistos.clear()
+    _proveedores_vistos.update({pid: dict(datos) for pid, datos in proveedores_dict.items()})
+
+def buscar_en_proceso(termino_busqueda, proveedor_buscado, proveedores_dict, ruta_perfil=None, filtros=None, con_facetas=False,
+                      filtro_resultados=None):
+    """Punto de entrada en el proceso de búsqueda. Con `ruta_perfil` la búsqueda corre bajo
+    cProfile y el perfil se escribe ahí (el request que espera lo suma al suyo)."""
+    sincronizar_variantes(proveedores_dict)
+    # Las etapas medidas acá viajan con el resultado y se suman al request que espera
+    token = _tiempos_actuales.set({} if TIEMPOS_ETAPAS else None)
+    perfil = None
+    if ruta_perfil:
+        import cProfile
+        perfil = cProfile.Profile()
+        perfil.enable()
+    try:
+        facetas = {} if con_facetas else None
+        productos, mensaje = buscar_productos(termino_busqueda, proveedor_buscado, proveedores_dict, filtros, facetas,
+                                              filtro_resultados)
+        tiempos = _tiempos_actuales.get()
+    finally:
+        _tiempos_actuales.reset(token)
+        if perfil is not None:
+            perfil.disable()
+            os.makedirs(os.path.dirname(ruta_perfil), exist_ok=True)
+            perfil.dump_stats(ruta_perfil)
+    return productos, mensaje, os.getpid(), catalogo_stats(), tiempos, facetas
+
+def precargar_catalogo(proveedores_dict, consultas=()):
+    """Lee a la caché las listas vigentes configuradas y sus precios por variante, y corre las
+    `consultas` [(termino, proveedor)] para dejar calculadas las columnas que usan."""
+    sincronizar_variantes(proveedores_dict)
+    rutas_vigentes = set()
+    for e in listas_manifiesto():
+        config = PROVEEDOR_CONFIG.get(e['clave'])
+        if e['old'] or not config:
+            continue
+        ruta = os.path.join(LISTAS_PATH, e['filename'])
+        rutas_vigentes.add(ruta)
+        try:
+            hojas = cargar_hojas_lista(ruta, config['fila_encabezado'], firma=(e['mtime'], e['size']))
+            for sheet_name, df in hojas.items():
+                if not df.empty:
+                    precios_variantes(ruta, e['filename'], sheet_name, df, config, proveedores_dict)
+                    facetas_hoja(ruta, sheet_name, df, config)
+        except Exception as ex:
+            log_debug('precargar_catalogo: error', e['filename'], ex)
+    purgar_catalogo(rutas_vigentes)
+    for termino, proveedor in consultas:
+        try:
+            buscar_productos(termino, proveedor or '', proveedores_dict)
+        except Exception as ex:
+            log_debug('precargar_catalogo: error en consulta', termino, ex)
+    return os.getpid(), catalogo_stats()
+
+def registrar_stats_worker(futuro):
+    try:
+        pid, stats = futuro.result()
+    except Exception as e:
+        log_debug('precarga de búsqueda: error', e)
+        return
+    with _busqueda_lock:
+        _catalogo_stats_workers[pid] = stats
+
+def precalentar_busqueda(proveedores_dict, consultas=()):
+    """Precarga el catálogo donde se va a buscar (los procesos del pool, o este proceso) sin bloquear."""
+    pool = get_busqueda_pool()
+    if pool is None:
+        threading.Thread(target=precargar_catalogo, args=(dict(proveedores_dict), list(consultas)), name='precarga_catalogo', daemon=True).start()
+        return
+    # Una tarea por proceso; el pool las reparte entre los procesos libres (sin garantía de una por proceso)
+    for _ in range(BUSQUEDA_PROCESOS):
+        pool.submit(precargar_catalogo, dict(proveedores_dict), list(consultas)).add_done_callback(registrar_stats_worker)
+
+def liberar_lugar_busqueda(_futuro=None):
+    with _busqueda_lock:
+        _busquedas['en_curso'] -= 1
+
+def ejecutar_busqueda(termino_busqueda, proveedor_buscado, proveedores_dict, filtros=None, facetas=None, filtro_resultados=None):
+    """buscar_productos con control de admisión; en el pool de procesos si está habilitado.
+    Una búsqueda enviada al pool ocupa su lugar hasta que el proceso la termina, aunque el
+    request deje de esperarla por BUSQUEDA_TIMEOUT: así BUSQUEDA_MAX_PENDIENTES acota el
+    trabajo real y no solo los requests en espera."""
+    from concurrent.futures import TimeoutError as FuturoTimeout
+    from concurrent.futures.process import BrokenProcessPool
+    with _busqueda_lock:
+        if _busquedas['en_curso'] >= BUSQUEDA_MAX_PENDIENTES:
+            _busquedas['rechazadas'] += 1
+            raise BusquedaSaturada()
+        _busquedas['en_curso'] += 1
+    liberar = True  # False mientras el lugar lo libera el callback del futuro
+    try:
+        pool = get_busqueda_pool()
+        if pool is None:
+            return buscar_productos(termino_busqueda, proveedor_buscado, proveedores_dict, filtros, facetas, filtro_resultados)
+        try:
+            perfil_base = _perfil_actual.get()
+            ruta_perfil = perfil_base + '.busqueda.prof' if perfil_base else None
+            futuro = pool.submit(buscar_en_proceso, termino_busqueda, proveedor_buscado, dict(proveedores_dict), ruta_perfil,
+                                 filtros, facetas is not None, filtro_resultados)
+            liberar = False
+            futuro.add_done_callback(liberar_lugar_busqueda)
+            productos, mensaje, pid, stats, tiempos, conteos = futuro.result(timeout=BUSQUEDA_TIMEOUT)
+        except FuturoTimeout:
+            # Si todavía espera en la cola del pool se descarta; si ya corre, sigue ocupando su lugar
+            futuro.cancel()
+            return [], f"⌛ LA BÚSQUEDA TARDÓ MÁS DE {BUSQUEDA_TIMEOUT:.0f}s. INTENTÁ CON UN TÉRMINO MÁS ESPECÍFICO."
+        except BrokenProcessPool as e:
+            # Un proceso murió (p. ej. sin memoria): se recrea el pool y esta búsqueda se hace acá
+            log_debug('ejecutar_busqueda: pool roto, se reinicia', e)
+            reiniciar_pool_busqueda()
+            if not liberar:
+                # El callback ya liberó el lugar del futuro fallido: se vuelve a tomar para la búsqueda local
+                with _busqueda_lock:
+                    _busquedas['en_curso'] += 1
+                liberar = True
+            return buscar_productos(termino_busqueda, proveedor_buscado, proveedores_dict, filtros, facetas, filtro_resultados)
+        with _busqueda_lock:
+            _catalogo_stats_workers[pid] = stats
+        sumar_tiempos(tiempos)
+        if facetas is not None:
+            facetas.update(conteos)
+        return productos, mensaje
+    finally:
+        if liberar:
+            liberar_lugar_busqueda()
+
+# --- REGISTRO DE BÚSQUEDAS ---
+# Cada búsqueda deja término normalizado, proveedor, cantidad de resultados y duración en la tabla
+# `busquedas` (o en busquedas.jsonl sin DB). Se escribe en lotes desde un hilo aparte para no demorar
+# la respuesta, y se acota a BUSQUEDAS_LOG_MAX registros (en el archivo, rotando a .1).
+# Al arrancar se corren las BUSQUEDAS_PRECALENTAR consultas más frecuentes de los últimos
+# BUSQUEDAS_PRECALENTAR_DIAS días para llegar con la caché caliente.
+BUSQUEDAS_LOG = os.getenv('BUSQUEDAS_LOG', '1') == '1'
+BUSQUEDAS_LOG_FILE = os.path.join(base_path, "busquedas.jsonl")
+BUSQUEDAS_LOG_MAX = int(os.getenv('BUSQUEDAS_LOG_MAX', '50000'))
+BUSQUEDAS_PRECALENTAR = int(os.getenv('BUSQUEDAS_PRECALENTAR', '20'))
+BUSQUEDAS_PRECALENTAR_DIAS = int(os.getenv('BUSQUEDAS_PRECALENTAR_DIAS', '14'))
+_busquedas_cola = queue.Queue(maxsize=10000)
+_busquedas_escritor = None
+_busquedas_escritor_lock = threading.Lock()
+_busquedas_log_lineas = None  # líneas del archivo actual (se cuentan en la primera escritura)
+
+def termino_para_registro(termino):
+    """El término como lo compara la búsqueda (los códigos quedan tal cual)."""
+    termino = termino.strip()
+    return termino if termino.isdigit() else normalizar_medidas(termino, consulta=True)
+
+def registrar_busqueda(termino, proveedor, resultados, duracion):
+    """Encola la búsqueda para el registro; si la cola está llena se descarta."""
+    global _busquedas_escritor
+    if not BUSQUEDAS_LOG:
+        return
+    registro = {
+        'timestamp': now_local().strftime(TIMESTAMP_FORMATO),
+        'termino': termino_para_registro(termino),
+        'proveedor': normalize_text(proveedor) if proveedor else None,
+        'resultados': resultados,
+        'duracion_ms': round(duracion * 1000, 1),
+    }
+    try:
+        _busquedas_cola.put_nowait(registro)
+    except queue.Full:
+        return
+    if _busquedas_escritor is None:
+        with _busquedas_escritor_lock:
+            if _busquedas_escritor is None:
+                _busquedas_escritor = threading.Thread(target=escribir_busquedas, name='registro_busquedas', daemon=True)
+                _busquedas_escritor.start()
+
+def escribir_busquedas():
+    while True:
+        lote = [_busquedas_cola.get()]
+        time.sleep(1)  # juntar las que lleguen mientras tanto
+        while len(lote) < 500:
+            try:
+                lote.append(_busquedas_cola.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            guardar_busquedas(lote)
+        except Exception as e:
+            log_debug('escribir_busquedas: error', e)
+
+def guardar_busquedas(lote):
+    global _busquedas_log_lineas
+    if DATABASE_URL:
+        try:
+            with get_pg_conn() as conn, conn.cursor() as cur:
+                cur.executemany("""
+                    INSERT INTO busquedas (timestamp, termino, proveedor, resultados, duracion_ms)
+                    VALUES (%(timestamp)s, %(termino)s, %(proveedor)s, %(resultados)s, %(duracion_ms)s)
+                """, lote)
+                cur.execute("DELETE FROM busquedas WHERE id <= (SELECT max(id) FROM busquedas) - %s", (BUSQUEDAS_LOG_MAX,))
+                conn.commit()
+                return
+        except Exception as e:
+            log_debug('guardar_busquedas: fallo PG', e)
+            print(f"[WARN] guardar_busquedas PG fallo: {e}. Se usa JSON.")
+    if _busquedas_log_lineas is None:
+        try:
+            with open(BUSQUEDAS_LOG_FILE, 'rb') as f:
+                _busquedas_log_lineas = sum(1 for _ in f)
+        except OSError:
+            _busquedas_log_lineas = 0
+    if _busquedas_log_lineas + len(lote) > BUSQUEDAS_LOG_MAX // 2:
+        # Dos archivos de hasta la mitad cada uno: el actual y el anterior (.1)
+        try:
+            os.replace(BUSQUEDAS_LOG_FILE, BUSQUEDAS_LOG_FILE + '.1')
+        except OSError:
+            pass
+        _busquedas_log_lineas = 0
+    with open(BUSQUEDAS_LOG_FILE, 'a', encoding='utf-8') as f:
+        for registro in lote:
+            f.write(json.dumps(registro, ensure_ascii=False) + '\n')
+    _busquedas_log_lineas += len(lote)
+
+def leer_busquedas_registradas(desde):
+    """Registros del archivo (anterior y actual) con timestamp >= desde (texto TIMESTAMP_FORMATO)."""
+    for ruta in (BUSQUEDAS_LOG_FILE + '.1', BUSQUEDAS_LOG_FILE):
+        try:
+            with open(ruta, 'r', encoding='utf-8') as f:
+                for linea in f:
+                    try:
+                        registro = json.loads(linea)
+                    except ValueError:
+                        continue
+                    if registro.get('timestamp', '') >= desde:
+                        yield registro
+        except OSError:
+            continue
+
+def resumen_busquedas(dias, limite):
+    """Consultas más frecuentes de los últimos `dias` días con resultados y duración promedio."""
+    from datetime import timedelta
+    desde = (now_local() - timedelta(days=dias)).strftime(TIMESTAMP_FORMATO)
+    if DATABASE_URL:
+        try:
+            with get_pg_conn() as conn, conn.cursor() as cur:
+                cur.execute("""
+                    SELECT termino, proveedor, count(*) AS veces, avg(resultados) AS resultados_prom,
+                           avg(duracion_ms) AS duracion_ms_prom
+                    FROM busquedas WHERE timestamp >= %s
+                    GROUP BY termino, proveedor ORDER BY veces DESC, termino LIMIT %s
+                """, (desde, limite))
+                return [{**r, 'resultados_prom': round(float(r['resultados_prom'] or 0), 1),
+                         'duracion_ms_prom': round(float(r['duracion_ms_prom'] or 0), 1)} for r in cur.fetchall()]
+        except Exception as e:
+            log_debug('resumen_busquedas: fallo PG', e)
+    grupos = {}
+    for registro in leer_busquedas_registradas(desde):
+        g = grupos.setdefault((registro['termino'], registro.get('proveedor')), [0, 0, 0.0])
+        g[0] += 1
+        g[1] += registro.get('resultados') or 0
+        g[2] += registro.get('duracion_ms') or 0.0
+    ordenados = sorted(grupos.items(), key=lambda kv: (-kv[1][0], kv[0][0]))[:limite]
+    return [{'termino': t, 'proveedor': p, 'veces': n, 'resultados_prom': round(r / n, 1),
+             'duracion_ms_prom': round(d / n, 1)} for (t, p), (n, r, d) in ordenados]
+
+def busquedas_frecuentes(n, dias=None):
+    """[(termino, proveedor)] de las `n` consultas más repetidas (para precalentar)."""
+    if not BUSQUEDAS_LOG or n <= 0:
+        return []
+    try:
+        return [(r['termino'], r['proveedor']) for r in resumen_busquedas(dias or BUSQUEDAS_PRECALENTAR_DIAS, n)]
+    except Exception as e:
+        log_debug('busquedas_frecuentes: error', e)
+        return []
+
+def busqueda_stats():
+    with _busqueda_lock:
+        return {'procesos': BUSQUEDA_PROCESOS, **_busquedas}
+
+def catalogo_stats_total():
+    """catalogo_stats() de este proceso más lo último informado por cada proceso de búsqueda."""
+    total = catalogo_stats()
+    with _busqueda_lock:
+        workers = list(_catalogo_stats_workers.values())
+    for stats in workers:
+        for clave in total:
+            total[clave] += stats.get(clave, [] if isinstance(total[clave], list) else 0)
+    return total
+
+# --- RUTA PRINCIPAL ---
+@app.route("/", methods=["GET", "POST"])
+@login_required
+def index():
+    asegurar_proveedores()
+    mensaje = None
+    resultado_auto = None
+    resultado_manual = None
+    productos_encontrados = None
+    proveedor_id_seleccionado = None
+    datos_seleccionados = {}
+    active_tab = "busqueda" 
+    proveedor_buscado = ""
+    filtro_resultados = ""
+    facetas_busqueda = []
+    busqueda_registrada = ""
+    # --- MODIFICACIÓN ---
+    datos_calculo_auto = {}
+    datos_calculo_manual = {}
+    busqueda_saturada = False
 
     if request.method == "POST":
         formulario = request.form.get("formulario")
@@ -614,145 +3184,34 @@ def index():
             termino_busqueda = request.form.get("termino_busqueda", "").strip()
             proveedor_buscado = request.form.get("proveedor_busqueda", "") # Capturar proveedor
             filtro_resultados = request.form.get("filtro_resultados", "").strip() # <-- AÑADIR ESTA LÍNEA
+            filtros_facetas = {f: set(request.form.getlist(f"faceta_{f}")) for f in FACETAS}
+            filtros_facetas = {f: elegidas for f, elegidas in filtros_facetas.items() if elegidas}
 
             if not termino_busqueda:
                 mensaje = "⚠️ POR FAVOR, INGRESA UN CÓDIGO O NOMBRE."
             else:
-                productos_encontrados = []
-                PROVEEDOR_CONFIG = {
-                    'brementools': {'fila_encabezado': 5, 'codigo': ['codigo'], 'producto': ['producto'], 'precios_a_mostrar': ['precio', 'precio de venta', 'precio de lista', 'precio neto unitario'], 'iva': ['iva'], 'extra_datos': ['unidades x caja']},
-                    #'bremenbuloneria': {'fila_encabezado': 5, 'codigo': ['codigo'], 'producto': ['producto'], 'precios_a_mostrar': ['precio neto unitario'], 'iva': ['iva'], 'extra_datos': ['rosca', 'terminacion', 'unidades por caja']},
-                    'crossmaster': {'fila_encabezado': 11, 'codigo': ['codigo'], 'producto': ['descripcion'], 'precios_a_mostrar': ['precio lista'], 'iva': ['iva'], 'extra_datos': []},
-                    'berger': {'fila_encabezado': 0, 'codigo': ['cod'], 'producto': ['detalle'], 'precios_a_mostrar': ['pventa'], 'iva': ['iva'], 'extra_datos': ['marca']},
-                    'chiesa': {'fila_encabezado': 1, 'codigo': ['codigo'], 'producto': ['descripcion'], 'precios_a_mostrar': ['pr unit', 'prunit'], 'iva': ['iva'], 'extra_datos': ['dcto', 'oferta']},
-                    'cachan': {'fila_encabezado': 0, 'codigo': ['codigo'], 'producto': ['nombre'], 'precios_a_mostrar': ['precio'], 'iva': [], 'extra_datos': ['marca']}
-                }
+                try:
+                    inicio_busqueda = time.perf_counter()
+                    conteos_facetas = {}
+                    with etapa('busqueda'):
+                        productos_encontrados, mensaje = ejecutar_busqueda(termino_busqueda, proveedor_buscado, proveedores,
+                                                                           filtros_facetas, conteos_facetas, filtro_resultados)
+                    facetas_busqueda = facetas_para_mostrar(conteos_facetas, filtros_facetas)
+                    # Se registra la búsqueda con lo encontrado antes de acotar; volver a enviarla
+                    # desde los resultados (facetas, filtro) acota la misma búsqueda y no se registra otra vez.
+                    busqueda_registrada = f"{termino_para_registro(termino_busqueda)}|{normalize_text(proveedor_buscado)}"
+                    if request.form.get("busqueda_registrada") != busqueda_registrada:
+                        registrar_busqueda(termino_busqueda, proveedor_buscado, conteos_facetas.get('total', len(productos_encontrados)),
+                                           time.perf_counter() - inicio_busqueda)
+                except BusquedaSaturada:
+                    busqueda_saturada = True
+                    productos_encontrados = []
+                    mensaje = "⏳ HAY MUCHAS BÚSQUEDAS EN CURSO. REINTENTÁ EN UNOS SEGUNDOS."
 
-                for filename in os.listdir(LISTAS_PATH):
-                    if not filename.endswith(('.xlsx', '.xls')): continue
-                    if 'old' in filename.lower():
-                        # Saltar archivos marcados como antiguos
-                        continue
-                    try:
-                        nombre_proveedor_archivo = normalize_text(''.join(filter(str.isalpha, os.path.splitext(filename)[0])))
-                        
-                        # --- LÓGICA DE FILTRADO POR PROVEEDOR ---
-                        # Si se seleccionó un proveedor y el nombre del archivo no coincide, saltar al siguiente.
-                        if proveedor_buscado and normalize_text(proveedor_buscado) != nombre_proveedor_archivo:
-                            continue
-                        # --- FIN DE LA LÓGICA DE FILTRADO ---
-
-                        config = PROVEEDOR_CONFIG.get(nombre_proveedor_archivo)
-                        if not config: continue
-
-                        proveedor_display_name = next((p.get("nombre_base") for p in proveedores.values() if normalize_text(p.get("nombre_base","")) == nombre_proveedor_archivo), nombre_proveedor_archivo.title())
-                        file_path = os.path.join(LISTAS_PATH, filename)
-                        
-                        header_row_index = config.get('fila_encabezado')
-                        if header_row_index is None: continue
-
-                        all_sheets = pd.read_excel(file_path, sheet_name=None, header=header_row_index)
-
-                        for sheet_name, df in all_sheets.items():
-                            if df.empty: continue
-                            
-                            df.columns = [normalize_text(c) for c in df.columns]
-
-                            actual_cols = {
-                                'codigo': next((alias for alias in config['codigo'] if alias in df.columns), None),
-                                'producto': next((alias for alias in config['producto'] if alias in df.columns), None),
-                                'iva': next((alias for alias in config.get('iva', []) if alias in df.columns), None),
-                                'precios_a_mostrar': [alias for alias in config.get('precios_a_mostrar', []) if alias in df.columns],
-                                'extra_datos': [alias for alias in config.get('extra_datos', []) if alias in df.columns]
-                            }
-                            if not all([actual_cols['codigo'], actual_cols['producto']]): continue
-                            
-                            if termino_busqueda.isdigit() and len(termino_busqueda) > 2:
-                                df[actual_cols['codigo']] = df[actual_cols['codigo']].apply(lambda x: str(x).split('.')[0] if pd.notna(x) else '')
-                                condition = (df[actual_cols['codigo']] == termino_busqueda)
-                            else:
-                                # Normalizar y convertir el término de búsqueda a formato de pulgadas
-                                termino_norm = normalize_text(formatear_pulgadas(termino_busqueda))
-                                palabras = termino_norm.split()
-                                df[actual_cols['producto']] = df[actual_cols['producto']].apply(lambda x: normalize_text(formatear_pulgadas(x)))
-                                # Coincidencia: todas las palabras deben estar presentes en el nombre del producto
-                                condition = df[actual_cols['producto']].apply(lambda nombre: all(palabra in nombre for palabra in palabras))
-                            producto_rows = df[condition]
-
-                            if not producto_rows.empty:
-                                for i, fila in producto_rows.iterrows():
-                                    
-                                    # Crear diccionarios base
-                                    precios = {col.replace("_", " ").title(): fila.get(col) for col in actual_cols['precios_a_mostrar']}
-                                    extra_datos = {col.replace("_", " ").title(): fila.get(col) for col in actual_cols['extra_datos']}
-                                    precios_calculados = {}
-
-                                    # --- LÓGICA ESPECIAL PARA PROVEEDORES ---
-
-                                    # Lógica para BremenTools
-                                    if nombre_proveedor_archivo == 'brementools':
-                                        precio_neto_col = next((alias for alias in ['precio neto unitario'] if alias in df.columns), None)
-                                        if precio_neto_col and pd.notna(fila.get(precio_neto_col)):
-                                            try:
-                                                precio_neto = float(str(fila[precio_neto_col]).replace(",", "."))
-                                                precio_final_bremen = precio_neto * 1.21 * 1.60
-                                                precios["Precio Final Calculado"] = precio_final_bremen
-                                            except (ValueError, TypeError):
-                                                pass
-
-                                    # Lógica para Chiesa
-                                    if nombre_proveedor_archivo == 'chiesa':
-                                        precio_base_col = next((alias for alias in ['pr unit', 'prunit'] if alias in df.columns), None)
-                                        if precio_base_col and pd.notna(fila.get(precio_base_col)):
-                                            try:
-                                                precio_base = float(str(fila[precio_base_col]).replace(",", "."))
-                                                dcto_excel = parse_percentage(fila.get('dcto', 0)) or 0.0
-                                                oferta_excel = parse_percentage(fila.get('oferta', 0)) or 0.0
-                                                
-                                                precio_con_4_extra = precio_base * (1 - dcto_excel) * (1 - oferta_excel) * (1 - 0.04)
-                                                precios_calculados["Costo (con 4% extra)"] = precio_con_4_extra
-
-                                                precio_sin_4_extra = precio_base * (1 - dcto_excel) * (1 - oferta_excel)
-                                                precios_calculados["Costo (sin 4% extra)"] = precio_sin_4_extra
-                                            except (ValueError, TypeError):
-                                                pass
-                                    
-                                    # --- FIN DE LÓGICA ESPECIAL ---
-
-                                    producto_iva = "N/A"
-                                    if actual_cols['iva'] and pd.notna(fila[actual_cols['iva']]):
-                                        try:
-                                            iva_val_str = str(fila[actual_cols['iva']]).replace('%','').replace(',','.')
-                                            iva_float = float(iva_val_str)
-                                            if iva_float < 1.0 and iva_float != 0: iva_float *= 100
-                                            producto_iva = f"{iva_float:.1f}%".replace(".0%", "%")
-                                        except: producto_iva = str(fila[actual_cols['iva']])
-                                    
-                                    productos_encontrados.append({
-                                        "codigo": fila[actual_cols['codigo']], "producto": formatear_pulgadas(fila[actual_cols['producto']]),
-                                        "proveedor": f"{proveedor_display_name} (Hoja: {sheet_name})", "iva": producto_iva, 
-                                        "precios": precios, 
-                                        "extra_datos": extra_datos,
-                                        "precios_calculados": precios_calculados
-                                    })
-                    except Exception as e:
-                        mensaje = f"❌ ERROR PROCESANDO {filename}: {e}"
-                
-                # --- NUEVO BLOQUE PARA FILTRAR RESULTADOS ---
-                if filtro_resultados and productos_encontrados:
-                    productos_filtrados = []
-                    filtro_norm = normalize_text(filtro_resultados)
-                    for producto in productos_encontrados:
-                        # Busca el filtro en el nombre, código o marca del producto
-                        texto_busqueda = f"{producto['producto']} {producto['codigo']} {producto.get('extra_datos', {}).get('Marca', '')}"
-                        if filtro_norm in normalize_text(texto_busqueda):
-                            productos_filtrados.append(producto)
-                    
-                    mensaje = f"✅ SE ENCONTRARON {len(productos_filtrados)} COINCIDENCIA(S) AL FILTRAR POR '{filtro_resultados}'."
-                    productos_encontrados = productos_filtrados
-                # --- FIN DEL BLOQUE DE FILTRADO ---
 
-                if not productos_encontrados and not mensaje:
+                if filtro_resultados and not productos_encontrados and not mensaje:
+                    mensaje = f"✅ SE ENCONTRARON 0 COINCIDENCIA(S) AL FILTRAR POR '{filtro_resultados}'."
+                elif not productos_encontrados and not mensaje:
                     mensaje = f"ℹ️ NO SE ENCONTRARON RESULTADOS PARA '{termino_busqueda}'."
                 elif productos_encontrados:
                     mensaje = f"✅ SE ENCONTRARON {len(productos_encontrados)} COINCIDENCIA(S)."
@@ -842,6 +3301,7 @@ def index():
                 proveedores[proveedor_id_seleccionado] = target_data
                 try:
                     save_proveedores(proveedores)
+                    invalidar_variante(proveedor_id_seleccionado)
                     mensaje = "✅ CAMBIOS GUARDADOS."
                 except Exception as e:
                     mensaje = f"❌ ERROR GUARDANDO DATOS.JSON: {e}"
@@ -853,7 +3313,8 @@ def index():
             if not nombre_base:
                 mensaje = "⚠️ ERROR: EL NOMBRE BASE NO PUEDE ESTAR VACÍO."
             else:
-                proveedores[str(uuid.uuid4())] = {
+                nuevo_id = str(uuid.uuid4())
+                proveedores[nuevo_id] = {
                     "nombre_base": nombre_base, "es_dinamico": request.form.get("nuevo_es_dinamico") == "true",
                     "descuento": parse_percentage(request.form.get("nuevo_descuento")) or 0.0,
                     "iva": parse_percentage(request.form.get("nuevo_iva")) or 0.0,
@@ -861,6 +3322,7 @@ def index():
                 }
                 try:
                     save_proveedores(proveedores)
+                    invalidar_variante(nuevo_id)
                     mensaje = f"✅ PROVEEDOR '{nombre_base}' AÑADIDO."
                 except Exception as e:
                     mensaje = f"❌ ERROR GUARDANDO DATOS.JSON: {e}"
@@ -871,6 +3333,7 @@ def index():
                 nombre_borrado = generar_nombre_visible(proveedores.pop(proveedor_id_a_borrar))
                 try:
                     save_proveedores(proveedores)
+                    invalidar_variante(proveedor_id_a_borrar)
                     mensaje = f"✅ PROVEEDOR '{nombre_borrado}' BORRADO."
                 except Exception as e:
                     mensaje = f"❌ ERROR GUARDANDO DATOS.JSON: {e}"
@@ -880,6 +3343,7 @@ def index():
         elif formulario == "borrar_historial_seleccionado":
             ids_para_borrar = request.form.getlist("historial_ids_a_borrar")
             if ids_para_borrar:
+                vaciar_historial()  # que no quede nada encolado que se escriba después de reescribir
                 nuevo_historial = [item for item in load_historial() if item.get("id_historial") not in ids_para_borrar]
                 try:
                     atomic_save_historial_list(nuevo_historial)
@@ -891,6 +3355,7 @@ def index():
 
         elif formulario == "borrar_todo_historial":
             try:
+                vaciar_historial()
                 atomic_save_historial_list([])
                 mensaje = "✅ TODO EL HISTORIAL BORRADO."
             except Exception as e:
@@ -899,16 +3364,16 @@ def index():
         elif formulario == "borrar_listas_old":
             # Eliminar todos los archivos con OLD en el nombre (sin tocar vigentes)
             try:
-                eliminados = 0
-                for fname in os.listdir(LISTAS_PATH):
-                    if not fname.lower().endswith(('.xlsx','.xls')):
-                        continue
-                    if 'old' in fname.lower():
+                eliminados = []
+                for entrada_lista in listas_manifiesto():
+                    if entrada_lista['old']:
                         try:
-                            os.remove(os.path.join(LISTAS_PATH, fname))
-                            eliminados += 1
+                            os.remove(os.path.join(LISTAS_PATH, entrada_lista['filename']))
+                            eliminados.append(entrada_lista['filename'])
                         except Exception:
                             pass
+                actualizar_manifiesto(quitar=eliminados)
+                eliminados = len(eliminados)
                 mensaje = f"✅ {eliminados} LISTA(S) OLD ELIMINADA(S)." if eliminados else "ℹ️ NO HABÍA LISTAS OLD PARA BORRAR."
                 active_tab = "gestion"
             except Exception as e:
@@ -919,6 +3384,7 @@ def index():
             if fname and 'old' in fname.lower() and fname.lower().endswith(('.xlsx','.xls')):
                 try:
                     os.remove(os.path.join(LISTAS_PATH, fname))
+                    actualizar_manifiesto(quitar=[fname])
                     mensaje = f"✅ LISTA OLD '{fname}' ELIMINADA."
                 except Exception as e:
                     mensaje = f"❌ ERROR ELIMINANDO '{fname}': {e}"
@@ -948,48 +3414,9 @@ def index():
                         fecha_formato = "%d%m%Y" if incluir_dia else "%m%Y"
                         fecha_str = now_local().strftime(fecha_formato)
                         nombre_final = f"{nombre_base}-{fecha_str}{ext}"
-                        ruta_final = os.path.join(LISTAS_PATH, nombre_final)
-                        # Política: solo 1 versión OLD por proveedor.
-                        # Pasos: eliminar cualquier OLD existente del proveedor, luego renombrar la vigente a OLD.
-                        try:
-                            norm_prov_subida = normalize_text(nombre_base)
-                            archivos = os.listdir(LISTAS_PATH)
-                            # 1) Borrar OLD previas del proveedor
-                            for existing in archivos:
-                                if not existing.lower().endswith(('.xlsx', '.xls')):
-                                    continue
-                                if 'old' in existing.lower():
-                                    prov_part_old = os.path.splitext(existing)[0].split('-')[0]
-                                    if normalize_text(prov_part_old) == norm_prov_subida:
-                                        try:
-                                            os.remove(os.path.join(LISTAS_PATH, existing))
-                                        except Exception:
-                                            pass
-                            # 2) Renombrar la vigente (si existe) a OLD
-                            for existing in archivos:
-                                if not existing.lower().endswith(('.xlsx', '.xls')):
-                                    continue
-                                if 'old' in existing.lower():
-                                    continue  # ya hemos limpiado las old
-                                prov_part = os.path.splitext(existing)[0].split('-')[0]
-                                if normalize_text(prov_part) == norm_prov_subida:
-                                    src_path = os.path.join(LISTAS_PATH, existing)
-                                    base_no_ext, ext_exist = os.path.splitext(existing)
-                                    dst_path = os.path.join(LISTAS_PATH, f"{base_no_ext}-OLD{ext_exist}")
-                                    # Si por alguna razón quedó un archivo destino, lo eliminamos para sobreescribir limpio
-                                    if os.path.exists(dst_path):
-                                        try: os.remove(dst_path)
-                                        except Exception: pass
-                                    try:
-                                        os.rename(src_path, dst_path)
-                                    except Exception as e_rn:
-                                        resultados_subida.append(f"⚠️ No se pudo renombrar a OLD: {existing} -> {e_rn}")
-                                    break  # solo una vigente
-                        except Exception as e_mark:
-                            resultados_subida.append(f"⚠️ Aviso al gestionar versiones OLD: {e_mark}")
-                        # Guardar (overwrite permitido)
-                        archivo.save(ruta_final)
-                        resultados_subida.append(f"✅ {nombre_orig} -> {nombre_final}")
+                        # La validación, la rotación a OLD y la carga a la caché las hace el worker
+                        trabajo_id = encolar_ingesta(archivo, nombre_final, nombre_base)
+                        resultados_subida.append(f"⏳ {nombre_orig} -> {nombre_final} (en proceso, trabajo {trabajo_id})")
                     except Exception as e:
                         resultados_subida.append(f"❌ {nombre_orig}: error {e}")
                 mensaje = " | ".join(resultados_subida)
@@ -1001,30 +3428,22 @@ def index():
     # Crear lista única de nombres base de proveedores para el dropdown
     lista_nombres_proveedores = sorted(list(set(p_data['nombre_base'] for p_data in proveedores.values())))
 
-    # --- Calcular últimas actualizaciones de archivos Excel ---
+    # --- Calcular últimas actualizaciones de archivos Excel (desde el manifiesto) ---
+    entradas_listas = listas_manifiesto()
+    nombre_por_norm = {}
+    for p in proveedores.values():
+        nombre_por_norm.setdefault(normalize_text(p['nombre_base']), p['nombre_base'])
     ultimas_actualizaciones = {}
-    try:
-        for fname in os.listdir(LISTAS_PATH):
-            if not fname.lower().endswith(('.xlsx', '.xls')):
-                continue
-            ruta = os.path.join(LISTAS_PATH, fname)
-            try:
-                mtime = os.path.getmtime(ruta)
-            except Exception:
-                continue
-            provider_part = os.path.splitext(fname)[0].split('-')[0]
-            norm_provider_part = normalize_text(provider_part)
-            nombre_match = next((p['nombre_base'] for p in proveedores.values() if normalize_text(p['nombre_base']) == norm_provider_part), provider_part)
-            data_existente = ultimas_actualizaciones.get(nombre_match)
-            if not data_existente or mtime > data_existente['mtime']:
-                ultimas_actualizaciones[nombre_match] = {
-                    'filename': fname,
-                    'mtime': mtime,
-                    'fecha': ts_to_local(mtime).strftime('%d/%m/%Y %H:%M'),
-                    'hace': humanizar_tiempo_desde(mtime)
-                }
-    except Exception:
-        pass
+    for e in entradas_listas:
+        nombre_match = nombre_por_norm.get(e['proveedor_norm'], e['proveedor'])
+        data_existente = ultimas_actualizaciones.get(nombre_match)
+        if not data_existente or e['mtime'] > data_existente['mtime']:
+            ultimas_actualizaciones[nombre_match] = {
+                'filename': e['filename'],
+                'mtime': e['mtime'],
+                'fecha': ts_to_local(e['mtime']).strftime('%d/%m/%Y %H:%M'),
+                'hace': humanizar_tiempo_desde(e['mtime'])
+            }
     ultimas_actualizaciones_list = sorted([
         {'proveedor': k, **v} for k, v in ultimas_actualizaciones.items()
     ], key=lambda x: x['proveedor'])
@@ -1032,46 +3451,47 @@ def index():
     # Listas vigentes y antiguas para descarga
     listas_vigentes = []
     listas_old = []
-    try:
-        for fname in os.listdir(LISTAS_PATH):
-            if not fname.lower().endswith(('.xlsx','.xls')): continue
-            full_path = os.path.join(LISTAS_PATH, fname)
-            info = {
-                'filename': fname,
-                'fecha': ts_to_local(os.path.getmtime(full_path)).strftime('%d/%m/%Y %H:%M')
-            }
-            if 'old' in fname.lower():
-                listas_old.append(info)
-            else:
-                listas_vigentes.append(info)
-        listas_vigentes.sort(key=lambda x: x['filename'])
-        listas_old.sort(key=lambda x: x['filename'])
-    except Exception:
-        pass
+    for e in entradas_listas:
+        info = {
+            'filename': e['filename'],
+            'fecha': ts_to_local(e['mtime']).strftime('%d/%m/%Y %H:%M')
+        }
+        if e['old']:
+            listas_old.append(info)
+        else:
+            listas_vigentes.append(info)
+    listas_vigentes.sort(key=lambda x: x['filename'])
+    listas_old.sort(key=lambda x: x['filename'])
 
-
-    return render_template(
-        "index_v5.html",
-        proveedores_lista=lista_proveedores_display,
-        resultado_auto=resultado_auto,
-        resultado_manual=resultado_manual,
-        productos_encontrados=productos_encontrados,
-        mensaje=mensaje,
-        proveedor_id_seleccionado=proveedor_id_seleccionado,
-        datos_seleccionados=datos_seleccionados,
-        historial=historial,
-        active_tab=active_tab,
-        lista_nombres_proveedores=lista_nombres_proveedores,
-        proveedor_buscado=proveedor_buscado,
-        filtro_resultados=filtro_resultados,
-        # --- MODIFICACIÓN ---
-        datos_calculo_auto=datos_calculo_auto,
-        datos_calculo_manual=datos_calculo_manual,
-        ultimas_actualizaciones=ultimas_actualizaciones_list,
-        listas_path=LISTAS_PATH,
-        listas_vigentes=listas_vigentes,
-        listas_old=listas_old
-    )
+    with etapa('render'):
+        html = render_template(
+            "index_v5.html",
+            proveedores_lista=lista_proveedores_display,
+            resultado_auto=resultado_auto,
+            resultado_manual=resultado_manual,
+            productos_encontrados=productos_encontrados,
+            mensaje=mensaje,
+            proveedor_id_seleccionado=proveedor_id_seleccionado,
+            datos_seleccionados=datos_seleccionados,
+            historial=historial,
+            active_tab=active_tab,
+            lista_nombres_proveedores=lista_nombres_proveedores,
+            proveedor_buscado=proveedor_buscado,
+            filtro_resultados=filtro_resultados,
+            facetas_busqueda=facetas_busqueda,
+            busqueda_registrada=busqueda_registrada,
+            # --- MODIFICACIÓN ---
+            datos_calculo_auto=datos_calculo_auto,
+            datos_calculo_manual=datos_calculo_manual,
+            ultimas_actualizaciones=ultimas_actualizaciones_list,
+            listas_path=LISTAS_PATH,
+            listas_vigentes=listas_vigentes,
+            listas_old=listas_old,
+            ingestas=listar_ingestas()[:10]
+        )
+    if busqueda_saturada:
+        return html, 503, {'Retry-After': str(BUSQUEDA_RETRY_AFTER)}
+    return html
 
 @app.route('/download_lista/<path:filename>')
 @login_required
@@ -1082,36 +3502,753 @@ def download_lista(filename):
     ext = os.path.splitext(filename)[1].lower()
     if ext not in app.config['UPLOAD_EXTENSIONS']:
         abort(404)
-    file_path = os.path.join(LISTAS_PATH, filename)
-    if not os.path.isfile(file_path):
+    entrada, digest = lista_para_descarga(filename)
+    # ETag = hash del contenido: una PC que ya la tiene recibe 304; Range permite reanudar
+    return respuesta_revalidable(send_from_directory(
+        LISTAS_PATH, filename, as_attachment=True, etag=digest, last_modified=entrada['mtime'], conditional=True))
+
+@app.route('/download_lista_csv/<path:filename>')
+@login_required
+def download_lista_csv(filename):
+    """La lista convertida a CSV comprimido (.csv.gz), para quien no necesita el XLSX original."""
+    if '..' in filename or filename.startswith('/'):
+        abort(400)
+    entrada, digest = lista_para_descarga(filename)
+    try:
+        ruta_csv = lista_csv_gz(os.path.join(LISTAS_PATH, filename), digest)
+    except Exception as e:
+        log_debug('download_lista_csv: error convirtiendo', filename, e)
+        abort(500)
+    return respuesta_revalidable(send_file(
+        ruta_csv, mimetype='application/gzip', as_attachment=True,
+        download_name=f"{os.path.splitext(filename)[0]}.csv.gz", etag=f"{digest}-csv", conditional=True))
+
+@app.route('/api/ingestas')
+@login_required
+def api_ingestas():
+    """Estado de las subidas de listas recientes (del más reciente al más viejo)."""
+    return {'trabajos': listar_ingestas()}, 200
+
+@app.route('/api/ingestas/<trabajo_id>')
+@login_required
+def api_ingesta(trabajo_id):
+    trabajo = next((t for t in listar_ingestas() if t['id'] == trabajo_id), None)
+    if trabajo is None:
+        return {'error': 'trabajo no encontrado'}, 404
+    return trabajo, 200
+
+@app.route('/api/busquedas/frecuentes')
+@login_required
+def api_busquedas_frecuentes():
+    """Consultas más frecuentes (`dias`, 30 por defecto; `limite`, 50): qué conviene tener indexado y precalentado."""
+    try:
+        dias = max(1, int(request.args.get('dias', 30)))
+        limite = max(1, min(int(request.args.get('limite', 50)), 1000))
+    except ValueError:
+        return {'error': 'dias y limite deben ser enteros'}, 400
+    consultas = resumen_busquedas(dias, limite)
+    total = sum(c['veces'] for c in consultas)
+    por_codigo = sum(c['veces'] for c in consultas if c['termino'].isdigit())
+    return {'dias': dias, 'consultas': consultas, 'total': total,
+            'proporcion_por_codigo': round(por_codigo / total, 3) if total else None}, 200
+
+@app.route('/api/precios/historial')
+@login_required
+def api_historial_precio():
+    """Evolución del precio base de un producto: `proveedor` (clave, p. ej. berger), `codigo`, `limite` (6)."""
+    proveedor = normalize_text(request.args.get('proveedor', ''))
+    codigo = str(request.args.get('codigo', '')).split('.')[0].strip()
+    if not proveedor or not codigo:
+        return {'error': 'faltan proveedor y codigo'}, 400
+    try:
+        limite = max(1, min(int(request.args.get('limite', PRECIOS_HISTORIAL_LIMITE)), 100))
+    except ValueError:
+        return {'error': 'limite debe ser un entero'}, 400
+    try:
+        versiones = historial_precio(proveedor, codigo, limite)
+    except Exception as e:
+        log_debug('historial_precio: error', e)
+        return {'error': 'no se pudo leer el historial de precios'}, 500
+    return {'proveedor': proveedor, 'codigo': codigo, 'versiones': versiones}, 200
+
+@app.route('/api/historial/resumen')
+@login_required
+def historial_resumen():
+    """Agregados del historial: ?agrupar=dia|proveedor|tipo&desde=AAAA-MM-DD&hasta=AAAA-MM-DD"""
+    agrupar = request.args.get('agrupar', 'dia')
+    try:
+        desde = datetime.strptime(request.args['desde'], '%Y-%m-%d').date() if request.args.get('desde') else None
+        hasta = datetime.strptime(request.args['hasta'], '%Y-%m-%d').date() if request.args.get('hasta') else None
+        filas = resumir_historial(agrupar, desde, hasta)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+    return {'agrupar': agrupar, 'desde': desde and desde.isoformat(), 'hasta': hasta and hasta.isoformat(), 'filas': filas}, 200
+
+@app.route('/api/calcular_lote', methods=['POST'])
+@login_required
+def api_calcular_lote():
+    """Calcula precios por lote. Entrada: archivo CSV/XLSX en `archivo` o JSON en el cuerpo.
+    Guarda todas las entradas en el historial de una vez (salvo ?guardar=0).
+    Respuesta JSON, o CSV con ?formato=csv.
+    """
+    try:
+        filas = leer_filas_lote(archivo=request.files.get('archivo'),
+                                datos_json=None if 'archivo' in request.files else request.get_json(silent=True))
+    except Exception as e:
+        return {'error': f'No se pudo leer la entrada: {e}'}, 400
+    resultados, entradas = calcular_lote(filas, asegurar_proveedores())
+    if request.args.get('guardar', '1') == '0':
+        entradas = []
+    else:
+        try:
+            add_entries_to_historial(entradas)
+        except Exception as e:
+            return {'error': f'Error guardando historial: {e}', 'resultados': resultados}, 500
+    if request.args.get('formato') == 'csv':
+        import csv
+        import io
+        buffer = io.StringIO()
+        buffer.write('\ufeff')
+        columnas = ['fila', 'producto', 'proveedor', 'tipo_calculo', 'precio_base', 'precio_final', 'error']
+        writer = csv.DictWriter(buffer, fieldnames=columnas, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(resultados)
+        return app.response_class(buffer.getvalue(), mimetype='text/csv; charset=utf-8',
+                                  headers={'Content-Disposition': 'attachment; filename="calculo_lote.csv"'})
+    return {'cantidad': len(resultados), 'guardadas': len(entradas), 'resultados': resultados}, 200
+
+@app.route('/proveedores/<prov_id>/lista_con_precios')
+@login_required
+def descargar_lista_con_precios(prov_id):
+    """Lista vigente del proveedor con costo y precio de venta según sus porcentajes."""
+    prov_data = asegurar_proveedores().get(prov_id)
+    if not prov_data:
+        abort(404)
+    filename = buscar_lista_vigente(prov_data.get('nombre_base', ''))
+    config = PROVEEDOR_CONFIG.get(clave_proveedor_archivo(filename)) if filename else None
+    if not config:
         abort(404)
-    return send_from_directory(LISTAS_PATH, filename, as_attachment=True)
+    nombre_prov = unicodedata.normalize('NFD', generar_nombre_visible(prov_data)).encode('ascii', 'ignore').decode()
+    nombre = f"{os.path.splitext(filename)[0]}-{re.sub(r'[^A-Za-z0-9.]+', '_', nombre_prov)}.xlsx"
+    cuerpo = generar_lista_con_precios(os.path.join(LISTAS_PATH, filename), config, prov_data)
+    return app.response_class(cuerpo, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+                              headers={'Content-Disposition': f'attachment; filename="{nombre}"'})
+
+# --- EXPORTACIÓN DE HISTORIAL ---
+COLUMNAS_EXPORTACION = ['id_historial', 'timestamp', 'tipo_calculo', 'proveedor_nombre', 'producto',
+                        'precio_base', 'porcentajes', 'precio_final', 'observaciones']
+
+def fila_exportacion(item):
+    fila = [item.get(col) for col in COLUMNAS_EXPORTACION]
+    fila[COLUMNAS_EXPORTACION.index('porcentajes')] = json.dumps(item.get('porcentajes') or {}, ensure_ascii=False)
+    return fila
+
+def generar_csv_historial(filas):
+    import csv
+    import io
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')  # BOM para que Excel reconozca UTF-8
+    writer.writerow(COLUMNAS_EXPORTACION)
+    for i, item in enumerate(filas, 1):
+        writer.writerow(fila_exportacion(item))
+        if i % 500 == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+def generar_xlsx_historial(filas, tamanio_bloque=64 * 1024):
+    """XLSX con workbook write-only de openpyxl: las filas se vuelcan a disco a medida que llegan
+    y el archivo (zip) se envía por bloques al terminar, sin tenerlo entero en memoria.
+    """
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('Historial')
+    ws.append(COLUMNAS_EXPORTACION)
+    for item in filas:
+        ws.append(fila_exportacion(item))
+    yield from enviar_workbook_por_bloques(wb, tamanio_bloque)
+
+def enviar_workbook_por_bloques(wb, tamanio_bloque=64 * 1024):
+    """Guarda el workbook en un archivo temporal y lo emite por bloques."""
+    with tempfile.TemporaryFile() as tmp:
+        wb.save(tmp)
+        tmp.seek(0)
+        while True:
+            bloque = tmp.read(tamanio_bloque)
+            if not bloque:
+                break
+            yield bloque
+
+@app.route('/historial/exportar')
+@login_required
+def exportar_historial():
+    """Descarga todo el historial: ?formato=csv|xlsx&desde=AAAA-MM-DD&hasta=AAAA-MM-DD"""
+    formato = request.args.get('formato', 'csv').lower()
+    if formato not in ('csv', 'xlsx'):
+        abort(400)
+    try:
+        desde = datetime.strptime(request.args['desde'], '%Y-%m-%d').date() if request.args.get('desde') else None
+        hasta = datetime.strptime(request.args['hasta'], '%Y-%m-%d').date() if request.args.get('hasta') else None
+    except ValueError:
+        abort(400)
+    filas = iterar_historial(desde, hasta)
+    nombre = f"historial-{now_local().strftime('%Y%m%d-%H%M')}.{formato}"
+    if formato == 'csv':
+        cuerpo, mimetype = generar_csv_historial(filas), 'text/csv; charset=utf-8'
+    else:
+        cuerpo, mimetype = generar_xlsx_historial(filas), 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    return app.response_class(cuerpo, mimetype=mimetype,
+                              headers={'Content-Disposition': f'attachment; filename="{nombre}"'})
+
+# --- CACHÉ HTTP Y COMPRESIÓN ---
+# Descargas de listas con ETag (hash del contenido), Last-Modified y Range; HTML/JSON
+# comprimidos con brotli (si está instalado) o gzip cuando superan COMPRESION_MIN_BYTES.
+COMPRESION_MIN_BYTES = int(os.getenv('COMPRESION_MIN_BYTES', '1024'))
+COMPRESION_TIPOS = ('text/html', 'application/json', 'text/plain', 'text/csv')
+LISTAS_CSV_DIR = os.path.join(LISTAS_PATH, '.csv')
+LISTAS_CSV_PRECONVERTIR = os.getenv('LISTAS_CSV_PRECONVERTIR', '0') == '1'
+_listas_csv_lock = threading.Lock()
+
+def lista_para_descarga(filename):
+    """(entrada del manifiesto, sha256) de una lista existente; 404 si no está."""
+    entrada = next((e for e in listas_manifiesto() if e['filename'] == filename), None)
+    if entrada is None:
+        abort(404)
+    try:
+        digest = hash_lista(os.path.join(LISTAS_PATH, filename), (entrada['mtime'], entrada['size']))
+    except OSError:
+        abort(404)
+    return entrada, digest
+
+def respuesta_revalidable(respuesta):
+    # Detrás del login: que la guarde solo el navegador y la revalide siempre (304 si no cambió)
+    respuesta.cache_control.public = False
+    respuesta.cache_control.max_age = None
+    respuesta.cache_control.private = True
+    respuesta.cache_control.no_cache = True
+    return respuesta
+
+def convertir_lista_a_csv_gz(file_path, destino):
+    """Escribe la lista como CSV (UTF-8 con BOM) comprimido con gzip. Con varias hojas se agrega
+    la columna 'Hoja' y se repite el encabezado cuando cambian las columnas.
+    """
+    import csv
+    import gzip
+    import math
+    config = PROVEEDOR_CONFIG.get(clave_proveedor_archivo(os.path.basename(file_path)))
+    hojas = cargar_hojas_lista(file_path, config['fila_encabezado'] if config else 0)
+    if config:
+        # Solo las hojas de catálogo (las que tienen código y producto), como la búsqueda
+        hojas = {n: df for n, df in hojas.items()
+                 if any(a in df.columns for a in config['codigo']) and any(a in df.columns for a in config['producto'])} or hojas
+    hojas = {n: df for n, df in hojas.items() if not df.empty}
+    varias = len(hojas) > 1
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(destino), suffix='.tmp')
+    os.close(fd)
+    try:
+        with gzip.open(tmp_path, 'wt', encoding='utf-8-sig', newline='', compresslevel=6) as f:
+            writer = csv.writer(f)
+            encabezado_previo = None
+            for sheet_name, df in hojas.items():
+                encabezado = df.attrs.get('columnas_originales', list(df.columns))
+                if encabezado != encabezado_previo:
+                    writer.writerow((['Hoja'] if varias else []) + encabezado)
+                    encabezado_previo = encabezado
+                prefijo = [sheet_name] if varias else []
+                for fila in df.itertuples(index=False, name=None):
+                    writer.writerow(prefijo + ['' if isinstance(v, float) and math.isnan(v) else v for v in fila])
+        os.replace(tmp_path, destino)
+    except Exception:
+        try: os.remove(tmp_path)
+        except Exception: pass
+        raise
+
+def lista_csv_gz(file_path, digest):
+    """Ruta del CSV comprimido de la lista (se genera una vez por contenido y se reutiliza)."""
+    destino = os.path.join(LISTAS_CSV_DIR, f"{digest}.csv.gz")
+    if os.path.exists(destino):
+        return destino
+    with _listas_csv_lock:
+        if not os.path.exists(destino):
+            os.makedirs(LISTAS_CSV_DIR, exist_ok=True)
+            convertir_lista_a_csv_gz(file_path, destino)
+            # Los CSV de contenidos que ya no están en LISTAS_PATH no se van a volver a pedir
+            vigentes = {e['sha256'] for e in listas_manifiesto()} | {digest}
+            for fname in os.listdir(LISTAS_CSV_DIR):
+                if fname.endswith('.csv.gz') and fname[:-len('.csv.gz')] not in vigentes:
+                    try: os.remove(os.path.join(LISTAS_CSV_DIR, fname))
+                    except OSError: pass
+    return destino
+
+def codificacion_aceptada():
+    aceptadas = request.headers.get('Accept-Encoding', '').lower()
+    if brotli is not None and 'br' in aceptadas:
+        return 'br'
+    if 'gzip' in aceptadas:
+        return 'gzip'
+    return None
+
+@app.after_request
+def comprimir_respuesta(response):
+    if (response.direct_passthrough or response.is_streamed or response.status_code not in (200, 201, 400, 404)
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESION_TIPOS):
+        return response
+    response.vary.add('Accept-Encoding')
+    codificacion = codificacion_aceptada()
+    if codificacion is None:
+        return response
+    cuerpo = response.get_data()
+    if len(cuerpo) < COMPRESION_MIN_BYTES:
+        return response
+    if codificacion == 'br':
+        comprimido = brotli.compress(cuerpo, quality=5)
+    else:
+        import gzip
+        comprimido = gzip.compress(cuerpo, compresslevel=6)
+    response.set_data(comprimido)
+    response.headers['Content-Encoding'] = codificacion
+    return response
 
 @app.route('/health')
 def health():
+    """Chequeo barato para el health-check de la plataforma: no trae filas del historial."""
     modo_storage = 'postgresql' if (DATABASE_URL and psycopg) else 'json'
+    status = 'ok'
     prov_count = 'n/a'
     try:
-        prov_count = len(proveedores)
+        if proveedores is not None:
+            prov_count = len(proveedores)
     except Exception:
         pass
+    db_estado = None
+    if modo_storage == 'postgresql':
+        try:
+            with get_pg_conn() as conn, conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            db_estado = 'ok'
+        except Exception as e:
+            log_debug('health: DB no responde', e)
+            db_estado = 'error'
+            status = 'degraded'
     histo_len = None
     try:
-        histo_len = len(load_historial())
+        histo_len = contar_historial()
     except Exception:
         histo_len = 'err'
     return {
-        'status': 'ok',
+        'status': status,
         'storage': modo_storage,
+        'db': db_estado,
         'proveedores': prov_count,
         'historial_count': histo_len,
         'debug': DEBUG_LOG
     }, 200
 
+# --- MÉTRICAS ---
+# Histograma de latencias por acción (formulario del index o endpoint) en formato Prometheus.
+LATENCIA_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+_metricas_lock = threading.Lock()
+_latencias = {}  # accion -> {'buckets': [int], 'count': int, 'sum': float}
+# Formularios del index que se miden por separado; cualquier otro valor (lo manda el cliente)
+# se cuenta como 'otro' para no agregar etiquetas sin límite ni texto arbitrario en /metrics.
+FORMULARIOS_INDEX = frozenset((
+    'consulta_producto', 'calcular_auto', 'calcular_manual', 'editar', 'agregar', 'borrar',
+    'borrar_historial_seleccionado', 'borrar_todo_historial', 'borrar_listas_old',
+    'borrar_lista_old_individual', 'subir_lista',
+))
+
+def accion_de_request():
+    if request.endpoint == 'index' and request.method == 'POST':
+        formulario = request.form.get('formulario')
+        if not formulario:
+            return 'index_post'
+        return formulario if formulario in FORMULARIOS_INDEX else 'otro'
+    return request.endpoint or 'sin_ruta'
+
+def registrar_latencia(accion, segundos):
+    with _metricas_lock:
+        datos = _latencias.get(accion)
+        if datos is None:
+            datos = _latencias[accion] = {'buckets': [0] * len(LATENCIA_BUCKETS), 'count': 0, 'sum': 0.0}
+        for i, limite in enumerate(LATENCIA_BUCKETS):
+            if segundos <= limite:
+                datos['buckets'][i] += 1
+        datos['count'] += 1
+        datos['sum'] += segundos
+
+@app.before_request
+def iniciar_cronometro():
+    request.inicio_request = time.perf_counter()
+
+@app.after_request
+def medir_latencia(response):
+    inicio = getattr(request, 'inicio_request', None)
+    if inicio is not None:
+        try:
+            registrar_latencia(accion_de_request(), time.perf_counter() - inicio)
+        except Exception as e:
+            log_debug('medir_latencia: error', e)
+    return response
+
+@app.before_request
+def iniciar_tiempos_etapas():
+    if TIEMPOS_ETAPAS:
+        _tiempos_actuales.set({})
+
+@app.after_request
+def emitir_tiempos_etapas(response):
+    """Header Server-Timing y una línea JSON con las etapas del request."""
+    if not TIEMPOS_ETAPAS:
+        return response
+    tiempos = _tiempos_actuales.get()
+    _tiempos_actuales.set(None)
+    inicio = getattr(request, 'inicio_request', None)
+    if tiempos is None or inicio is None:
+        return response
+    try:
+        total_ms = (time.perf_counter() - inicio) * 1000
+        etapas = {nombre: {'ms': round(segundos * 1000, 2), 'n': veces} for nombre, (segundos, veces) in tiempos.items()}
+        partes = [f'{nombre};dur={datos["ms"]}' + (f';desc="x{datos["n"]}"' if datos['n'] > 1 else '')
+                  for nombre, datos in etapas.items()]
+        partes.append(f'total;dur={total_ms:.2f}')
+        response.headers['Server-Timing'] = ', '.join(partes)
+        linea = json.dumps({
+            'ts': now_local().isoformat(timespec='milliseconds'),
+            'metodo': request.method,
+            'ruta': request.path,
+            'accion': accion_de_request(),
+            'status': response.status_code,
+            'total_ms': round(total_ms, 2),
+            'etapas': etapas,
+        }, ensure_ascii=False)
+        with _tiempos_log_lock:
+            if TIEMPOS_LOG:
+                with open(TIEMPOS_LOG, 'a', encoding='utf-8') as f:
+                    f.write(linea + '\n')
+            else:
+                print(linea, flush=True)
+    except Exception as e:
+        log_debug('emitir_tiempos_etapas: error', e)
+    return response
+
+def rss_proceso_bytes():
+    """RSS actual del proceso (Linux /proc); si no, el pico vía resource; None en otros sistemas."""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for linea in f:
+                if linea.startswith('VmRSS:'):
+                    return int(linea.split()[1]) * 1024
+    except Exception:
+        pass
+    try:
+        import resource
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == 'darwin' else maxrss * 1024
+    except Exception:
+        return None
+
+@app.route('/metrics')
+def metrics():
+    if METRICS_TOKEN and request.args.get('token') != METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        abort(403)
+    lineas = [
+        '# HELP app_request_duration_seconds Latencia de requests por acción.',
+        '# TYPE app_request_duration_seconds histogram',
+    ]
+    with _metricas_lock:
+        latencias = {k: {'buckets': list(v['buckets']), 'count': v['count'], 'sum': v['sum']} for k, v in _latencias.items()}
+    for accion in sorted(latencias):
+        datos = latencias[accion]
+        for limite, cantidad in zip(LATENCIA_BUCKETS, datos['buckets']):
+            lineas.append(f'app_request_duration_seconds_bucket{{accion="{accion}",le="{limite}"}} {cantidad}')
+        lineas.append(f'app_request_duration_seconds_bucket{{accion="{accion}",le="+Inf"}} {datos["count"]}')
+        lineas.append(f'app_request_duration_seconds_sum{{accion="{accion}"}} {datos["sum"]:.6f}')
+        lineas.append(f'app_request_duration_seconds_count{{accion="{accion}"}} {datos["count"]}')
+
+    cat = catalogo_stats_total()
+    consultas = cat['hits'] + cat['misses']
+    lineas += [
+        '# TYPE app_catalogo_listas gauge',
+        f'app_catalogo_listas {cat["listas"]}',
+        '# TYPE app_catalogo_bytes gauge',
+        f'app_catalogo_bytes {cat["bytes"]}',
+        '# TYPE app_catalogo_hits_total counter',
+        f'app_catalogo_hits_total {cat["hits"]}',
+        '# TYPE app_catalogo_misses_total counter',
+        f'app_catalogo_misses_total {cat["misses"]}',
+        '# TYPE app_catalogo_desalojos_total counter',
+        f'app_catalogo_desalojos_total {cat["desalojos"]}',
+        '# TYPE app_catalogo_limite_bytes gauge',
+        f'app_catalogo_limite_bytes {cat["limite_bytes"]}',
+        '# TYPE app_catalogo_hit_ratio gauge',
+        f'app_catalogo_hit_ratio {(cat["hits"] / consultas) if consultas else 0:.4f}',
+    ]
+
+    bus = busqueda_stats()
+    lineas += [
+        '# TYPE app_busqueda_procesos gauge',
+        f'app_busqueda_procesos {bus["procesos"]}',
+        '# TYPE app_busqueda_en_curso gauge',
+        f'app_busqueda_en_curso {bus["en_curso"]}',
+        '# TYPE app_busqueda_rechazadas_total counter',
+        f'app_busqueda_rechazadas_total {bus["rechazadas"]}',
+    ]
+
+    lineas.append('# TYPE app_ingesta_trabajos gauge')
+    for estado, cantidad in ingesta_stats().items():
+        lineas.append(f'app_ingesta_trabajos{{estado="{estado}"}} {cantidad}')
+
+    pool = get_pg_pool()
+    if pool is not None:
+        try:
+            for clave, valor in sorted(pool.get_stats().items()):
+                lineas.append(f'# TYPE app_db_pool_{clave} gauge')
+                lineas.append(f'app_db_pool_{clave} {valor}')
+        except Exception as e:
+            log_debug('metrics: error leyendo stats del pool', e)
+
+    rss = rss_proceso_bytes()
+    if rss is not None:
+        lineas += ['# TYPE app_process_resident_memory_bytes gauge', f'app_process_resident_memory_bytes {rss}']
+    return '\n'.join(lineas) + '\n', 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@app.route('/api/catalogo')
+def api_catalogo():
+    """Caché de listas por proceso: listas residentes (de la usada hace más tiempo a la más
+    reciente) con su tamaño, límite, hits, cargas (misses) y desalojos."""
+    if not autorizado_diagnostico():
+        abort(403)
+    with _busqueda_lock:
+        workers = {str(pid): stats for pid, stats in _catalogo_stats_workers.items()}
+    return {'total': catalogo_stats_total(), 'procesos': {str(os.getpid()): catalogo_stats(), **workers}}, 200
+
+# --- PERFILADOR BAJO DEMANDA ---
+# Para ver en producción dónde se va el tiempo sin reproducir el entorno ni redeployar:
+# POST /api/perfilador arma el perfilador y los próximos N requests (opcionalmente solo los de
+# una acción, p. ej. consulta_producto) corren bajo cProfile; un request suelto se perfila con
+# ?perfilar=1. La búsqueda que corre en el pool de procesos se perfila allá y se suma al perfil.
+# Cada perfil queda en PERFILES_DIR como .prof (pstats; snakeviz o flameprof lo muestran como
+# flamegraph) más un resumen .txt, y se conservan los últimos PERFILES_MAX.
+PERFILES_DIR = os.getenv('PERFILES_DIR', os.path.join(tempfile.gettempdir(), 'consulta_precios_perfiles'))
+PERFILES_MAX = int(os.getenv('PERFILES_MAX', '20'))
+PERFILADOR_MAX_REQUESTS = 50
+_perfilador_lock = threading.Lock()
+_perfilador = {'restantes': 0, 'accion': None}
+# cProfile admite un solo perfil activo por proceso (en 3.12 usa sys.monitoring): de a un request
+_perfil_en_curso = threading.Lock()
+_perfil_actual = contextvars.ContextVar('perfil_actual', default=None)  # ruta base del perfil del request
+
+def autorizado_diagnostico():
+    """Sesión iniciada o METRICS_TOKEN (para usarlo con curl)."""
+    if session.get('logged_in'):
+        return True
+    return bool(METRICS_TOKEN) and (request.args.get('token') == METRICS_TOKEN
+                                    or request.headers.get('Authorization') == f'Bearer {METRICS_TOKEN}')
+
+def listar_perfiles():
+    try:
+        nombres = [f for f in os.listdir(PERFILES_DIR) if f.endswith('.prof')]
+    except OSError:
+        return []
+    perfiles = []
+    for nombre in nombres:
+        try:
+            st = os.stat(os.path.join(PERFILES_DIR, nombre))
+        except OSError:
+            continue
+        perfiles.append({'nombre': nombre, 'resumen': nombre[:-5] + '.txt', 'bytes': st.st_size,
+                         'creado': ts_to_local(st.st_mtime).strftime(TIMESTAMP_FORMATO), '_mtime': st.st_mtime})
+    perfiles.sort(key=lambda p: p['_mtime'], reverse=True)
+    for p in perfiles:
+        del p['_mtime']
+    return perfiles
+
+def purgar_perfiles():
+    for viejo in listar_perfiles()[PERFILES_MAX:]:
+        for nombre in (viejo['nombre'], viejo['resumen']):
+            try:
+                os.remove(os.path.join(PERFILES_DIR, nombre))
+            except OSError:
+                pass
+
+def guardar_perfil(perfil, base):
+    """Escribe base.prof (sumando el perfil del proceso de búsqueda si lo hay) y base.txt."""
+    import io
+    import pstats
+    os.makedirs(PERFILES_DIR, exist_ok=True)
+    stats = pstats.Stats(perfil)
+    perfil_busqueda = base + '.busqueda.prof'
+    if os.path.exists(perfil_busqueda):
+        try:
+            stats.add(perfil_busqueda)
+        finally:
+            os.remove(perfil_busqueda)
+    stats.dump_stats(base + '.prof')
+    resumen = io.StringIO()
+    stats.stream = resumen
+    stats.sort_stats('cumulative').print_stats(60)
+    with open(base + '.txt', 'w', encoding='utf-8') as f:
+        f.write(resumen.getvalue())
+    purgar_perfiles()
+
+@app.before_request
+def iniciar_perfil():
+    if request.endpoint in (None, 'static', 'health', 'metrics') or request.endpoint.startswith('perfilador'):
+        return
+    pedido = request.args.get('perfilar') == '1'
+    if not pedido and not _perfilador['restantes']:  # camino rápido sin lock
+        return
+    if pedido and not autorizado_diagnostico():
+        return
+    if not _perfil_en_curso.acquire(blocking=False):
+        return
+    accion = accion_de_request()
+    if not pedido:
+        with _perfilador_lock:
+            elegible = _perfilador['restantes'] > 0 and _perfilador['accion'] in (None, accion)
+            if elegible:
+                _perfilador['restantes'] -= 1
+        if not elegible:
+            _perfil_en_curso.release()
+            return
+    import cProfile
+    nombre = f"{now_local().strftime('%Y%m%d-%H%M%S')}-{re.sub(r'[^A-Za-z0-9_]', '_', accion)}-{uuid.uuid4().hex[:6]}"
+    request.perfil = cProfile.Profile()
+    request.perfil_nombre = nombre
+    _perfil_actual.set(os.path.join(PERFILES_DIR, nombre))
+    try:
+        request.perfil.enable()
+    except ValueError as e:  # otra herramienta de perfilado activa
+        log_debug('iniciar_perfil: no se pudo activar', e)
+        terminar_perfil()
+
+def terminar_perfil():
+    perfil = getattr(request, 'perfil', None)
+    if perfil is None:
+        return None
+    request.perfil = None
+    base = _perfil_actual.get()
+    _perfil_actual.set(None)
+    try:
+        perfil.disable()
+        guardar_perfil(perfil, base)
+        return os.path.basename(base) + '.prof'
+    except Exception as e:
+        log_debug('terminar_perfil: error guardando', e)
+        print(f"[WARN] No se pudo guardar el perfil: {e}")
+        return None
+    finally:
+        _perfil_en_curso.release()
+
+@app.after_request
+def cerrar_perfil(response):
+    nombre = terminar_perfil()
+    if nombre:
+        response.headers['X-Perfil'] = nombre
+    return response
+
+@app.teardown_request
+def liberar_perfil(exc):
+    # Si el view lanzó una excepción no pasa por after_request
+    terminar_perfil()
+
+@app.route('/api/perfilador', methods=['GET', 'POST'])
+def perfilador():
+    """GET: estado y perfiles guardados. POST requests=N [accion=consulta_producto]: perfila los próximos N."""
+    if not autorizado_diagnostico():
+        abort(403)
+    if request.method == 'POST':
+        datos = request.get_json(silent=True) or request.form
+        try:
+            cantidad = int(datos.get('requests', 1))
+        except (TypeError, ValueError):
+            return {'error': 'requests debe ser un entero'}, 400
+        with _perfilador_lock:
+            _perfilador['restantes'] = max(0, min(cantidad, PERFILADOR_MAX_REQUESTS))
+            _perfilador['accion'] = (datos.get('accion') or '').strip() or None
+    with _perfilador_lock:
+        estado = dict(_perfilador)
+    return {'restantes': estado['restantes'], 'accion': estado['accion'], 'perfiles': listar_perfiles()}, 200
+
+@app.route('/api/perfilador/<nombre>')
+def perfilador_descarga(nombre):
+    if not autorizado_diagnostico():
+        abort(403)
+    if not nombre.endswith(('.prof', '.txt')):
+        abort(404)
+    return send_from_directory(PERFILES_DIR, nombre, as_attachment=nombre.endswith('.prof'))
+
+# --- PREPARACIÓN DE LA BASE (fuera del import) ---
+# Tablas, migración JSON -> PG, credenciales y proveedores se preparan en segundo plano
+# (o con `python app_v5.py init-db`) para que el servidor acepte conexiones de inmediato.
+# Los requests (salvo /health y /metrics) esperan a que termine, como mucho PREPARACION_TIMEOUT.
+PREPARACION_TIMEOUT = float(os.getenv('PREPARACION_TIMEOUT', '30'))
+_preparacion_lista = threading.Event()
+_preparacion_iniciada = False
+_preparacion_lock = threading.Lock()
+
+def preparar_base_de_datos():
+    """Crea tablas, migra historial.json si la tabla está vacía y precarga credenciales y proveedores."""
+    global credentials_cache
+    inicio = time.perf_counter()
+    try:
+        ensure_tables()
+        maybe_migrate_historial_json_to_pg()
+        if os.path.exists(HISTORIAL_PENDIENTE_FILE):
+            iniciar_escritor_historial()  # quedaron entradas de una corrida anterior sin base
+        credentials_cache = load_credentials()
+        asegurar_proveedores()
+        log_debug(f'preparar_base_de_datos: lista en {time.perf_counter() - inicio:.2f}s')
+    except Exception as e:
+        log_debug('preparar_base_de_datos: error', e)
+    finally:
+        _preparacion_lista.set()
+
+def iniciar_preparacion_en_segundo_plano():
+    global _preparacion_iniciada
+    with _preparacion_lock:
+        if _preparacion_iniciada:
+            return
+        _preparacion_iniciada = True
+    threading.Thread(target=preparar_base_de_datos, name='preparar_db', daemon=True).start()
+
+@app.before_request
+def esperar_preparacion():
+    if request.endpoint in ('health', 'metrics', 'static'):
+        return
+    if not _preparacion_lista.is_set():
+        iniciar_preparacion_en_segundo_plano()
+        with etapa('preparacion'):
+            _preparacion_lista.wait(PREPARACION_TIMEOUT)
+
+def precalentar_al_arrancar():
+    _preparacion_lista.wait()
+    try:
+        purgar_catalogo_sqlite()
+    except Exception as e:
+        log_debug('purgar_catalogo_sqlite: error', e)
+    registrar_precios_listas_existentes()
+    precalentar_busqueda(asegurar_proveedores(), busquedas_frecuentes(BUSQUEDAS_PRECALENTAR))
+
 def abrir_navegador():
     webbrowser.open_new('http://127.0.0.1:5000/')
 
 if __name__ == "__main__":
+    import multiprocessing
+    multiprocessing.freeze_support()  # procesos de búsqueda en el ejecutable de escritorio
+    if len(sys.argv) > 1 and sys.argv[1] == 'init-db':
+        # Paso explícito de despliegue: tablas + migraciones, sin levantar el servidor
+        preparar_base_de_datos()
+        print("Base de datos preparada.")
+        sys.exit(0)
+    # SIGTERM (plataformas de deploy) sale por SystemExit: así corre atexit y se vuelca el historial
+    import signal
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    iniciar_preparacion_en_segundo_plano()
+    threading.Thread(target=precalentar_al_arrancar, name='precalentar_busqueda', daemon=True).start()
     # Puerto dinámico para plataformas como Railway / Render / Heroku
     port = int(os.getenv("PORT", 5000))
     # Abrir navegador solo si es entorno local (heurística: no hay PORT externo)
@@ -1122,4 +4259,4 @@ if __name__ == "__main__":
             pass
     print(f"Iniciando servidor en http://0.0.0.0:{port}/ (Waitress)")
     print(f"Las listas de precios en formato Excel deben guardarse en: {LISTAS_PATH}")
-    serve(app, host='0.0.0.0', port=port)
\ No newline at end of file
+    serve(app, host='0.0.0.0', port=port, threads=int(os.getenv('WAITRESS_THREADS', '4')))
\ No newline at end of file
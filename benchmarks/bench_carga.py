@@ -0,0 +1,322 @@
+"""Generador de carga: levanta app_v5 y reproduce tráfico de búsquedas, cálculos y subidas.
+
+Arranca `python app_v5.py` (waitress) desde una copia en una carpeta temporal, con LISTAS_PATH
+sembrada con las listas de `extras/`, así el historial, las credenciales y las listas de la
+instalación real no se tocan. Cada usuario virtual inicia sesión por `/login` y repite una
+mezcla de acciones hasta cumplir la duración:
+    - codigo: búsqueda por código.
+    - palabras: búsqueda por varias palabras.
+    - proveedor: búsqueda por palabras filtrada por proveedor.
+    - calcular_auto / calcular_manual: cálculos que se guardan en el historial.
+    - subida: subida de una lista (alterna entre dos versiones, así cada una se procesa).
+Informa throughput y latencias p50/p95/p99 por acción, rechazos (503) y errores.
+
+Uso:
+    python benchmarks/bench_carga.py [--usuarios 8] [--duracion 60] [--hilos-waitress 4]
+                                     [--procesos-busqueda 1]
+                                     [--mezcla codigo=35,palabras=30,proveedor=15,calcular_auto=8,calcular_manual=8,subida=4]
+                                     [--json salida.json]
+
+Contra un servidor ya levantado: --url http://host:puerto --usuario U --password P (ojo: los
+cálculos quedan en el historial y las subidas reemplazan listas de esa instalación).
+Sin --usar-database-url no se pasa DATABASE_URL a la app (para no escribir en la base real).
+"""
+from __future__ import annotations
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import random
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.cookiejar
+import urllib.error
+import urllib.parse
+import urllib.request
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXTRAS = os.path.join(REPO, "extras")
+LISTAS = ["Berger-092025.xlsx", "BremenTools-092025.xlsx", "Chiesa-08092025.xlsx", "Crossmaster-08092025.xlsx"]
+TERMINOS_PALABRAS = ["destornillador", "llave 1/2", "mecha acero", "tornillo", "pinza", "disco corte",
+                     "martillo", "cinta", "llave combinada", "broca"]
+PROVEEDORES_BUSQUEDA = ["Berger", "BremenTools", "Chiesa", "Crossmaster"]
+MEZCLA_DEFAULT = "codigo=35,palabras=30,proveedor=15,calcular_auto=8,calcular_manual=8,subida=4"
+USUARIO_DEFAULT = ("CPauluk", "20052016")  # credenciales iniciales de una instalación nueva
+
+
+def puerto_libre() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentil(valores: list[float], p: float) -> float:
+    ordenados = sorted(valores)
+    k = (len(ordenados) - 1) * p
+    i = int(k)
+    j = min(i + 1, len(ordenados) - 1)
+    return ordenados[i] + (ordenados[j] - ordenados[i]) * (k - i)
+
+
+def parsear_mezcla(texto: str) -> dict[str, float]:
+    mezcla = {}
+    for parte in texto.split(","):
+        nombre, _, peso = parte.partition("=")
+        nombre = nombre.strip()
+        if nombre not in ACCIONES:
+            raise SystemExit(f"Acción desconocida en --mezcla: {nombre} (válidas: {', '.join(ACCIONES)})")
+        mezcla[nombre] = float(peso or 1)
+    return mezcla
+
+
+def preparar_datos(trabajo: str) -> dict:
+    """Códigos de muestra y dos versiones de una lista para las subidas."""
+    import pandas as pd
+    berger = pd.read_excel(os.path.join(EXTRAS, "Berger-092025.xlsx"))
+    codigos = [str(c) for c in berger["COD"].dropna().astype(int).tolist()]
+    subidas = []
+    for i, recorte in enumerate((0, 1)):
+        ruta = os.path.join(trabajo, f"Berger-carga-{i}.xlsx")
+        berger.iloc[: len(berger) - recorte].to_excel(ruta, index=False)
+        with open(ruta, "rb") as f:
+            subidas.append(f.read())
+    return {"codigos": random.Random(0).sample(codigos, min(200, len(codigos))), "subidas": subidas}
+
+
+def levantar_app(trabajo: str, args) -> tuple[subprocess.Popen, str]:
+    """Copia la app a `trabajo` (para que sus JSON queden ahí) y la arranca con waitress."""
+    app_dir = os.path.join(trabajo, "app")
+    listas = os.path.join(trabajo, "listas")
+    os.makedirs(listas)
+    os.makedirs(app_dir)
+    shutil.copy(os.path.join(REPO, "app_v5.py"), app_dir)
+    shutil.copytree(os.path.join(REPO, "templates"), os.path.join(app_dir, "templates"))
+    for nombre in LISTAS:
+        shutil.copy(os.path.join(EXTRAS, nombre), listas)
+
+    port = puerto_libre()
+    env = dict(os.environ, LISTAS_PATH=listas, PORT=str(port), WAITRESS_THREADS=str(args.hilos_waitress),
+               PYTHONDONTWRITEBYTECODE="1")
+    env.setdefault("SECRET_KEY", uuid.uuid4().hex)
+    if args.procesos_busqueda is not None:
+        env["BUSQUEDA_PROCESOS"] = str(args.procesos_busqueda)
+    if not args.usar_database_url:
+        env.pop("DATABASE_URL", None)
+    salida = open(os.path.join(trabajo, "app.log"), "w")
+    proc = subprocess.Popen([sys.executable, os.path.join(app_dir, "app_v5.py")], cwd=app_dir, env=env,
+                            stdout=salida, stderr=subprocess.STDOUT)
+    url = f"http://127.0.0.1:{port}"
+    inicio = time.perf_counter()
+    while time.perf_counter() - inicio < 60:
+        if proc.poll() is not None:
+            raise RuntimeError(f"la app terminó al arrancar (ver {salida.name})")
+        try:
+            with urllib.request.urlopen(f"{url}/health", timeout=1) as r:
+                if r.status == 200:
+                    return proc, url
+        except Exception:
+            time.sleep(0.05)
+    proc.terminate()
+    raise RuntimeError("/health no respondió en 60s")
+
+
+class Usuario:
+    """Un navegador: su propia cookie de sesión."""
+
+    def __init__(self, url: str, usuario: str, password: str):
+        self.url = url
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+        status, html = self.enviar("/login", {"username": usuario, "password": password})
+        if status != 200 or "Credenciales inválidas" in html:
+            raise RuntimeError(f"login falló ({status})")
+
+    def enviar(self, ruta: str, campos: dict | None = None, archivo: tuple[str, bytes] | None = None,
+               timeout: float = 120) -> tuple[int, str]:
+        cabeceras = {}
+        cuerpo = None
+        if archivo is not None:
+            limite = uuid.uuid4().hex
+            partes = []
+            for clave, valor in (campos or {}).items():
+                partes.append(f'--{limite}\r\nContent-Disposition: form-data; name="{clave}"\r\n\r\n{valor}\r\n'.encode())
+            nombre, datos = archivo
+            partes.append(f'--{limite}\r\nContent-Disposition: form-data; name="archivos_excel"; filename="{nombre}"\r\n'
+                          f'Content-Type: application/octet-stream\r\n\r\n'.encode() + datos + b"\r\n")
+            partes.append(f"--{limite}--\r\n".encode())
+            cuerpo = b"".join(partes)
+            cabeceras["Content-Type"] = f"multipart/form-data; boundary={limite}"
+        elif campos is not None:
+            cuerpo = urllib.parse.urlencode(campos).encode()
+        pedido = urllib.request.Request(self.url + ruta, data=cuerpo, headers=cabeceras)
+        try:
+            with self.opener.open(pedido, timeout=timeout) as r:
+                return r.status, r.read().decode("utf-8", "replace")
+        except urllib.error.HTTPError as e:
+            return e.code, ""
+
+
+def accion_codigo(u: Usuario, datos: dict, rnd: random.Random):
+    return u.enviar("/", {"formulario": "consulta_producto", "termino_busqueda": rnd.choice(datos["codigos"])})
+
+
+def accion_palabras(u: Usuario, datos: dict, rnd: random.Random):
+    return u.enviar("/", {"formulario": "consulta_producto", "termino_busqueda": rnd.choice(TERMINOS_PALABRAS)})
+
+
+def accion_proveedor(u: Usuario, datos: dict, rnd: random.Random):
+    return u.enviar("/", {"formulario": "consulta_producto", "termino_busqueda": rnd.choice(TERMINOS_PALABRAS),
+                          "proveedor_busqueda": rnd.choice(PROVEEDORES_BUSQUEDA)})
+
+
+def accion_calcular_auto(u: Usuario, datos: dict, rnd: random.Random):
+    return u.enviar("/", {"formulario": "calcular_auto", "active_tab": "calculos",
+                          "proveedor_id": rnd.choice(datos["proveedor_ids"]),
+                          "precio": f"{rnd.uniform(100, 50000):.2f}".replace(".", ","), "auto_producto": "carga"})
+
+
+def accion_calcular_manual(u: Usuario, datos: dict, rnd: random.Random):
+    return u.enviar("/", {"formulario": "calcular_manual", "active_tab": "calculos",
+                          "manual_precio": f"{rnd.uniform(100, 50000):.2f}".replace(".", ","),
+                          "manual_descuento": "10", "manual_iva": "21", "manual_ganancia": "60",
+                          "manual_producto": "carga"})
+
+
+_subidas = {"n": 0}
+_subidas_lock = threading.Lock()
+
+
+def accion_subida(u: Usuario, datos: dict, rnd: random.Random):
+    with _subidas_lock:
+        contenido = datos["subidas"][_subidas["n"] % len(datos["subidas"])]
+        _subidas["n"] += 1
+    return u.enviar("/", {"formulario": "subir_lista", "active_tab": "gestion"}, archivo=("Berger.xlsx", contenido))
+
+
+ACCIONES = {
+    "codigo": accion_codigo,
+    "palabras": accion_palabras,
+    "proveedor": accion_proveedor,
+    "calcular_auto": accion_calcular_auto,
+    "calcular_manual": accion_calcular_manual,
+    "subida": accion_subida,
+}
+
+
+def usuario_virtual(indice: int, url: str, credenciales: tuple[str, str], datos: dict, mezcla: dict,
+                    fin: float, registros: list, lock: threading.Lock):
+    rnd = random.Random(indice)
+    u = Usuario(url, *credenciales)
+    nombres = list(mezcla)
+    pesos = [mezcla[n] for n in nombres]
+    propios = []
+    while time.perf_counter() < fin:
+        nombre = rnd.choices(nombres, pesos)[0]
+        inicio = time.perf_counter()
+        try:
+            status, _ = ACCIONES[nombre](u, datos, rnd)
+        except Exception:
+            status = 0  # conexión cortada / timeout
+        propios.append((nombre, status, time.perf_counter() - inicio))
+    with lock:
+        registros.extend(propios)
+
+
+def resumir(registros: list, duracion: float) -> dict:
+    por_accion = {}
+    for nombre in sorted({r[0] for r in registros}) + ["total"]:
+        filas = registros if nombre == "total" else [r for r in registros if r[0] == nombre]
+        ok = [r[2] * 1000 for r in filas if r[1] == 200]
+        por_accion[nombre] = {
+            "n": len(filas),
+            "ok": len(ok),
+            "rechazadas_503": sum(1 for r in filas if r[1] == 503),
+            "errores": sum(1 for r in filas if r[1] not in (200, 503)),
+            "por_s": round(len(ok) / duracion, 2),
+            "p50_ms": round(percentil(ok, 0.50), 1) if ok else None,
+            "p95_ms": round(percentil(ok, 0.95), 1) if ok else None,
+            "p99_ms": round(percentil(ok, 0.99), 1) if ok else None,
+            "max_ms": round(max(ok), 1) if ok else None,
+        }
+    return por_accion
+
+
+def rss_servidor(u: Usuario) -> float | None:
+    _, texto = u.enviar("/metrics")
+    m = re.search(r"^app_process_resident_memory_bytes (\d+)", texto, re.M)
+    return round(int(m.group(1)) / 2**20, 1) if m else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generador de carga para app_v5")
+    parser.add_argument("--usuarios", type=int, default=8, help="Usuarios virtuales concurrentes")
+    parser.add_argument("--duracion", type=float, default=60, help="Segundos de carga medida")
+    parser.add_argument("--mezcla", default=MEZCLA_DEFAULT, help="Pesos por acción (accion=peso,...)")
+    parser.add_argument("--hilos-waitress", type=int, default=4, help="WAITRESS_THREADS de la app levantada")
+    parser.add_argument("--procesos-busqueda", type=int, help="BUSQUEDA_PROCESOS de la app levantada")
+    parser.add_argument("--usar-database-url", action="store_true", help="Pasar DATABASE_URL a la app levantada")
+    parser.add_argument("--url", help="Usar un servidor ya levantado en lugar de arrancar uno")
+    parser.add_argument("--usuario", default=USUARIO_DEFAULT[0])
+    parser.add_argument("--password", default=USUARIO_DEFAULT[1])
+    parser.add_argument("--json", help="Guarda los resultados en este archivo")
+    args = parser.parse_args()
+    mezcla = parsear_mezcla(args.mezcla)
+    credenciales = (args.usuario, args.password)
+
+    with tempfile.TemporaryDirectory() as trabajo:
+        datos = preparar_datos(trabajo)
+        proc = None
+        if args.url:
+            url = args.url.rstrip("/")
+        else:
+            proc, url = levantar_app(trabajo, args)
+        try:
+            # Calentamiento fuera de la medición: primera lectura de las listas y proveedores disponibles
+            u = Usuario(url, *credenciales)
+            _, html = u.enviar("/")
+            datos["proveedor_ids"] = re.findall(r'<option value="(p[^"]+)"', html) or ["p001"]
+            for termino in ("destornillador", datos["codigos"][0]):
+                u.enviar("/", {"formulario": "consulta_producto", "termino_busqueda": termino})
+
+            registros, lock = [], threading.Lock()
+            inicio = time.perf_counter()
+            fin = inicio + args.duracion
+            hilos = [threading.Thread(target=usuario_virtual, args=(i, url, credenciales, datos, mezcla, fin, registros, lock))
+                     for i in range(args.usuarios)]
+            for h in hilos:
+                h.start()
+            for h in hilos:
+                h.join()
+            duracion = time.perf_counter() - inicio
+            rss = rss_servidor(u)
+        finally:
+            if proc is not None:
+                proc.terminate()
+                try:
+                    proc.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+
+    resumen = resumir(registros, duracion)
+    print(f"{args.usuarios} usuarios, {duracion:.0f}s, waitress {args.hilos_waitress} hilos"
+          + (f", RSS servidor {rss} MB" if rss is not None else ""))
+    print(f"{'acción':>16} {'n':>6} {'ok/s':>7} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8} {'503':>5} {'err':>5}")
+    for nombre, d in resumen.items():
+        fmt = lambda v: f"{v:8.1f}" if v is not None else f"{'-':>8}"
+        print(f"{nombre:>16} {d['n']:>6} {d['por_s']:>7.2f} {fmt(d['p50_ms'])} {fmt(d['p95_ms'])} {fmt(d['p99_ms'])} "
+              f"{fmt(d['max_ms'])} {d['rechazadas_503']:>5} {d['errores']:>5}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"parametros": {"usuarios": args.usuarios, "duracion_s": round(duracion, 1), "mezcla": mezcla,
+                                      "hilos_waitress": args.hilos_waitress, "procesos_busqueda": args.procesos_busqueda,
+                                      "url": args.url},
+                       "rss_servidor_mb": rss, "acciones": resumen}, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,315 @@
+"""Benchmark del catálogo de listas de app_v5 (parseo, búsqueda, subida y cálculo).
+
+Usa las listas reales de `extras/` copiadas a una carpeta temporal (como LISTAS_PATH) y una
+lista sintética más grande armada repitiendo la de Berger. Mide:
+    - parseo: lectura de cada Excel (`leer_hojas_excel`) y del snapshot mapeado.
+    - normalización: filas/s de normalizar_medidas(...) sobre los nombres.
+    - búsqueda por código y por varias palabras: latencia p50/p95 con la caché caliente.
+    - subida hasta buscable: desde que se encola la lista sintética hasta que un código
+      que solo está en ella aparece en la búsqueda.
+    - core_math: cálculos/s escalar y vectorizado.
+    - memoria: RSS pico del proceso.
+
+Uso:
+    python benchmarks/bench_catalogo.py [--repeticiones 20] [--escala 3] [--json salida.json]
+                                        [--umbrales benchmarks/umbrales_catalogo.json]
+                                        [--base resultados_anteriores.json --tolerancia 0.25]
+
+Con --umbrales y/o --base el script termina con código 1 si alguna métrica empeora más de
+lo permitido (para correrlo antes de desplegar). Sin --usar-database-url la app corre sin
+DATABASE_URL (tampoco la del .env), para no escribir la lista sintética en la base real.
+Las búsquedas se hacen en el propio proceso (BUSQUEDA_PROCESOS=0) salvo que se pase --procesos.
+"""
+from __future__ import annotations
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import argparse
+import platform
+import tempfile
+import subprocess
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXTRAS = os.path.join(REPO, "extras")
+UMBRALES_DEFAULT = os.path.join(REPO, "benchmarks", "umbrales_catalogo.json")
+
+# Listas de extras/ con configuración en PROVEEDOR_CONFIG
+LISTAS = ["Berger-092025.xlsx", "BremenTools-092025.xlsx", "Chiesa-08092025.xlsx", "Crossmaster-08092025.xlsx"]
+TERMINOS_PALABRAS = ["destornillador", "llave 1/2", "mecha acero", "tornillo", "pinza", "disco corte"]
+SINTETICA = "Berger-sintetica"
+CODIGO_MARCADOR = 88888888  # solo existe en la lista sintética
+MAYOR_ES_MEJOR = ("_por_s",)  # sufijos de métricas donde un valor más alto es mejor
+
+
+def percentil(valores: list[float], p: float) -> float:
+    ordenados = sorted(valores)
+    k = (len(ordenados) - 1) * p
+    i = int(k)
+    j = min(i + 1, len(ordenados) - 1)
+    return ordenados[i] + (ordenados[j] - ordenados[i]) * (k - i)
+
+
+def rss_pico_mb() -> float | None:
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux informa KB, macOS bytes
+    return round(pico / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def crear_lista_sintetica(destino: str, escala: int) -> int:
+    """Repite la lista de Berger `escala` veces (códigos desplazados) y agrega el código marcador."""
+    import pandas as pd
+    base = pd.read_excel(os.path.join(EXTRAS, "Berger-092025.xlsx"))
+    copias = []
+    for i in range(escala):
+        copia = base.copy()
+        copia["COD"] = copia["COD"] + i * 10_000_000
+        copias.append(copia)
+    marcador = pd.DataFrame([{"COD": CODIGO_MARCADOR, "DETALLE": "MARCADOR BENCHMARK", "P.VENTA": 1234.5, "MARCA": "BENCH"}])
+    df = pd.concat(copias + [marcador], ignore_index=True)
+    df.to_excel(destino, index=False)
+    return len(df)
+
+
+def medir_parseo(app, rutas: dict[str, str]) -> dict:
+    """Segundos de leer_hojas_excel por lista y de leer_snapshot para la más grande."""
+    resultados = {}
+    total = 0.0
+    for nombre, ruta in rutas.items():
+        clave_config = app.normalize_text(nombre.split("-")[0])
+        header = app.PROVEEDOR_CONFIG[clave_config]["fila_encabezado"]
+        inicio = time.perf_counter()
+        hojas = app.leer_hojas_excel(ruta, header)
+        duracion = time.perf_counter() - inicio
+        filas = sum(len(df) for df in hojas.values())
+        resultados[nombre] = {"s": round(duracion, 4), "filas": filas}
+        total += duracion
+        if nombre == SINTETICA:
+            clave = (app.sha256_archivo(ruta), header)
+            app.escribir_snapshot(clave, hojas)
+            tiempos = []
+            for _ in range(3):  # el mejor de 3: son milisegundos y el ruido pesa
+                inicio = time.perf_counter()
+                leidas = app.leer_snapshot(clave)
+                tiempos.append(time.perf_counter() - inicio)
+            resultados["snapshot_sintetica"] = {"s": round(min(tiempos), 4),
+                                                "filas": sum(len(df) for df in (leidas or {}).values())}
+    resultados["total_s"] = round(total, 4)
+    return resultados
+
+
+def medir_normalizacion(app, rutas: dict[str, str]) -> float:
+    """Filas/s de la normalización que hace la búsqueda por palabras."""
+    nombres = []
+    for nombre, ruta in rutas.items():
+        config = app.PROVEEDOR_CONFIG[app.normalize_text(nombre.split("-")[0])]
+        for df in app.leer_hojas_excel(ruta, config["fila_encabezado"]).values():
+            col = next((alias for alias in config["producto"] if alias in df.columns), None)
+            if col:
+                nombres.extend(df[col].tolist())
+    inicio = time.perf_counter()
+    for valor in nombres:
+        app.normalizar_medidas(valor)
+    return len(nombres) / (time.perf_counter() - inicio)
+
+
+def codigos_de_muestra(app, ruta: str, cantidad: int) -> list[str]:
+    hojas = app.leer_hojas_excel(ruta, 0)
+    df = next(iter(hojas.values()))
+    codigos = [str(c).split(".")[0] for c in df["cod"].dropna().tolist()]
+    return random.Random(0).sample(codigos, min(cantidad, len(codigos)))
+
+
+def medir_busquedas(app, terminos: list[str], repeticiones: int) -> dict:
+    """Latencias en ms (caché caliente: la primera pasada no se cuenta)."""
+    proveedores = app.asegurar_proveedores()
+    for termino in terminos:
+        app.ejecutar_busqueda(termino, "", proveedores)
+    tiempos = []
+    for _ in range(repeticiones):
+        for termino in terminos:
+            inicio = time.perf_counter()
+            app.ejecutar_busqueda(termino, "", proveedores)
+            tiempos.append((time.perf_counter() - inicio) * 1000)
+    return {"p50_ms": round(percentil(tiempos, 0.5), 2), "p95_ms": round(percentil(tiempos, 0.95), 2), "n": len(tiempos)}
+
+
+def medir_subida(app, ruta_sintetica: str, timeout: float = 300.0) -> float:
+    """Segundos desde que se encola la lista hasta que el código marcador aparece en la búsqueda."""
+    from werkzeug.datastructures import FileStorage
+    proveedores = app.asegurar_proveedores()
+    nombre_final = f"Berger-{app.now_local().strftime('%m%Y')}.xlsx"
+    inicio = time.perf_counter()
+    with open(ruta_sintetica, "rb") as f:
+        trabajo_id = app.encolar_ingesta(FileStorage(stream=f, filename="Berger.xlsx"), nombre_final, "Berger")
+    while time.perf_counter() - inicio < timeout:
+        trabajo = next(t for t in app.listar_ingestas() if t["id"] == trabajo_id)
+        if trabajo["estado"] == "error":
+            raise RuntimeError(f"la ingesta falló: {trabajo['mensaje']}")
+        if trabajo["estado"] == "listo":
+            productos, _ = app.ejecutar_busqueda(str(CODIGO_MARCADOR), "", proveedores)
+            if productos:
+                return time.perf_counter() - inicio
+        time.sleep(0.02)
+    raise RuntimeError(f"la lista no quedó buscable en {timeout}s")
+
+
+def medir_core_math(app, n: int = 200_000, pasadas: int = 3) -> dict:
+    """Cálculos/s (la mejor de `pasadas`) de core_math y core_math_vectorizado."""
+    import numpy as np
+    rng = np.random.default_rng(0)
+    precios = rng.uniform(1, 100_000, n)
+    lista_precios = precios.tolist()
+    descuentos = np.tile([0.10, np.nan], (n, 1))
+    ganancias = np.full((n, 1), 0.60)
+    escalar, vectorizado = [], []
+    for _ in range(pasadas):
+        inicio = time.perf_counter()
+        for precio in lista_precios:
+            app.core_math(precio, 0.21, [0.10, None], [0.60])
+        escalar.append(time.perf_counter() - inicio)
+        inicio = time.perf_counter()
+        app.core_math_vectorizado(precios, np.full(n, 0.21), descuentos, ganancias)
+        vectorizado.append(time.perf_counter() - inicio)
+    return {"escalar": n / min(escalar), "vectorizado": n / min(vectorizado)}
+
+
+def entorno_ejecucion() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        commit = None
+    import pandas as pd
+    import numpy as np
+    return {
+        "fecha": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "plataforma": platform.platform(),
+        "cpus": os.cpu_count(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+    }
+
+
+def verificar(metricas: dict, umbrales: dict | None, base: dict | None, tolerancia: float) -> list[str]:
+    """Lista de regresiones: contra límites absolutos (`max`/`min`) y contra una corrida anterior."""
+    problemas = []
+    for nombre, limite in (umbrales or {}).items():
+        valor = metricas.get(nombre)
+        if valor is None:
+            continue
+        if "max" in limite and valor > limite["max"]:
+            problemas.append(f"{nombre}={valor} supera el máximo {limite['max']}")
+        if "min" in limite and valor < limite["min"]:
+            problemas.append(f"{nombre}={valor} está debajo del mínimo {limite['min']}")
+    for nombre, anterior in (base or {}).items():
+        valor = metricas.get(nombre)
+        if valor is None or not anterior:
+            continue
+        if nombre.endswith(MAYOR_ES_MEJOR):
+            if valor < anterior * (1 - tolerancia):
+                problemas.append(f"{nombre}={valor} bajó más de {tolerancia:.0%} respecto de {anterior}")
+        elif valor > anterior * (1 + tolerancia):
+            problemas.append(f"{nombre}={valor} subió más de {tolerancia:.0%} respecto de {anterior}")
+    return problemas
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del catálogo de listas de app_v5")
+    parser.add_argument("--repeticiones", type=int, default=20, help="Pasadas de búsqueda por término")
+    parser.add_argument("--escala", type=int, default=3, help="Veces que se repite Berger en la lista sintética")
+    parser.add_argument("--procesos", type=int, default=0, help="BUSQUEDA_PROCESOS a usar (0 = en este proceso)")
+    parser.add_argument("--json", help="Guarda los resultados en este archivo")
+    parser.add_argument("--umbrales", nargs="?", const=UMBRALES_DEFAULT,
+                        help=f"Límites absolutos por métrica (por defecto {os.path.relpath(UMBRALES_DEFAULT, REPO)})")
+    parser.add_argument("--base", help="Resultados JSON de una corrida anterior para comparar")
+    parser.add_argument("--tolerancia", type=float, default=0.25, help="Empeoramiento relativo admitido contra --base")
+    parser.add_argument("--usar-database-url", action="store_true", help="Usar DATABASE_URL (del entorno o del .env) en la app")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as trabajo:
+        listas = os.path.join(trabajo, "listas")
+        os.makedirs(listas)
+        for nombre in LISTAS:
+            shutil.copy(os.path.join(EXTRAS, nombre), listas)
+        ruta_sintetica = os.path.join(trabajo, f"{SINTETICA}.xlsx")
+        filas_sinteticas = crear_lista_sintetica(ruta_sintetica, args.escala)
+
+        os.environ["LISTAS_PATH"] = listas
+        os.environ["BUSQUEDA_PROCESOS"] = str(args.procesos)
+        if not args.usar_database_url:
+            # Vacía y no borrada: app_v5 llama a load_dotenv(), que no pisa variables ya definidas
+            os.environ["DATABASE_URL"] = ""
+        sys.path.insert(0, REPO)
+        import app_v5 as app
+
+        # El proveedor de cada lista sale del nombre (lo anterior al primer guion)
+        rutas = {nombre: os.path.join(EXTRAS, nombre) for nombre in LISTAS}
+        rutas[SINTETICA] = ruta_sintetica
+        parseo = medir_parseo(app, rutas)
+        normalizacion = medir_normalizacion(app, rutas)
+
+        inicio = time.perf_counter()
+        app.ejecutar_busqueda("destornillador", "", app.asegurar_proveedores())
+        primera_busqueda = time.perf_counter() - inicio
+        codigos = codigos_de_muestra(app, rutas["Berger-092025.xlsx"], 10)
+        busqueda_codigo = medir_busquedas(app, codigos, args.repeticiones)
+        busqueda_palabras = medir_busquedas(app, TERMINOS_PALABRAS, args.repeticiones)
+        subida = medir_subida(app, ruta_sintetica)
+        core = medir_core_math(app)
+        if app._busqueda_pool is not None:
+            app._busqueda_pool.shutdown()
+
+    metricas = {
+        "parseo_excel_total_s": parseo["total_s"],
+        "parseo_sintetica_s": parseo[SINTETICA]["s"],
+        "snapshot_sintetica_s": parseo["snapshot_sintetica"]["s"],
+        "normalizacion_filas_por_s": round(normalizacion),
+        "busqueda_primera_s": round(primera_busqueda, 4),
+        "busqueda_codigo_p50_ms": busqueda_codigo["p50_ms"],
+        "busqueda_codigo_p95_ms": busqueda_codigo["p95_ms"],
+        "busqueda_palabras_p50_ms": busqueda_palabras["p50_ms"],
+        "busqueda_palabras_p95_ms": busqueda_palabras["p95_ms"],
+        "subida_a_buscable_s": round(subida, 4),
+        "core_math_por_s": round(core["escalar"]),
+        "core_math_vectorizado_por_s": round(core["vectorizado"]),
+        "rss_pico_mb": rss_pico_mb(),
+    }
+    resultados = {
+        "entorno": entorno_ejecucion(),
+        "parametros": {"repeticiones": args.repeticiones, "escala": args.escala, "procesos": args.procesos,
+                       "filas_sinteticas": filas_sinteticas},
+        "parseo": parseo,
+        "metricas": metricas,
+    }
+    for nombre, valor in metricas.items():
+        print(f"{nombre:>30}: {valor}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(resultados, f, indent=2, ensure_ascii=False)
+
+    umbrales = None
+    if args.umbrales:
+        with open(args.umbrales, "r", encoding="utf-8") as f:
+            umbrales = json.load(f)
+    base = None
+    if args.base:
+        with open(args.base, "r", encoding="utf-8") as f:
+            base = json.load(f).get("metricas", {})
+    problemas = verificar(metricas, umbrales, base, args.tolerancia)
+    for problema in problemas:
+        print(f"[REGRESIÓN] {problema}")
+    if problemas:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
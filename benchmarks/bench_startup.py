@@ -0,0 +1,100 @@
+"""Benchmark de arranque de app_v5.
+
+Mide, en procesos nuevos:
+    - import: tiempo de `import app_v5` (lo que paga cada worker al iniciar).
+    - health: tiempo desde lanzar `python app_v5.py` hasta que /health responde 200
+      (lo que mira el health-check de Railway).
+
+Uso:
+    python benchmarks/bench_startup.py [--repeticiones 5] [--json salida.json]
+
+Respeta DATABASE_URL si está definida (mide el arranque contra esa base).
+"""
+from __future__ import annotations
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import statistics
+import subprocess
+import urllib.request
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def puerto_libre() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def entorno(listas_path: str) -> dict:
+    env = dict(os.environ)
+    env.setdefault("LISTAS_PATH", listas_path)
+    env["PYTHONDONTWRITEBYTECODE"] = "1"
+    return env
+
+
+def medir_import(env: dict) -> float:
+    codigo = "import time; t = time.perf_counter(); import app_v5; print(time.perf_counter() - t)"
+    salida = subprocess.run([sys.executable, "-c", codigo], cwd=REPO, env=env,
+                            capture_output=True, text=True, check=True)
+    return float(salida.stdout.strip().splitlines()[-1])
+
+
+def medir_health(env: dict, timeout: float = 60.0) -> float:
+    port = puerto_libre()
+    env = dict(env, PORT=str(port))
+    inicio = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, os.path.join(REPO, "app_v5.py")], cwd=REPO, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - inicio < timeout:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=1) as r:
+                    if r.status == 200:
+                        return time.perf_counter() - inicio
+            except Exception:
+                time.sleep(0.01)
+        raise RuntimeError(f"/health no respondió en {timeout}s")
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def resumen(valores: list[float]) -> dict:
+    return {
+        "min_s": round(min(valores), 4),
+        "mediana_s": round(statistics.median(valores), 4),
+        "max_s": round(max(valores), 4),
+        "n": len(valores),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mide el tiempo de arranque de app_v5")
+    parser.add_argument("--repeticiones", type=int, default=5)
+    parser.add_argument("--json", help="Guarda los resultados en este archivo")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as listas:
+        env = entorno(listas)
+        imports = [medir_import(env) for _ in range(args.repeticiones)]
+        healths = [medir_health(env) for _ in range(args.repeticiones)]
+
+    resultados = {"import": resumen(imports), "health": resumen(healths)}
+    for nombre, datos in resultados.items():
+        print(f"{nombre:>7}: mediana {datos['mediana_s']:.3f}s  (min {datos['min_s']:.3f}s, max {datos['max_s']:.3f}s, n={datos['n']})")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(resultados, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
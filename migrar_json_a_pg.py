@@ -1,45 +1,60 @@
 """Script de migración de datos locales JSON a PostgreSQL.
 
 Uso:
-    python migrar_json_a_pg.py [--forzar-actualizacion]
+    python migrar_json_a_pg.py [--forzar-actualizacion] [--batch-size N]
+                               [--historial RUTA] [--proveedores RUTA]
 
 Requisitos:
     - Variable de entorno DATABASE_URL definida.
-    - Dependencias instaladas (psycopg2-binary, python-dotenv).
+    - Dependencias instaladas (psycopg 3, python-dotenv).
 
 Comportamiento:
     - Proveedores: Inserta proveedores que NO existan (por id). Con --forzar-actualizacion hace UPSERT.
-    - Historial: Inserta solo entradas cuyo id_historial no exista.
+    - Historial: se lee el JSON de forma incremental (array JSON o JSON lines), se copia por lotes
+      con COPY FROM STDIN a una tabla temporal y desde ahí se hace
+      INSERT ... ON CONFLICT (id_historial) DO NOTHING. No se cargan en memoria los ids existentes
+      ni el archivo completo. Se informa el avance y la velocidad (filas/s) por lote.
 
 Seguro para ejecutar múltiples veces (idempotente, salvo que uses la opción de forzar actualización de proveedores).
 """
 from __future__ import annotations
 import os
 import json
+import time
+import uuid
 import argparse
-from datetime import datetime
+from typing import Iterator
 from dotenv import load_dotenv
 
 try:
-    import psycopg2
-    from psycopg2.extras import RealDictCursor, Json
+    import psycopg
+    from psycopg.rows import dict_row
+    from psycopg.types.json import Jsonb
 except ImportError:
-    psycopg2 = None  # type: ignore
-    RealDictCursor = None  # type: ignore
-    class Json:  # fallback mínimo para tipeo
-        def __init__(self, v):
-            self.adapted = v
+    psycopg = None  # type: ignore
+    dict_row = None  # type: ignore
+    Jsonb = None  # type: ignore
 
 # Cargar .env si existe
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
+# Los timestamps del JSON son hora local de la app (mismo criterio que app_v5.py)
+APP_TZ_NAME = os.getenv("APP_TZ", "America/Argentina/Buenos_Aires")
 
 # Resolver rutas de los JSON (asumimos este script está en la raíz del proyecto)
 BASE_PATH = os.path.dirname(os.path.abspath(__file__))
 DATA_FILE = os.path.join(BASE_PATH, "datos_v2.json")
 HISTORIAL_FILE = os.path.join(BASE_PATH, "historial.json")
 
+BATCH_SIZE_DEFAULT = 5000
+CHUNK_LECTURA = 1024 * 1024  # caracteres leídos por vez del JSON
+
+COLUMNAS_HISTORIAL = (
+    "id_historial", "timestamp", "tipo_calculo", "proveedor_nombre", "producto",
+    "precio_base", "porcentajes", "precio_final", "observaciones",
+)
+
 
 def fail(msg: str):
     print(f"[ERROR] {msg}")
@@ -49,9 +64,9 @@ def fail(msg: str):
 def get_conn():
     if not DATABASE_URL:
         fail("DATABASE_URL no está definida.")
-    if not psycopg2:
-        fail("psycopg2 no está instalado. Ejecuta: pip install psycopg2-binary")
-    return psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
+    if not psycopg:
+        fail("psycopg no está instalado. Ejecuta: pip install 'psycopg[binary]'")
+    return psycopg.connect(DATABASE_URL, row_factory=dict_row, options=f"-c TimeZone={APP_TZ_NAME}")
 
 
 def ensure_tables():
@@ -64,7 +79,7 @@ def ensure_tables():
             );
             CREATE TABLE IF NOT EXISTS historial (
                 id_historial TEXT PRIMARY KEY,
-                timestamp TEXT NOT NULL,
+                timestamp TIMESTAMPTZ,
                 tipo_calculo TEXT,
                 proveedor_nombre TEXT,
                 producto TEXT,
@@ -73,6 +88,8 @@ def ensure_tables():
                 precio_final DOUBLE PRECISION,
                 observaciones TEXT
             );
+            -- Tablas creadas con NOT NULL por versiones anteriores: las entradas sin fecha van en NULL
+            ALTER TABLE historial ALTER COLUMN timestamp DROP NOT NULL;
             """
         )
         conn.commit()
@@ -90,6 +107,73 @@ def cargar_json(path: str, default):
         return default
 
 
+def iterar_items_json(path: str, chunk_size: int = CHUNK_LECTURA) -> Iterator[dict]:
+    """Recorre los objetos de un archivo JSON sin cargarlo entero.
+
+    Acepta un array JSON (`[{...}, {...}]`, formato de historial.json) o JSON lines
+    (un objeto por línea). Los elementos que no son objetos se ignoran.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8") as f:
+        buffer = f.read(chunk_size).lstrip("\ufeff")
+        fin_archivo = not buffer
+        pos = 0
+        # Saltar espacios iniciales y detectar el formato
+        while True:
+            while pos < len(buffer) and buffer[pos].isspace():
+                pos += 1
+            if pos < len(buffer) or fin_archivo:
+                break
+            buffer, pos = f.read(chunk_size), 0
+            fin_archivo = not buffer
+        en_array = pos < len(buffer) and buffer[pos] == "["
+        if en_array:
+            pos += 1
+        while True:
+            # Saltar separadores entre elementos
+            while pos < len(buffer) and (buffer[pos].isspace() or buffer[pos] == ","):
+                pos += 1
+            if pos < len(buffer) and en_array and buffer[pos] == "]":
+                return
+            if pos >= len(buffer):
+                if fin_archivo:
+                    return
+                buffer, pos = f.read(chunk_size), 0
+                fin_archivo = not buffer
+                continue
+            try:
+                item, fin = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # Objeto cortado al final del bloque: leer más y reintentar
+                if fin_archivo:
+                    raise
+                mas = f.read(chunk_size)
+                fin_archivo = not mas
+                buffer, pos = buffer[pos:] + mas, 0
+                continue
+            pos = fin
+            if isinstance(item, dict):
+                yield item
+            # Compactar el buffer para no retener lo ya procesado
+            if pos > chunk_size:
+                buffer, pos = buffer[pos:], 0
+
+
+def fila_historial(item: dict) -> tuple:
+    """Convierte una entrada del JSON en la tupla de columnas para COPY."""
+    return (
+        item.get("id_historial") or str(uuid.uuid4()),
+        item.get("timestamp") or None,  # sin fecha: NULL, no cuenta en los reportes por fecha
+        item.get("tipo_calculo"),
+        item.get("proveedor_nombre"),
+        item.get("producto"),
+        item.get("precio_base"),
+        json.dumps(item.get("porcentajes") or {}, ensure_ascii=False),
+        item.get("precio_final"),
+        item.get("observaciones"),
+    )
+
+
 def migrar_proveedores(data: dict, forzar_actualizacion: bool) -> tuple[int,int]:
     """Devuelve (insertados, actualizados)."""
     if not data:
@@ -97,74 +181,109 @@ def migrar_proveedores(data: dict, forzar_actualizacion: bool) -> tuple[int,int]
     inserted = 0
     updated = 0
     with get_conn() as conn, conn.cursor() as cur:
-        # Obtener existentes
-        cur.execute("SELECT id FROM proveedores")
-        existentes = {r["id"] for r in cur.fetchall()}
         for pid, pdata in data.items():
-            if pid in existentes:
-                if forzar_actualizacion:
-                    cur.execute(
-                        "UPDATE proveedores SET data = %s WHERE id = %s",
-                        (Json(pdata), pid)
-                    )
+            if forzar_actualizacion:
+                cur.execute(
+                    """
+                    INSERT INTO proveedores (id, data) VALUES (%s, %s)
+                    ON CONFLICT (id) DO UPDATE SET data = EXCLUDED.data
+                    RETURNING (xmax = 0) AS insertado
+                    """,
+                    (pid, Jsonb(pdata))
+                )
+                row = cur.fetchone()
+                if row and row["insertado"]:
+                    inserted += 1
+                else:
                     updated += 1
             else:
                 cur.execute(
-                    "INSERT INTO proveedores (id, data) VALUES (%s, %s)",
-                    (pid, Json(pdata))
+                    "INSERT INTO proveedores (id, data) VALUES (%s, %s) ON CONFLICT (id) DO NOTHING",
+                    (pid, Jsonb(pdata))
                 )
-                inserted += 1
+                inserted += cur.rowcount
         conn.commit()
     return inserted, updated
 
 
-def migrar_historial(items: list) -> int:
-    if not items:
-        return 0
-    inserted = 0
+def migrar_historial(items, batch_size: int = BATCH_SIZE_DEFAULT) -> tuple[int, int]:
+    """Copia el historial por lotes vía tabla temporal + INSERT ... ON CONFLICT DO NOTHING.
+
+    `items` puede ser cualquier iterable (p. ej. `iterar_items_json`). Devuelve (leídas, insertadas).
+    """
+    columnas = ", ".join(COLUMNAS_HISTORIAL)
+    leidas = 0
+    insertadas = 0
+    inicio = time.perf_counter()
     with get_conn() as conn, conn.cursor() as cur:
-        cur.execute("SELECT id_historial FROM historial")
-        existentes = {r["id_historial"] for r in cur.fetchall()}
-        for item in items:
-            if item.get("id_historial") in existentes:
-                continue
-            # Asegurar campos faltantes
+        cur.execute("CREATE TEMP TABLE historial_staging (LIKE historial INCLUDING DEFAULTS)")
+        lote = []
+
+        def volcar_lote():
+            nonlocal insertadas
+            with cur.copy(f"COPY historial_staging ({columnas}) FROM STDIN") as copy:
+                for fila in lote:
+                    copy.write_row(fila)
             cur.execute(
+                f"""
+                INSERT INTO historial ({columnas})
+                SELECT {columnas} FROM historial_staging
+                ON CONFLICT (id_historial) DO NOTHING
                 """
-                INSERT INTO historial (id_historial, timestamp, tipo_calculo, proveedor_nombre, producto,
-                                       precio_base, porcentajes, precio_final, observaciones)
-                VALUES (%(id_historial)s, %(timestamp)s, %(tipo_calculo)s, %(proveedor_nombre)s, %(producto)s,
-                        %(precio_base)s, %(porcentajes)s, %(precio_final)s, %(observaciones)s)
-                """,
-                item
             )
-            inserted += 1
-        conn.commit()
-    return inserted
+            insertadas += max(cur.rowcount, 0)
+            cur.execute("TRUNCATE historial_staging")
+            conn.commit()
+            lote.clear()
+            transcurrido = time.perf_counter() - inicio
+            velocidad = leidas / transcurrido if transcurrido > 0 else 0
+            print(f"[historial] {leidas} leídas, {insertadas} insertadas ({velocidad:,.0f} filas/s)", flush=True)
+
+        for item in items:
+            lote.append(fila_historial(item))
+            leidas += 1
+            if len(lote) >= batch_size:
+                volcar_lote()
+        if lote:
+            volcar_lote()
+    return leidas, insertadas
 
 
 def main():
     parser = argparse.ArgumentParser(description="Migrar datos JSON a PostgreSQL")
     parser.add_argument("--forzar-actualizacion", action="store_true", help="Actualiza proveedores existentes (UPSERT)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE_DEFAULT, help=f"Filas de historial por lote COPY (default {BATCH_SIZE_DEFAULT})")
+    parser.add_argument("--historial", default=HISTORIAL_FILE, help="Ruta del historial JSON (array o JSON lines)")
+    parser.add_argument("--proveedores", default=DATA_FILE, help="Ruta del JSON de proveedores")
     args = parser.parse_args()
 
     if not DATABASE_URL:
         fail("Define DATABASE_URL antes de migrar.")
-    if not psycopg2:
-        fail("Instala psycopg2-binary antes de migrar.")
+    if not psycopg:
+        fail("Instala psycopg antes de migrar.")
+    if args.batch_size < 1:
+        fail("--batch-size debe ser mayor que 0.")
 
     ensure_tables()
 
-    proveedores_json = cargar_json(DATA_FILE, {})
-    historial_json = cargar_json(HISTORIAL_FILE, [])
-
+    proveedores_json = cargar_json(args.proveedores, {})
     ins_p, upd_p = migrar_proveedores(proveedores_json, args.forzar_actualizacion)
-    ins_h = migrar_historial(historial_json)
+
+    leidas_h, ins_h = 0, 0
+    inicio = time.perf_counter()
+    if os.path.exists(args.historial):
+        leidas_h, ins_h = migrar_historial(iterar_items_json(args.historial), args.batch_size)
+    else:
+        print(f"[WARN] No existe {args.historial}, se salta.")
+    duracion = time.perf_counter() - inicio
 
     print("--- RESUMEN MIGRACIÓN ---")
     print(f"Proveedores insertados: {ins_p}")
     print(f"Proveedores actualizados: {upd_p}")
+    print(f"Entradas historial leídas: {leidas_h}")
     print(f"Entradas historial insertadas: {ins_h}")
+    if leidas_h:
+        print(f"Tiempo historial: {duracion:.1f}s ({leidas_h / duracion if duracion > 0 else 0:,.0f} filas/s)")
     print("Listo.")
 
 if __name__ == "__main__":
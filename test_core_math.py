@@ -0,0 +1,86 @@
+"""Prueba de core_math_vectorizado contra core_math, elemento por elemento.
+
+Uso:
+    python test_core_math.py      (o con pytest)
+
+La versión NumPy tiene que dar exactamente el mismo float que core_math (mismo orden de
+multiplicaciones y mismo redondeo que round(x, 4)), también en los precios que quedan justo
+en medio centavo de centavo, donde np.round y round() pueden diferir.
+"""
+import os
+import sys
+import random
+
+os.environ["BUSQUEDA_PROCESOS"] = "0"
+os.environ["DATABASE_URL"] = ""  # load_dotenv no pisa una variable ya definida
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import app_v5  # noqa: E402
+
+
+def comparar(casos):
+    """casos: [(precio, iva, [descuentos], [ganancias])], todos con la misma cantidad de columnas."""
+    nan = float("nan")
+    sin_nulos = lambda valores: [nan if v is None else v for v in valores]  # noqa: E731
+    vectorizado = app_v5.core_math_vectorizado(
+        [c[0] for c in casos],
+        sin_nulos([c[1] for c in casos]),
+        [sin_nulos(c[2]) for c in casos],
+        [sin_nulos(c[3]) for c in casos],
+    )
+    distintos = []
+    for caso, obtenido in zip(casos, vectorizado):
+        esperado = app_v5.core_math(*caso)
+        if obtenido != esperado:
+            distintos.append((caso, esperado, obtenido))
+    assert len(vectorizado) == len(casos)
+    assert not distintos, distintos[:5]
+    return len(casos)
+
+
+def porcentaje(azar):
+    """Un porcentaje como los que se cargan en la calculadora, o None (no aplicar)."""
+    if azar.random() < 0.2:
+        return None
+    return azar.choice([round(azar.uniform(0, 0.6), 4), azar.randint(0, 100) / 100, azar.randint(0, 1000) / 1000])
+
+
+def test_aleatorios():
+    azar = random.Random(20251019)
+    total = 0
+    for columnas in (0, 1, 3):
+        casos = []
+        for _ in range(20000):
+            precio = azar.choice([azar.uniform(0, 10), azar.uniform(0, 1e6), round(azar.uniform(0, 1e5), 2)])
+            iva = azar.choice([None, 0.105, 0.21, 0.27, porcentaje(azar)])
+            casos.append((precio, iva, [porcentaje(azar) for _ in range(columnas)],
+                          [porcentaje(azar) for _ in range(columnas)]))
+        total += comparar(casos)
+    print(f"{total} precios al azar iguales")
+
+
+def test_medio_centavo():
+    # Precios cuyo cuarto decimal queda en ...5 (el caso que redondea distinto según el método),
+    # solos y después de aplicar porcentajes que los dejan en el límite.
+    casos = []
+    for entero in (0, 1, 12, 999, 123456, 10 ** 9):
+        for cola in range(1, 20, 2):
+            precio = entero + cola / 20000  # x.00005, x.00015, ... x.00095
+            casos.append((precio, None, [None], [None]))
+            casos.append((precio, 0.0, [0.0], [0.0]))
+    for centavos in range(1, 2001):
+        precio = centavos / 100
+        casos.append((precio, 0.21, [None], [0.5]))
+        casos.append((precio, None, [0.05], [0.25]))
+        casos.append((precio / 2, None, [None], [None]))
+    print(f"{comparar(casos)} precios en medio centavo iguales")
+
+
+def test_vacio():
+    assert app_v5.core_math_vectorizado([], [], [], []) == []
+
+
+if __name__ == "__main__":
+    for nombre, prueba in list(globals().items()):
+        if nombre.startswith("test_"):
+            prueba()
+            print(f"OK {nombre}")
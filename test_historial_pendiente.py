@@ -0,0 +1,138 @@
+"""Prueba del archivo pendiente del historial (escritura diferida con la base caída).
+
+Uso:
+    python test_historial_pendiente.py      (o con pytest)
+
+La base se simula: guardar_entradas_historial falla mientras está "caída" y, cuando responde,
+guarda en un dict y rechaza los ids repetidos (así un reenvío duplicado hace fallar la prueba).
+El resto (cola en memoria, volcado, historial_pendiente.jsonl, load_historial, arranque) es el
+código real, con el archivo pendiente en una carpeta temporal. El arranque se prueba en un
+proceso aparte.
+"""
+import os
+import sys
+import json
+import time
+import atexit
+import shutil
+import tempfile
+import subprocess
+
+os.environ["BUSQUEDA_PROCESOS"] = "0"
+os.environ["DATABASE_URL"] = ""  # load_dotenv no pisa una variable ya definida
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import app_v5  # noqa: E402
+
+_carpeta_tmp = tempfile.mkdtemp(prefix="test_historial_")
+atexit.register(shutil.rmtree, _carpeta_tmp, ignore_errors=True)
+app_v5.HISTORIAL_PENDIENTE_FILE = os.path.join(_carpeta_tmp, "historial_pendiente.jsonl")
+
+
+class BaseSimulada:
+    def __init__(self):
+        self.caida = False
+        self.filas = {}
+        self.repetidas = []
+
+    def guardar(self, entradas, respaldo_json=True):
+        if self.caida:
+            return False
+        for entrada in entradas:
+            if entrada["id_historial"] in self.filas:
+                self.repetidas.append(entrada["id_historial"])
+            self.filas[entrada["id_historial"]] = entrada
+        return True
+
+    def leer(self):
+        return [dict(e) for e in self.filas.values()]
+
+
+def usar_base_simulada():
+    """Reemplaza la base por una simulada vacía y empieza sin nada pendiente."""
+    app_v5.vaciar_historial()
+    base = BaseSimulada()
+    app_v5.guardar_entradas_historial = base.guardar
+    app_v5.leer_historial_guardado = base.leer
+    if os.path.exists(app_v5.HISTORIAL_PENDIENTE_FILE):
+        os.remove(app_v5.HISTORIAL_PENDIENTE_FILE)
+    return base
+
+
+def entrada(id_historial):
+    return {
+        "id_historial": id_historial, "timestamp": app_v5.now_local().strftime(app_v5.TIMESTAMP_FORMATO),
+        "tipo_calculo": "Manual", "proveedor_nombre": "prueba", "producto": f"producto {id_historial}",
+        "precio_base": 100.0, "porcentajes": {"ganancia": 0.5}, "precio_final": 150.0, "observaciones": "",
+    }
+
+
+def ids_en_archivo():
+    with open(app_v5.HISTORIAL_PENDIENTE_FILE, "r", encoding="utf-8") as f:
+        return [json.loads(linea)["id_historial"] for linea in f]
+
+
+def ids_visibles():
+    return [e["id_historial"] for e in app_v5.load_historial()]
+
+
+def test_base_caida_va_al_archivo_y_se_sigue_viendo():
+    base = usar_base_simulada()
+    base.caida = True
+    app_v5.add_entries_to_historial([entrada("c1"), entrada("c2")])
+    app_v5.vaciar_historial()
+    assert sorted(ids_en_archivo()) == ["c1", "c2"]
+    assert not app_v5._historial_pendientes
+    assert sorted(ids_visibles()) == ["c1", "c2"]
+    assert not base.filas
+
+
+def test_reintento_sin_duplicados():
+    base = usar_base_simulada()
+    base.caida = True
+    app_v5.add_entry_to_historial(entrada("r1"))
+    app_v5.vaciar_historial()
+    app_v5.add_entry_to_historial(entrada("r2"))
+    app_v5.vaciar_historial()  # sigue caída: se agrega al archivo
+    assert sorted(ids_en_archivo()) == ["r1", "r2"]
+    base.caida = False
+    app_v5.add_entry_to_historial(entrada("r3"))
+    app_v5.vaciar_historial()
+    assert sorted(base.filas) == ["r1", "r2", "r3"]
+    assert not os.path.exists(app_v5.HISTORIAL_PENDIENTE_FILE)
+    app_v5.vaciar_historial()  # nada más para reenviar
+    assert not base.repetidas, base.repetidas
+    assert sorted(ids_visibles()) == ["r1", "r2", "r3"]
+
+
+def escenario_arranque():
+    """Arranque con el archivo que dejó una corrida anterior (corre en un proceso aparte)."""
+    base = usar_base_simulada()
+    with open(app_v5.HISTORIAL_PENDIENTE_FILE, "w", encoding="utf-8") as f:
+        for id_historial in ("a1", "a2"):
+            f.write(json.dumps(entrada(id_historial), ensure_ascii=False) + "\n")
+    assert sorted(ids_visibles()) == ["a1", "a2"]
+    app_v5.preparar_base_de_datos()
+    limite = time.monotonic() + 5
+    while os.path.exists(app_v5.HISTORIAL_PENDIENTE_FILE) and time.monotonic() < limite:
+        time.sleep(0.05)
+    assert not os.path.exists(app_v5.HISTORIAL_PENDIENTE_FILE)
+    assert sorted(base.filas) == ["a1", "a2"]
+    assert not base.repetidas, base.repetidas
+    assert sorted(ids_visibles()) == ["a1", "a2"]
+
+
+def test_al_arrancar_reenvia_lo_pendiente():
+    # Proceso nuevo: sin hilo escritor de las pruebas anteriores que pueda volcar el archivo antes
+    proceso = subprocess.run([sys.executable, os.path.abspath(__file__), "--arranque"],
+                             capture_output=True, text=True, timeout=120)
+    assert proceso.returncode == 0, proceso.stdout + proceso.stderr
+
+
+if __name__ == "__main__":
+    if "--arranque" in sys.argv:
+        escenario_arranque()
+        sys.exit(0)
+    for nombre, prueba in list(globals().items()):
+        if nombre.startswith("test_"):
+            prueba()
+            print(f"OK {nombre}")
@@ -0,0 +1,74 @@
+"""Prueba de la normalización de medidas con los nombres reales de las listas de extras/.
+
+Uso:
+    python test_medidas.py      (o con pytest)
+
+Copia las listas a una carpeta temporal (como LISTAS_PATH), sin base de datos, y comprueba que
+el término de búsqueda y los nombres de productos llevan las medidas al mismo token.
+"""
+import os
+import re
+import sys
+import atexit
+import shutil
+import tempfile
+
+CARPETA_EXTRAS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "extras")
+LISTAS = ["Berger-092025.xlsx", "BremenTools-092025.xlsx", "Chiesa-08092025.xlsx", "Crossmaster-08092025.xlsx"]
+
+_listas_tmp = tempfile.mkdtemp(prefix="test_medidas_")
+atexit.register(shutil.rmtree, _listas_tmp, ignore_errors=True)
+for _nombre in LISTAS:
+    shutil.copy(os.path.join(CARPETA_EXTRAS, _nombre), _listas_tmp)
+os.environ["LISTAS_PATH"] = _listas_tmp
+os.environ["BUSQUEDA_PROCESOS"] = "0"
+os.environ["CATALOGO_SQLITE"] = "0"
+os.environ["DATABASE_URL"] = ""  # load_dotenv no pisa una variable ya definida
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import app_v5  # noqa: E402
+
+
+def textos_de_listas():
+    """Todas las celdas de texto de todas las listas de extras/ (tengan o no configuración)."""
+    import pandas as pd
+    textos = []
+    for nombre in sorted(os.listdir(CARPETA_EXTRAS)):
+        if nombre.endswith(".xlsx"):
+            for df in pd.read_excel(os.path.join(CARPETA_EXTRAS, nombre), sheet_name=None, header=None).values():
+                textos.extend(v for v in df.to_numpy().ravel() if isinstance(v, str))
+    return textos
+
+
+def cantidad(termino):
+    productos, mensaje = app_v5.buscar_productos(termino, "", app_v5.asegurar_proveedores())
+    assert mensaje is None, mensaje
+    return len(productos)
+
+
+def test_mixto_con_espacio_igual_en_nombre_y_consulta():
+    nombres = textos_de_listas()
+    for termino in ("1 1/2", "3 1/4"):
+        token = app_v5.normalizar_medidas(termino, consulta=True)
+        patron = re.compile(r"(?<![\d/.,])" + re.escape(termino).replace(r"\ ", r"\s+") + r"(?![\d/.,])")
+        literales = [n for n in nombres if patron.search(n)]
+        assert literales, termino
+        perdidos = [n for n in literales if f" {token} " not in f" {app_v5.normalizar_medidas(n)} "]
+        assert not perdidos, (termino, perdidos[:5])
+        print(f"'{termino}': {len(literales)} nombres lo contienen, todos normalizados a {token}")
+
+
+def test_decimal_no_es_fraccion():
+    assert "1/4" not in app_v5.normalizar_medidas("EST 14.44").split()
+    assert "1/2" not in app_v5.normalizar_medidas("CAÑO 12,5 MM").split()
+
+
+def test_516_equivale_a_5_16():
+    assert cantidad("516") >= cantidad("5/16") == cantidad("5 16")
+    print(f"'516': {cantidad('516')}, '5/16': {cantidad('5/16')}, '5 16': {cantidad('5 16')}")
+
+
+if __name__ == "__main__":
+    for nombre, prueba in list(globals().items()):
+        if nombre.startswith("test_"):
+            prueba()
+            print(f"OK {nombre}")